@@ -1,45 +1,275 @@
-from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException, Query
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 import pandas as pd
+import numpy as np
 import os
 import json
 import pulp
-from typing import Dict, Any
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
 from pathlib import Path
 import math
+import io
 import base64
-from groq import Groq
 from datetime import datetime
 import logging
+import threading
+import asyncio
+import hashlib
+import zlib
+import random
+import itertools
+import heapq
+import bisect
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+import sqlite3
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
+try:
+    import orjson  # optional, faster JSON encoding
+except ImportError:
+    orjson = None
+try:
+    from PIL import Image, ImageChops, ImageOps  # optional, upload preprocessing
+except ImportError:
+    Image = None
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 # Load environment variables from .env at project root (if present)
 load_dotenv(dotenv_path=BASE_DIR / ".env")
 DATA_DIR = BASE_DIR / "data"
 
-app = FastAPI(title="KMRL Scheduler MVP")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm caches and the solver in the background; see start_warmup
+    start_warmup()
+    yield
+
+app = FastAPI(title="KMRL Scheduler MVP", lifespan=lifespan)
 
 # serve static files at '/static' (Starlette requires leading slash)
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 
-def load_csv(name):
-    p = DATA_DIR / name
-    return pd.read_csv(p)
+# ---------------------------------------------------------------------------
+# Timing: span("stage") times one stage of a request. Durations feed Prometheus
+# histograms served at /api/metrics and, with SERVER_TIMING=1, a Server-Timing
+# header listing the stages of that request. Metrics are per process.
+# ---------------------------------------------------------------------------
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS = {
+    "kmrl_http_request_seconds": ("histogram", "Request latency until the response is complete."),
+    "kmrl_stage_seconds": ("histogram", "Time spent in one stage of a request."),
+    "kmrl_schedule_solves_total": ("counter", "Schedule solves by solver and status."),
+    "kmrl_schedule_result_cache_total": ("counter", "/api/schedule answers by result cache outcome."),
+    "kmrl_schedule_model_variables": ("gauge", "Variables in the last schedule model built."),
+    "kmrl_schedule_model_constraints": ("gauge", "Constraints in the last schedule model built."),
+    "kmrl_shunting_swaps_total": ("counter", "State swaps made by the shunting stage."),
+    "kmrl_data_version": ("gauge", "Shared data version this worker last saw."),
+    "kmrl_mileage_rollup_rows_total": ("counter", "mileage.csv rows folded into the rollup, by append or rebuild."),
+    "kmrl_schedule_feed_subscribers": ("gauge", "Open /api/schedule/feed streams."),
+    "kmrl_schedule_feed_pushes_total": ("counter", "Schedule events pushed by reason."),
+}
+_METRICS_LOCK = threading.Lock()
+_METRIC_VALUES: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Any] = {}  # (name, labels) -> value or [buckets..., sum, count]
+_REQUEST_ROUTE: contextvars.ContextVar[str] = contextvars.ContextVar("request_route", default="")
+_REQUEST_TIMINGS: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("request_timings", default=None)
+
+def observe(name: str, value: float, **labels: str):
+    """Add value to histogram name."""
+    key = (name, tuple(sorted(labels.items())))
+    with _METRICS_LOCK:
+        h = _METRIC_VALUES.get(key)
+        if h is None:
+            h = _METRIC_VALUES[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+def count(name: str, amount: float = 1, **labels: str):
+    key = (name, tuple(sorted(labels.items())))
+    with _METRICS_LOCK:
+        _METRIC_VALUES[key] = _METRIC_VALUES.get(key, 0) + amount
+
+def set_gauge(name: str, value: float, **labels: str):
+    with _METRICS_LOCK:
+        _METRIC_VALUES[(name, tuple(sorted(labels.items())))] = value
+
+def record_stage(stage: str, seconds: float):
+    """Record a stage duration for the current request (and its histogram)."""
+    observe("kmrl_stage_seconds", seconds, route=_REQUEST_ROUTE.get(), stage=stage)
+    timings = _REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def _metric_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    with _METRICS_LOCK:
+        items = sorted((k, list(v) if isinstance(v, list) else v) for k, v in _METRIC_VALUES.items())
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in items:
+            if metric != name:
+                continue
+            if kind != "histogram":
+                lines.append(f"{name}{_metric_labels(labels)} {value}")
+                continue
+            for bound, n in [*zip(METRIC_BUCKETS, value), ("+Inf", value[-1])]:
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{_metric_labels(labels, le)} {n}")
+            lines.append(f"{name}_sum{_metric_labels(labels)} {value[-2]:.6f}")
+            lines.append(f"{name}_count{_metric_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+def server_timing_header(timings: List[Tuple[str, float]], total: float) -> str:
+    """Server-Timing value; repeated stages (e.g. one per uploaded file) are summed."""
+    merged: Dict[str, float] = {}
+    for stage, seconds in timings:
+        merged[stage] = merged.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in [*merged.items(), ("total", total)])
+
+class TimingMiddleware:
+    """Times every HTTP request by route and collects its stages (ASGI middleware,
+    so streamed responses are timed until their last chunk)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings: List[Tuple[str, float]] = []
+        route_token = _REQUEST_ROUTE.set(scope["path"])
+        timings_token = _REQUEST_TIMINGS.set(timings)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if SERVER_TIMING:
+                    header = server_timing_header(timings, time.perf_counter() - started)
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            route = scope.get("route")
+            # the route template keeps label cardinality bounded (static files and 404s share "other")
+            observe("kmrl_http_request_seconds", time.perf_counter() - started,
+                    route=getattr(route, "path", "other"), method=scope["method"], status=str(status[0]))
+            _REQUEST_TIMINGS.reset(timings_token)
+            _REQUEST_ROUTE.reset(route_token)
+
+app.add_middleware(TimingMiddleware)
+
+# Process-wide cache of parsed fleet tables. Entries are keyed by (table, kind)
+# and stay valid while the storage backend's signature for that table is
+# unchanged (file mtime/size for CSV, a version counter for SQLite); writers
+# in this module also invalidate explicitly after touching a table.
+_FLEET_CACHE_LOCK = threading.Lock()
+_FLEET_CACHE: Dict[Tuple[str, str], Tuple[Any, Any]] = {}
+_DATA_PAYLOAD: Dict[str, Tuple[Any, bytes]] = {}  # orient -> (signature, body)
+
+def file_signature(path: Path) -> Optional[Tuple[int, int]]:
+    """Return (mtime_ns, size) for path, or None when it does not exist."""
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def cached_table(table: str, kind: str, build: Callable[[str], Any]) -> Any:
+    """Return build(table), memoized until the table changes in storage or is invalidated.
+    Cached values are shared between requests and must be treated as read-only.
+    """
+    key = (table, kind)
+    sig = STORAGE.signature(table)
+    with _FLEET_CACHE_LOCK:
+        hit = _FLEET_CACHE.get(key)
+        if hit is not None and hit[0] == sig:
+            return hit[1]
+    value = build(table)
+    with _FLEET_CACHE_LOCK:
+        _FLEET_CACHE[key] = (sig, value)
+    return value
+
+def invalidate_fleet_cache(table: Optional[str] = None):
+    """Drop cached values for table, e.g. "fitness.csv" (or everything when None).
+    The mileage rollup follows appends on its own and is only reset by a full drop."""
+    global _MILEAGE_ROLLUP
+    with _FLEET_CACHE_LOCK:
+        if table is None:
+            _FLEET_CACHE.clear()
+            _MILEAGE_ROLLUP = None
+        else:
+            for key in [k for k in _FLEET_CACHE if k[0] == table]:
+                del _FLEET_CACHE[key]
+        _DATA_PAYLOAD.clear()
+    if table is None or table == "trains.csv" or table[:-4] in FLEET_TABLES:
+        invalidate_schedule_cache()
+
+def _column_safe(values: np.ndarray) -> List[Any]:
+    """Column values as Python objects with NaN/inf replaced by None (vectorized)."""
+    kind = values.dtype.kind
+    if kind in "iub":
+        return values.tolist()
+    if kind == "f":
+        bad = ~np.isfinite(values)
+    else:
+        values = values.astype(object)
+        bad = pd.isna(values) | (values == np.inf) | (values == -np.inf)
+    if not bad.any():
+        return values.tolist()
+    values = values.astype(object)
+    values[bad] = None
+    return values.tolist()
+
+def df_columns_safe(df: pd.DataFrame) -> Dict[str, List[Any]]:
+    """Convert DataFrame to {column: list} with NaN/inf replaced by None for JSON compliance."""
+    return {col: _column_safe(df[col].to_numpy()) for col in df.columns}
 
 def df_records_safe(df: pd.DataFrame):
     """Convert DataFrame to list[dict] with NaN/inf replaced by None for JSON compliance."""
-    # Replace NaN/inf with None
-    df_clean = df.copy()
-    # Replace NaN
-    df_clean = df_clean.where(pd.notna(df_clean), None)
-    # Replace +/-inf
-    for col in df_clean.columns:
-        df_clean[col] = df_clean[col].apply(
-            lambda v: (None if _is_nan_or_inf(v) else v)
-        )
-    return df_clean.to_dict(orient="records")
+    columns = df_columns_safe(df)
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+def json_bytes(content: Any) -> bytes:
+    """Compact UTF-8 JSON; orjson when installed (NaN/inf become null), stdlib json otherwise."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered through json_bytes."""
+    def render(self, content: Any) -> bytes:
+        return json_bytes(content)
 
 def _is_nan_or_inf(v) -> bool:
     try:
@@ -62,12 +292,191 @@ def now_iso() -> str:
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
-def append_or_update_csv(csv_path: Path, key: str, row: Dict[str, Any]):
-    """Upsert a row by key and keep the last record per key.
-    - Adds a timestamp when missing.
-    - Preserves existing values for columns not provided in the new row.
+# ---------------------------------------------------------------------------
+# Cross-process data lock and shared data version, for running several uvicorn
+# workers (or replicas on one volume) against the same data directory. Writers
+# hold an exclusive lock on the storage's lock file, readers that need a
+# consistent multi-table snapshot a shared one; inside a process the lock is
+# layered under _UPSERT_LOCK (defined with the upsert index below). Every write
+# bumps a version counter kept next to the data, so each worker can tell when
+# its caches were built from data another worker has since changed.
+# ---------------------------------------------------------------------------
+
+try:
+    import fcntl  # POSIX advisory locks
+except ImportError:
+    fcntl = None
+    try:
+        import msvcrt  # Windows: byte-range locks, exclusive only
+    except ImportError:
+        msvcrt = None
+
+_DATA_LOCK_STATE: Dict[str, Any] = {"path": None, "pid": None, "file": None, "depth": 0, "exclusive": False}
+
+def _file_lock(f, exclusive: bool):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    elif msvcrt is not None:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return
+            except OSError:
+                time.sleep(0.01)
+
+def _file_unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _data_lock_file():
+    """Open handle on the active storage's lock file (one per process); None if it cannot be created."""
+    st = _DATA_LOCK_STATE
+    path = STORAGE.lock_path
+    if st["file"] is not None and st["path"] == path and st["pid"] == os.getpid():
+        return st["file"]
+    try:
+        ensure_dir(path.parent)
+        f = open(path, "a+b")
+    except OSError as e:
+        logging.getLogger("storage").warning("Data lock unavailable; writes are only serialized within this process",
+                                             extra={"path": str(path), "error": str(e)})
+        f = None
+    st.update(path=path, pid=os.getpid(), file=f)
+    return f
+
+@contextmanager
+def data_lock(exclusive: bool = True):
+    """Hold the data lock: exclusive for writers, shared for snapshot readers.
+    Re-entrant within a thread; a nested writer upgrades an outer shared hold
+    for its duration.
     """
-    ensure_dir(csv_path.parent)
+    with _UPSERT_LOCK:
+        st = _DATA_LOCK_STATE
+        outer = st["depth"] == 0
+        upgrade = not outer and exclusive and not st["exclusive"]
+        f = _data_lock_file() if outer else st["file"]
+        if f is not None and (outer or upgrade):
+            _file_lock(f, exclusive)
+        if outer or upgrade:
+            st["exclusive"] = exclusive
+        st["depth"] += 1
+        try:
+            yield
+        finally:
+            st["depth"] -= 1
+            if f is not None and st["depth"] == 0:
+                _file_unlock(f)
+            elif f is not None and upgrade:
+                _file_lock(f, False)
+            if upgrade:
+                st["exclusive"] = False
+
+def atomic_write(path: Path, write: Callable[[Any], None], mode: str = "w", durable: bool = True):
+    """Write path through a uniquely named temp file in the same directory, then
+    rename it over path, so readers see either the old or the new file.
+    durable=False skips the fsync, for files that are cheap to lose in a crash."""
+    import tempfile
+    ensure_dir(path.parent)
+    fd, tmp = tempfile.mkstemp(prefix=path.name + ".", suffix=".tmp", dir=path.parent)
+    try:
+        with open(fd, mode, **({} if "b" in mode else {"encoding": "utf-8", "newline": ""})) as f:
+            write(f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+_SEEN_DATA_VERSION: Dict[str, Any] = {"version": None}
+
+def sync_data_version() -> Any:
+    """Return the shared data version, dropping this worker's derived caches when
+    another process has written since we last looked."""
+    version = STORAGE.data_version()
+    if version != _SEEN_DATA_VERSION["version"]:
+        if _SEEN_DATA_VERSION["version"] is not None:
+            # table caches revalidate by signature on their own; solved schedules are keyed by data version
+            invalidate_schedule_cache()
+        _SEEN_DATA_VERSION["version"] = version
+        set_gauge("kmrl_data_version", version)
+    return version
+
+# Upsert indexes for append_or_update_csv, keyed by CSV path. Each entry holds
+# the header, the last row per key (raw CSV cells) and the file signature we
+# last observed, so an upsert is a single appended line instead of a rewrite.
+# Superseded rows are folded away by compact_csv once enough have accumulated.
+_UPSERT_LOCK = threading.RLock()
+_UPSERT_INDEX: Dict[str, Dict[str, Any]] = {}
+CSV_COMPACT_MIN_APPENDS = int(os.getenv("CSV_COMPACT_MIN_APPENDS", "500"))
+
+def _csv_cell(v) -> str:
+    """Format a value the way DataFrame.to_csv would (None/NaN -> empty)."""
+    if v is None:
+        return ""
+    if isinstance(v, float) and math.isnan(v):
+        return ""
+    return str(v)
+
+def _build_upsert_index(csv_path: Path, key: str) -> Optional[Dict[str, Any]]:
+    """Scan csv_path once and index its last row per key. None if it has no usable header."""
+    import csv
+    with open(csv_path, mode="r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header or key not in header:
+            return None
+        k = header.index(key)
+        rows = {}
+        total = 0
+        for cells in reader:
+            if not cells:
+                continue
+            cells = (cells + [""] * len(header))[:len(header)]
+            rows[cells[k]] = cells
+            total += 1
+    with open(csv_path, mode="rb") as f:
+        f.seek(0, os.SEEK_END)
+        needs_newline = False
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    return {
+        "key": key,
+        "header": header,
+        "rows": rows,
+        "total": total,
+        "appended": 0,
+        "needs_newline": needs_newline,
+        "signature": file_signature(csv_path),
+    }
+
+def _upsert_index(csv_path: Path, key: str) -> Optional[Dict[str, Any]]:
+    """Return the upsert index for csv_path, rebuilding it if the file changed behind our back."""
+    idx = _UPSERT_INDEX.get(str(csv_path))
+    if idx is not None and idx["key"] == key and idx["signature"] == file_signature(csv_path):
+        return idx
+    _UPSERT_INDEX.pop(str(csv_path), None)
+    if not csv_path.exists() or csv_path.stat().st_size == 0:
+        return None
+    try:
+        idx = _build_upsert_index(csv_path, key)
+    except Exception:
+        idx = None
+    if idx is not None:
+        _UPSERT_INDEX[str(csv_path)] = idx
+    return idx
+
+def _rewrite_upsert_csv(csv_path: Path, key: str, rows: List[Dict[str, Any]]):
+    """Full read/concat/dedupe rewrite, used when the rows introduce new columns."""
     df_existing = None
     if csv_path.exists():
         try:
@@ -76,44 +485,551 @@ def append_or_update_csv(csv_path: Path, key: str, row: Dict[str, Any]):
             df_existing = pd.DataFrame()
     else:
         df_existing = pd.DataFrame()
-
-    row = {**row}
-    if "timestamp" not in row:
-        row["timestamp"] = now_iso()
-    # If an existing row for this key exists, backfill unspecified columns from it
-    if not df_existing.empty and key in df_existing.columns and row.get(key) in set(df_existing[key].astype(str)):
-        try:
-            ex_row = df_existing[df_existing[key].astype(str) == str(row.get(key))].tail(1)
-        except Exception:
-            ex_row = pd.DataFrame()
-        if not ex_row.empty:
-            cols = list(set(df_existing.columns).union(row.keys()))
-            merged = {}
-            for c in cols:
-                if c in row and row[c] is not None and row[c] != "":
-                    merged[c] = row[c]
-                else:
-                    merged[c] = ex_row.iloc[0][c] if c in ex_row.columns else None
-            new_row_df = pd.DataFrame([merged])
-        else:
-            new_row_df = pd.DataFrame([row])
-    else:
-        new_row_df = pd.DataFrame([row])
-
+    new_rows_df = pd.DataFrame(rows)
     if df_existing.empty:
-        df_out = new_row_df
+        df_out = new_rows_df
     else:
-        df_out = pd.concat([df_existing, new_row_df], ignore_index=True)
+        df_out = pd.concat([df_existing, new_rows_df], ignore_index=True)
         # Deduplicate by key keeping last
         if key in df_out.columns:
             df_out = df_out.drop_duplicates(subset=[key], keep="last")
-    df_out.to_csv(csv_path, index=False)
+    atomic_write(csv_path, lambda f: df_out.to_csv(f, index=False, lineterminator="\n"))
+
+def compact_csv(csv_path: Path, key: str):
+    """Rewrite csv_path keeping only the last row per key (atomic temp-file replace)."""
+    import csv
+    with data_lock():
+        idx = _upsert_index(csv_path, key)
+        if idx is None or idx["total"] == len(idx["rows"]):
+            return
+        k = idx["header"].index(key)
+        with open(csv_path, mode="r", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            last = {}
+            for cells in reader:
+                if not cells:
+                    continue
+                cells = (cells + [""] * len(idx["header"]))[:len(idx["header"])]
+                # Re-inserting moves the key to its last position, as drop_duplicates(keep="last") does
+                last.pop(cells[k], None)
+                last[cells[k]] = cells
+        def write(f):
+            w = csv.writer(f, lineterminator="\n")
+            w.writerow(idx["header"])
+            w.writerows(last.values())
+        atomic_write(csv_path, write)
+        idx.update(rows=last, total=len(last), appended=0, needs_newline=False, signature=file_signature(csv_path))
+    invalidate_fleet_cache(csv_path.name)
+    logging.getLogger("ingest").info("Compacted CSV", extra={"csv": csv_path.name, "rows": len(last)})
 
-def append_ingestion_audit(filename: str, size_bytes: int, model: str, entries: Any, updates: Any, raw_text: str):
-    """Append a single audit row to data/ingestion_log.csv with a safe excerpt of raw text."""
-    ensure_dir(DATA_DIR)
+def upsert_csv_rows(csv_path: Path, key: str, rows: List[Dict[str, Any]]):
+    """Upsert several rows by key in one write, keeping the last record per key.
+    - Adds a timestamp when missing.
+    - Preserves existing values for columns not provided in a new row; rows for
+      the same key are merged in order, so the last write wins per column.
+    - Appends the merged rows in a single write when they fit the existing
+      header; otherwise rewrites the file via a temp file and atomic rename.
+      Superseded rows are removed by a background compact_csv once enough accumulate.
+    """
     import csv
-    path = DATA_DIR / "ingestion_log.csv"
+    if not rows:
+        return
+    ensure_dir(csv_path.parent)
+    compact = False
+    with data_lock():
+        idx = _upsert_index(csv_path, key)
+        header = idx["header"] if idx is not None else []
+        staged: Dict[str, Dict[str, Any]] = {}
+        for row in rows:
+            row = {**row}
+            if "timestamp" not in row:
+                row["timestamp"] = now_iso()
+            k = str(row.get(key))
+            prev = staged.get(k)
+            if prev is None and idx is not None and k in idx["rows"]:
+                prev = dict(zip(header, idx["rows"][k]))
+            merged = dict(prev or {})
+            for c, v in row.items():
+                if (v is not None and v != "") or c not in merged:
+                    merged[c] = v
+            staged[k] = merged
+
+        if idx is None or any(not set(r.keys()) <= set(header) for r in staged.values()):
+            # New file or new columns: fall back to a full rewrite and re-index lazily
+            _rewrite_upsert_csv(csv_path, key, list(staged.values()))
+            _UPSERT_INDEX.pop(str(csv_path), None)
+        else:
+            lines = []
+            for k, merged in staged.items():
+                cells = [_csv_cell(merged.get(c)) for c in header]
+                lines.append(cells)
+                idx["rows"][k] = cells
+            with open(csv_path, mode="a", encoding="utf-8", newline="") as f:
+                buf = io.StringIO()
+                if idx["needs_newline"]:
+                    buf.write("\n")
+                csv.writer(buf, lineterminator="\n").writerows(lines)
+                f.write(buf.getvalue())
+            idx["total"] += len(lines)
+            idx["appended"] += len(lines)
+            idx["needs_newline"] = False
+            idx["signature"] = file_signature(csv_path)
+            compact = idx["appended"] >= max(CSV_COMPACT_MIN_APPENDS, len(idx["rows"]))
+            if compact:
+                idx["appended"] = 0
+    invalidate_fleet_cache(csv_path.name)
+    if compact:
+        threading.Thread(target=compact_csv, args=(csv_path, key), daemon=True).start()
+
+def append_or_update_csv(csv_path: Path, key: str, row: Dict[str, Any]):
+    """Upsert a single row by key; see upsert_csv_rows.
+    Files under DATA_DIR are routed through the active storage backend.
+    """
+    if csv_path.parent == DATA_DIR:
+        STORAGE.upsert(csv_path.name, key, [row])
+    else:
+        upsert_csv_rows(csv_path, key, [row])
+
+def csv_has_key(csv_path: Path, key: str, value: str) -> bool:
+    """True when csv_path already holds a row whose key column equals value."""
+    with data_lock(exclusive=False):
+        idx = _upsert_index(csv_path, key)
+        return idx is not None and str(value) in idx["rows"]
+
+# ---------------------------------------------------------------------------
+# Storage backends. Tables are addressed by their CSV file name ("fitness.csv")
+# whichever backend is active, so API payloads keep the same keys. Select with
+# FLEET_STORAGE=csv (default) or FLEET_STORAGE=sqlite (FLEET_DB, default
+# data/fleet.db); `python -m backend.main migrate` imports data/*.csv.
+# ---------------------------------------------------------------------------
+
+def _crc32_prefix(f, n: int) -> int:
+    """CRC-32 of the next n bytes of f, read in 1 MiB blocks."""
+    crc = 0
+    while n > 0:
+        block = f.read(min(n, 1 << 20))
+        if not block:
+            break
+        crc = zlib.crc32(block, crc)
+        n -= len(block)
+    return crc
+
+class CsvStorage:
+    """Plain CSV files under a data directory (the original layout).
+    Table versions live in .versions.json beside them: {"seq": n, "tables": {table: seq of its last write}}.
+    """
+
+    kind = "csv"
+
+    def __init__(self, data_dir: Path):
+        self.data_dir = data_dir
+        self.lock_path = data_dir / ".fleet.lock"
+        self.versions_path = data_dir / ".versions.json"
+        self._versions_cache: Tuple[Any, Dict[str, Any]] = (None, {"seq": 0, "tables": {}})
+
+    def _versions(self) -> Dict[str, Any]:
+        try:
+            st = self.versions_path.stat()
+        except OSError:
+            return {"seq": 0, "tables": {}}
+        # the file is only ever replaced, so a new inode/mtime means new content
+        sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self._versions_cache
+        if cached[0] == sig:
+            return cached[1]
+        try:
+            versions = json.loads(self.versions_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {"seq": 0, "tables": {}}
+        self._versions_cache = (sig, versions)
+        return versions
+
+    def bump(self, tables: List[str]):
+        """Record a write to tables (call with the data lock held)."""
+        versions = self._versions()
+        seq = versions["seq"] + 1
+        versions = {"seq": seq, "tables": {**versions["tables"], **dict.fromkeys(tables, seq)}}
+        # losing it in a crash only resets the counters, which still differ from any cached signature
+        atomic_write(self.versions_path, lambda f: json.dump(versions, f), durable=False)
+
+    def data_version(self) -> int:
+        return self._versions()["seq"]
+
+    def tables(self) -> List[str]:
+        return sorted(f for f in os.listdir(self.data_dir) if f.endswith(".csv"))
+
+    def signature(self, table: str):
+        sig = file_signature(self.data_dir / table)
+        return None if sig is None else (self._versions()["tables"].get(table, 0), *sig)
+
+    def read(self, table: str) -> pd.DataFrame:
+        return pd.read_csv(self.data_dir / table)
+
+    def iter_chunks(self, table: str, start: int = 0, chunksize: int = 5000) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """Yield (first row position, DataFrame) from data row start on, chunksize rows at a time."""
+        skip = (lambda i: 0 < i <= start) if start else None
+        try:
+            reader = pd.read_csv(self.data_dir / table, skiprows=skip, chunksize=chunksize)
+        except pd.errors.EmptyDataError:
+            return
+        first = start
+        with reader:
+            for chunk in reader:
+                yield first, chunk
+                first += len(chunk)
+
+    def latest_by_train(self, table: str) -> Dict[str, Dict[str, Any]]:
+        return _latest_by_train_df(pd.read_csv(self.data_dir / table))
+
+    def read_since(self, table: str, cursor: Any = None) -> Optional[Tuple[pd.DataFrame, Any]]:
+        """Rows appended after cursor (all rows for None) and the cursor to pass next time.
+        None when the file was rewritten since (compaction, new columns, an edit
+        outside the app): read again from None.
+        """
+        try:
+            f = open(self.data_dir / table, "rb")
+        except FileNotFoundError:
+            return (pd.DataFrame(), None) if cursor is None else None
+        with f:
+            st = os.fstat(f.fileno())
+            header = f.readline()
+            offset, crc = f.tell(), zlib.crc32(header)
+            if cursor is not None:
+                # atomic_write gives a new inode, but data/ can also be edited in
+                # place; the CRC of the bytes already read catches that
+                ino, offset, head, crc = cursor
+                if ino != st.st_ino or head != header or offset > st.st_size:
+                    return None
+                f.seek(0)
+                if _crc32_prefix(f, offset) != crc:
+                    return None
+            chunk = f.read()
+        if not header.strip():
+            return pd.DataFrame(), None
+        # a line without its newline is not complete yet; it is read next time
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+        return pd.read_csv(io.BytesIO(header + chunk)), (st.st_ino, offset + len(chunk), header, zlib.crc32(chunk, crc))
+
+    def has_key(self, table: str, key: str, value: str) -> bool:
+        return csv_has_key(self.data_dir / table, key, value)
+
+    def upsert(self, table: str, key: str, rows: List[Dict[str, Any]]):
+        self.upsert_many({table: rows}, key)
+
+    def upsert_many(self, staged: Dict[str, List[Dict[str, Any]]], key: str):
+        with data_lock():
+            for table in _commit_order(staged):
+                upsert_csv_rows(self.data_dir / table, key, staged[table])
+            self.bump([t for t in staged if staged[t]])
+
+    def append(self, table: str, row: Dict[str, Any]):
+        import csv
+        ensure_dir(self.data_dir)
+        path = self.data_dir / table
+        with data_lock():
+            header = list(row.keys())
+            write_header = not path.exists() or path.stat().st_size == 0
+            if not write_header:
+                with open(path, encoding="utf-8", newline="") as f:
+                    existing = next(csv.reader(f), [])
+                added = [c for c in header if c not in existing]
+                if added:
+                    # new columns: rewrite once with the widened header (existing rows get blanks)
+                    with open(path, encoding="utf-8", newline="") as f:
+                        rows = list(csv.reader(f))[1:]
+
+                    def write(f):
+                        w = csv.writer(f)
+                        w.writerow(existing + added)
+                        w.writerows(r + [""] * len(added) for r in rows)
+                    atomic_write(path, write)
+                header = existing + added
+            with open(path, mode="a", encoding="utf-8", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=header)
+                if write_header:
+                    w.writeheader()
+                w.writerow(row)
+            self.bump([table])
+        invalidate_fleet_cache(table)
+
+class SqliteStorage:
+    """One SQLite database, one table per CSV. Tables holding a train_id get an
+    index on (train_id, timestamp) (or train_id alone without timestamps), so
+    the latest row per train is an index seek per train instead of a scan/sort.
+    Index order (NULL timestamps first, then timestamp, then rowid) matches the
+    precedence latest_by_train applies to CSV files.
+    """
+
+    kind = "sqlite"
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.lock_path = db_path.with_name(db_path.name + ".lock")
+        self._local = threading.local()
+        ensure_dir(db_path.parent)
+        with self._conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS _table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            # bumped when rows are deleted or replaced, unlike a plain append (see read_since)
+            conn.execute("CREATE TABLE IF NOT EXISTS _table_rewrites (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _name(table: str) -> str:
+        return table[:-4] if table.endswith(".csv") else table
+
+    @staticmethod
+    def _q(ident: str) -> str:
+        return '"' + str(ident).replace('"', '""') + '"'
+
+    def _columns(self, conn, name: str) -> List[str]:
+        return [r[1] for r in conn.execute(f"PRAGMA table_info({self._q(name)})")]
+
+    def _ensure_columns(self, conn, name: str, columns: List[str]) -> List[str]:
+        existing = self._columns(conn, name)
+        if not existing:
+            conn.execute(f"CREATE TABLE {self._q(name)} ({', '.join(self._q(c) for c in columns)})")
+            existing = list(columns)
+        else:
+            for c in columns:
+                if c not in existing:
+                    conn.execute(f"ALTER TABLE {self._q(name)} ADD COLUMN {self._q(c)}")
+                    existing.append(c)
+        if "train_id" in existing:
+            cols = ["train_id", "timestamp"] if "timestamp" in existing else ["train_id"]
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self._q('ix_' + name + '_' + '_'.join(cols))} "
+                f"ON {self._q(name)} ({', '.join(self._q(c) for c in cols)})"
+            )
+        return existing
+
+    def _bump(self, conn, name: str, rewrite: bool = False):
+        conn.execute(
+            "INSERT INTO _table_versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+            (name,),
+        )
+        if rewrite:
+            conn.execute(
+                "INSERT INTO _table_rewrites (name, generation) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET generation = generation + 1",
+                (name,),
+            )
+
+    def tables(self) -> List[str]:
+        rows = self._conn().execute("SELECT name FROM _table_versions ORDER BY name").fetchall()
+        return [f"{r[0]}.csv" for r in rows]
+
+    def signature(self, table: str):
+        row = self._conn().execute("SELECT version FROM _table_versions WHERE name = ?", (self._name(table),)).fetchone()
+        return row[0] if row else None
+
+    def data_version(self) -> int:
+        # every write bumps one table's version, so the sum only grows
+        return self._conn().execute("SELECT COALESCE(SUM(version), 0) FROM _table_versions").fetchone()[0]
+
+    def read(self, table: str) -> pd.DataFrame:
+        name = self._name(table)
+        return pd.read_sql_query(f"SELECT * FROM {self._q(name)} ORDER BY rowid", self._conn())
+
+    def iter_chunks(self, table: str, start: int = 0, chunksize: int = 5000) -> Iterator[Tuple[int, pd.DataFrame]]:
+        # own connection: a streaming response may resume the generator on another thread
+        name = self._name(table)
+        conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        try:
+            sql = f"SELECT * FROM {self._q(name)} ORDER BY rowid LIMIT -1 OFFSET ?"
+            first = start
+            for chunk in pd.read_sql_query(sql, conn, params=(start,), chunksize=chunksize):
+                yield first, chunk
+                first += len(chunk)
+        finally:
+            conn.close()
+
+    def latest_by_train(self, table: str) -> Dict[str, Dict[str, Any]]:
+        name = self._name(table)
+        conn = self._conn()
+        cols = self._columns(conn, name)
+        if "train_id" not in cols:
+            raise KeyError(f"{table} has no train_id column")
+        order = "t.timestamp DESC, t.rowid DESC" if "timestamp" in cols else "t.rowid DESC"
+        sql = (
+            f"SELECT t.* FROM {self._q(name)} t WHERE t.rowid IN ("
+            f"SELECT (SELECT t.rowid FROM {self._q(name)} t WHERE t.train_id = k.train_id ORDER BY {order} LIMIT 1) "
+            f"FROM (SELECT DISTINCT train_id FROM {self._q(name)}) k"
+            f") ORDER BY t.rowid"
+        )
+        return _latest_by_train_df(pd.read_sql_query(sql, conn))
+
+    def read_since(self, table: str, cursor: Any = None) -> Optional[Tuple[pd.DataFrame, Any]]:
+        """Rows inserted after cursor (all rows for None) and the next cursor; None once
+        an upsert or import has replaced rows since (read again from None)."""
+        name = self._name(table)
+        conn = self._conn()
+        row = conn.execute("SELECT generation FROM _table_rewrites WHERE name = ?", (name,)).fetchone()
+        generation, last = (row[0] if row else 0), 0
+        if cursor is not None:
+            if cursor[0] != generation:
+                return None
+            last = cursor[1]
+        if not self._columns(conn, name):
+            return pd.DataFrame(), (generation, last)
+        df = pd.read_sql_query(f"SELECT rowid AS _rowid, * FROM {self._q(name)} WHERE rowid > ? ORDER BY rowid", conn, params=(last,))
+        if len(df):
+            last = int(df["_rowid"].iloc[-1])
+        return df.drop(columns="_rowid"), (generation, last)
+
+    def has_key(self, table: str, key: str, value: str) -> bool:
+        name = self._name(table)
+        conn = self._conn()
+        if key not in self._columns(conn, name):
+            return False
+        row = conn.execute(f"SELECT 1 FROM {self._q(name)} WHERE CAST({self._q(key)} AS TEXT) = ? LIMIT 1", (str(value),)).fetchone()
+        return row is not None
+
+    def _upsert(self, conn, table: str, key: str, rows: List[Dict[str, Any]]):
+        name = self._name(table)
+        staged: Dict[str, Dict[str, Any]] = {}
+        for row in rows:
+            row = {**row}
+            if "timestamp" not in row:
+                row["timestamp"] = now_iso()
+            merged = staged.setdefault(str(row.get(key)), {})
+            for c, v in row.items():
+                if (v is not None and v != "") or c not in merged:
+                    merged[c] = v
+        columns = list(dict.fromkeys(c for r in staged.values() for c in r))
+        existing = self._ensure_columns(conn, name, columns)
+        for k, merged in staged.items():
+            # Backfill unspecified columns from the latest stored row for this key
+            prev = conn.execute(
+                f"SELECT * FROM {self._q(name)} WHERE CAST({self._q(key)} AS TEXT) = ? ORDER BY rowid DESC LIMIT 1", (k,)
+            ).fetchone()
+            if prev is not None:
+                for c, v in zip(existing, prev):
+                    if c not in merged or merged[c] is None or merged[c] == "":
+                        merged[c] = v
+            conn.execute(f"DELETE FROM {self._q(name)} WHERE CAST({self._q(key)} AS TEXT) = ?", (k,))
+            cols = list(merged.keys())
+            conn.execute(
+                f"INSERT INTO {self._q(name)} ({', '.join(self._q(c) for c in cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                [_sql_value(merged[c]) for c in cols],
+            )
+        self._bump(conn, name, rewrite=True)
+
+    def upsert(self, table: str, key: str, rows: List[Dict[str, Any]]):
+        self.upsert_many({table: rows}, key)
+
+    def upsert_many(self, staged: Dict[str, List[Dict[str, Any]]], key: str):
+        conn = self._conn()
+        with data_lock(), conn:
+            for table in _commit_order(staged):
+                if staged[table]:
+                    self._upsert(conn, table, key, staged[table])
+        for table in staged:
+            invalidate_fleet_cache(table)
+
+    def append(self, table: str, row: Dict[str, Any]):
+        name = self._name(table)
+        conn = self._conn()
+        with data_lock(), conn:
+            self._ensure_columns(conn, name, list(row.keys()))
+            cols = list(row.keys())
+            conn.execute(
+                f"INSERT INTO {self._q(name)} ({', '.join(self._q(c) for c in cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                [_sql_value(row[c]) for c in cols],
+            )
+            self._bump(conn, name)
+        invalidate_fleet_cache(table)
+
+    def import_frame(self, table: str, df: pd.DataFrame):
+        """Replace table with the rows of df (used by migrate)."""
+        name = self._name(table)
+        conn = self._conn()
+        with data_lock(), conn:
+            conn.execute(f"DROP TABLE IF EXISTS {self._q(name)}")
+            self._ensure_columns(conn, name, [str(c) for c in df.columns])
+            if len(df.columns):
+                cols = [str(c) for c in df.columns]
+                conn.executemany(
+                    f"INSERT INTO {self._q(name)} ({', '.join(self._q(c) for c in cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                    [[_sql_value(v) for v in r] for r in df.itertuples(index=False, name=None)],
+                )
+            self._bump(conn, name, rewrite=True)
+        invalidate_fleet_cache(table)
+
+def _sql_value(v):
+    """Convert pandas/numpy scalars to values sqlite3 can bind (NaN -> NULL)."""
+    if v is None:
+        return None
+    if hasattr(v, "item") and not isinstance(v, (str, bytes)):
+        v = v.item()
+    if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
+        return None
+    if isinstance(v, (int, float, str, bytes)):
+        return v
+    return str(v)
+
+def _commit_order(staged: Dict[str, Any]) -> List[str]:
+    # trains.csv first so every referenced train exists before its attributes land
+    return sorted(staged, key=lambda n: n != "trains.csv")
+
+def make_storage():
+    backend = os.getenv("FLEET_STORAGE", "csv").strip().lower()
+    if backend == "sqlite":
+        return SqliteStorage(Path(os.getenv("FLEET_DB", str(DATA_DIR / "fleet.db"))))
+    if backend != "csv":
+        logging.getLogger("storage").warning(f"Unknown FLEET_STORAGE={backend!r}; using csv")
+    return CsvStorage(DATA_DIR)
+
+STORAGE = make_storage()
+
+def load_csv(name):
+    return STORAGE.read(name)
+
+def commit_staged_rows(staged: Dict[str, List[Dict[str, Any]]], key: str = "train_id"):
+    """Write rows staged per table name, one upsert per table, atomically w.r.t. readers."""
+    STORAGE.upsert_many(staged, key)
+    SCHEDULE_FEED.notify()
+
+def migrate_csv_to_sqlite(data_dir: Path = DATA_DIR, db_path: Optional[Path] = None) -> Dict[str, int]:
+    """Import every data_dir/*.csv into a SQLite database; returns rows per table."""
+    target = SqliteStorage(db_path or data_dir / "fleet.db")
+    counts = {}
+    for f in sorted(os.listdir(data_dir)):
+        if not f.endswith(".csv"):
+            continue
+        df = pd.read_csv(data_dir / f)
+        if "timestamp" in df.columns:
+            # Normalize to one ISO format so text order in the index is time order
+            ts = pd.to_datetime(df["timestamp"], format="mixed", errors="coerce", utc=True)
+            df["timestamp"] = ts.dt.strftime("%Y-%m-%dT%H:%M:%SZ").where(ts.notna(), df["timestamp"])
+        target.import_frame(f, df)
+        counts[f] = len(df)
+    return counts
+
+def export_sqlite_to_csv(db_path: Path, out_dir: Path) -> Dict[str, int]:
+    """Write every table of a SQLite database back out as out_dir/<table>.csv."""
+    source = SqliteStorage(db_path)
+    ensure_dir(out_dir)
+    counts = {}
+    for table in source.tables():
+        df = source.read(table)
+        df.to_csv(out_dir / table, index=False)
+        counts[table] = len(df)
+    return counts
+
+def append_ingestion_audit(filename: str, size_bytes: int, model: str, entries: Any, updates: Any, raw_text: str,
+                           cache_hit: bool = False, content_sha256: Optional[str] = None):
+    """Append a single audit row to the ingestion_log table with a safe excerpt of raw text.
+    cache_hit marks uploads answered from the vision cache (no API call made).
+    """
     row = {
         "timestamp": now_iso(),
         "filename": filename or "(upload)",
@@ -121,68 +1037,361 @@ def append_ingestion_audit(filename: str, size_bytes: int, model: str, entries:
         "model": model,
         "entries_json": json.dumps(entries or [], ensure_ascii=False),
         "updates_json": json.dumps(updates or [], ensure_ascii=False),
-        "raw_excerpt": (raw_text or "")[:800]
+        "raw_excerpt": (raw_text or "")[:800],
+        "cache_hit": int(bool(cache_hit)),
+        "content_sha256": content_sha256 or "",
     }
-    header = list(row.keys())
-    write_header = not path.exists() or path.stat().st_size == 0
-    with open(path, mode="a", encoding="utf-8", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=header)
-        if write_header:
-            w.writeheader()
-        w.writerow(row)
+    STORAGE.append("ingestion_log.csv", row)
 
 def ensure_train_exists(train_id: str):
-    trains_csv = DATA_DIR / "trains.csv"
-    df = None
-    if trains_csv.exists():
-        try:
-            df = pd.read_csv(trains_csv)
-        except Exception:
-            df = pd.DataFrame()
-    else:
-        df = pd.DataFrame()
-    if df.empty or "train_id" not in df.columns or train_id not in set(df.get("train_id", []).astype(str)):
+    if not STORAGE.has_key("trains.csv", "train_id", train_id):
         # Append minimal train row
         row = {"train_id": train_id, "model": "Unknown", "capacity": None, "timestamp": now_iso()}
-        append_or_update_csv(trains_csv, "train_id", row)
+        STORAGE.upsert("trains.csv", "train_id", [row])
+
+GROQ_VISION_PROMPT = (
+    "Extract a clean JSON with an array named 'entries'. Each entry must have: "
+    "train_id (string), status (one of run, standby, maintenance, cleaning), "
+    "slot (string or number, optional), and notes (string, optional). "
+    "Only output JSON with no extra commentary."
+)
+
+# ---------------------------------------------------------------------------
+# Vision response cache: one JSON file per (image SHA-256, model, prompt) under
+# LLM_CACHE_DIR, so re-uploads of the same photo (forwards, retries) skip the
+# API call. Bounded by total size; least recently used files go first.
+# ---------------------------------------------------------------------------
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", str(DATA_DIR / "llm_cache")))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+_LLM_CACHE_LOCK = threading.Lock()
+
+def vision_cache_key(image_sha256: str) -> str:
+    model = os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+    # preprocessing settings change what the model sees, so they are part of the key
+    return hashlib.sha256(f"{model}\0{GROQ_VISION_PROMPT}\0{preprocess_signature()}\0{image_sha256}".encode("utf-8")).hexdigest()
+
+def vision_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    if not LLM_CACHE_ENABLED:
+        return None
+    path = LLM_CACHE_DIR / f"{key}.json"
+    try:
+        hit = json.loads(path.read_text(encoding="utf-8"))
+        os.utime(path)  # mtime doubles as last-used time for eviction
+    except (OSError, ValueError):
+        return None
+    return hit
+
+def vision_cache_put(key: str, raw: Optional[str], entries: List[Dict[str, Any]]):
+    if not LLM_CACHE_ENABLED:
+        return
+    ensure_dir(LLM_CACHE_DIR)
+    path = LLM_CACHE_DIR / f"{key}.json"
+    body = {"model": os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct"),
+            "created": now_iso(), "raw": raw, "entries": entries}
+    atomic_write(path, lambda f: json.dump(body, f, ensure_ascii=False))
+    with _LLM_CACHE_LOCK:
+        files = []
+        for p in LLM_CACHE_DIR.glob("*.json"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime_ns, st.st_size, p))
+        total = sum(size for _, size, _ in files)
+        for _, size, p in sorted(files):
+            if total <= LLM_CACHE_MAX_BYTES:
+                break
+            try:
+                p.unlink()
+            except OSError:
+                pass
+            total -= size
+
+# ---------------------------------------------------------------------------
+# Upload preprocessing (needs Pillow; uploads pass through unchanged without it):
+# auto-orient, grayscale, trim uniform margins, downscale to IMAGE_MAX_EDGE and
+# re-encode as JPEG, lowering quality until IMAGE_TARGET_BYTES is met.
+# ---------------------------------------------------------------------------
+
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") != "0"
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "1") != "0"
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MIN_JPEG_QUALITY = int(os.getenv("IMAGE_MIN_JPEG_QUALITY", "55"))
+IMAGE_TARGET_BYTES = int(os.getenv("IMAGE_TARGET_BYTES", str(300 * 1024)))
+
+def preprocess_signature() -> str:
+    if not IMAGE_PREPROCESS or Image is None:
+        return "raw"
+    return f"v1:{IMAGE_MAX_EDGE}:{int(IMAGE_GRAYSCALE)}:{IMAGE_JPEG_QUALITY}:{IMAGE_MIN_JPEG_QUALITY}:{IMAGE_TARGET_BYTES}"
+
+def _trim_margins(img, tolerance: int = 24):
+    """Crop borders that match the corner colour (table/background around the sheet)."""
+    gray = img.convert("L")
+    corner = gray.getpixel((0, 0))
+    diff = ImageChops.difference(gray, Image.new("L", gray.size, corner)).point(lambda v: 255 if v > tolerance else 0)
+    box = diff.getbbox()
+    if not box:
+        return img
+    # keep a small margin and skip crops that would remove almost nothing
+    pad = max(4, min(img.size) // 100)
+    box = (max(0, box[0] - pad), max(0, box[1] - pad), min(img.width, box[2] + pad), min(img.height, box[3] + pad))
+    if (box[2] - box[0]) * (box[3] - box[1]) > 0.95 * img.width * img.height:
+        return img
+    return img.crop(box)
+
+def preprocess_image(image_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    """Shrink an upload for the vision call; returns (bytes to send, stats).
+    The original is kept when it cannot be decoded or is already a smaller JPEG.
+    """
+    info: Dict[str, Any] = {"bytes_in": len(image_bytes), "bytes_out": len(image_bytes), "preprocessed": False}
+    if not IMAGE_PREPROCESS or Image is None:
+        return image_bytes, info
+    started = time.perf_counter()
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as src:
+            source_format = src.format
+            info["size_in"] = list(src.size)
+            img = ImageOps.exif_transpose(src)
+            img = img.convert("L") if IMAGE_GRAYSCALE else img.convert("RGB")
+            img = _trim_margins(img)
+            if max(img.size) > IMAGE_MAX_EDGE:
+                img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+            quality = IMAGE_JPEG_QUALITY
+            while True:
+                buf = io.BytesIO()
+                img.save(buf, format="JPEG", quality=quality, optimize=True)
+                if buf.tell() <= IMAGE_TARGET_BYTES or quality <= IMAGE_MIN_JPEG_QUALITY:
+                    break
+                quality = max(IMAGE_MIN_JPEG_QUALITY, quality - 10)
+    except Exception as e:
+        logging.getLogger("ingest").warning("Image preprocessing skipped", extra={"error": str(e)})
+        return image_bytes, info
+    out = buf.getvalue()
+    info.update({"size_out": list(img.size), "quality": quality, "ms": round((time.perf_counter() - started) * 1000, 1)})
+    if source_format == "JPEG" and len(out) >= len(image_bytes):
+        return image_bytes, info
+    info.update({"bytes_out": len(out), "preprocessed": True})
+    return out, info
+
+def _vision_cache_hit(image_sha256: str, hit: Dict[str, Any]) -> Dict[str, Any]:
+    logging.getLogger("ingest").info("Vision cache hit", extra={"content_sha256": image_sha256})
+    return {"raw": hit.get("raw"), "entries": hit.get("entries") or [], "attempts": 0, "cache_hit": True, "content_sha256": image_sha256}
 
-def call_groq_vision(image_bytes: bytes) -> Dict[str, Any]:
+def _groq_vision_request(image_bytes: bytes) -> Tuple[str, Dict[str, Any]]:
+    """API key and chat.completions.create kwargs for one vision extraction."""
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise HTTPException(status_code=400, detail="Missing GROQ_API_KEY environment variable")
     model = os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
     b64 = base64.b64encode(image_bytes).decode("utf-8")
-    prompt = (
-        "Extract a clean JSON with an array named 'entries'. Each entry must have: "
-        "train_id (string), status (one of run, standby, maintenance, cleaning), "
-        "slot (string or number, optional), and notes (string, optional). "
-        "Only output JSON with no extra commentary."
-    )
-    try:
-        client = Groq(api_key=api_key)
-        logging.getLogger("ingest").info("Calling Groq vision model", extra={"model": model, "image_b64_len": len(b64)})
-        chat = client.chat.completions.create(
-            model=model,
-            temperature=0.2,
-            max_tokens=800,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{b64}"},
-                        },
-                    ],
-                }
-            ],
-        )
-        content = chat.choices[0].message.content
-        logging.getLogger("ingest").info("Groq response received", extra={"chars": len(content), "excerpt": (content[:200] if content else "")})
-        return {"raw": content}
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"Groq API error: {e}")
+    prompt = GROQ_VISION_PROMPT
+    logging.getLogger("ingest").info("Calling Groq vision model", extra={"model": model, "image_b64_len": len(b64)})
+    return api_key, {
+        "model": model,
+        "temperature": 0.2,
+        "max_tokens": 800,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/jpeg;base64,{b64}"},
+                    },
+                ],
+            }
+        ],
+    }
+
+# Retry policy for rate limits (429), server errors (5xx) and connection failures;
+# the SDK's own retries are disabled so this is the only one.
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "3"))
+GROQ_RETRY_BASE_DELAY = float(os.getenv("GROQ_RETRY_BASE_DELAY", "0.5"))
+GROQ_CONCURRENCY = max(1, int(os.getenv("GROQ_CONCURRENCY", "4")))
+
+def groq_async_client_factory(api_key: str):
+    """Async Groq client used for ingestion; replace this attribute to plug in a fake (see bench/)."""
+    from groq import AsyncGroq  # the SDK takes ~0.1 s to import; only ingestion needs it
+    return AsyncGroq(api_key=api_key, max_retries=0)
+
+def groq_retry_delay(exc: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying after exc (Retry-After wins), or None if exc is not retryable."""
+    import groq
+    if isinstance(exc, groq.APIStatusError):
+        if exc.status_code != 429 and exc.status_code < 500:
+            return None
+        try:
+            return float(exc.response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    elif not isinstance(exc, groq.APIConnectionError):
+        return None
+    return GROQ_RETRY_BASE_DELAY * (2 ** attempt) * (0.5 + random.random())
+
+async def vision_events(image_bytes: bytes, client=None, get_client=None):
+    """Streamed vision extraction as an async iterator of events:
+    {"event": "entry", "entry": {...}} as soon as each element of "entries" closes,
+    {"event": "retry", "attempt": n, "delay_s": s} when a failed call is retried
+    (entries seen so far are void; the next call starts over), and finally
+    {"event": "result", "result": {...}} with what call_groq_vision_async returns.
+    Retries 429/5xx/connection errors with exponential backoff. Answers from the
+    vision cache when the same image was extracted before (attempts 0); the API
+    key and the client (get_client(api_key) when given) are only needed on a miss.
+    """
+    image_sha256 = hashlib.sha256(image_bytes).hexdigest()
+    key = vision_cache_key(image_sha256)
+    hit = await run_in_threadpool(vision_cache_get, key)
+    if hit is not None:
+        result = _vision_cache_hit(image_sha256, hit)
+        for entry in result["entries"]:
+            yield {"event": "entry", "entry": entry}
+        yield {"event": "result", "result": result}
+        return
+    # decoding/resizing is CPU work; keep it off the event loop
+    with span("preprocess"):
+        image_bytes, prep = await run_in_threadpool(preprocess_image, image_bytes)
+    logging.getLogger("ingest").info("Image preprocessed", extra=prep)
+    api_key, request = _groq_vision_request(image_bytes)
+    client = client or (get_client or groq_async_client_factory)(api_key)
+    attempt = 0
+    parse_s = 0.0
+    while True:
+        parser = EntryStreamParser()
+        try:
+            stream = await client.chat.completions.create(**request, stream=True)
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                started = time.perf_counter()
+                found = parser.feed(delta or "")
+                parse_s += time.perf_counter() - started
+                for entry in found:
+                    yield {"event": "entry", "entry": entry}
+            break
+        except Exception as e:
+            delay = groq_retry_delay(e, attempt)
+            if delay is None or attempt >= GROQ_MAX_RETRIES:
+                raise HTTPException(status_code=502, detail=f"Groq API error: {e}")
+            logging.getLogger("ingest").warning("Groq call failed, retrying", extra={"attempt": attempt + 1, "delay_s": round(delay, 2), "error": str(e)})
+            yield {"event": "retry", "attempt": attempt + 1, "delay_s": round(delay, 2)}
+            await asyncio.sleep(delay)
+            attempt += 1
+    started = time.perf_counter()
+    rest = parser.finish()
+    record_stage("parse", parse_s + time.perf_counter() - started)
+    for entry in rest:
+        yield {"event": "entry", "entry": entry}
+    raw = parser.text
+    logging.getLogger("ingest").info("Groq response received", extra={"chars": len(raw), "excerpt": raw[:200], "truncated": parser.truncated})
+    result = {"raw": raw, "entries": parser.entries, "attempts": attempt + 1, "cache_hit": False, "content_sha256": image_sha256}
+    await run_in_threadpool(vision_cache_put, key, raw, parser.entries)
+    yield {"event": "result", "result": result}
+
+async def call_groq_vision_async(image_bytes: bytes, client=None, get_client=None) -> Dict[str, Any]:
+    """Vision extraction of one image: the result event of vision_events, i.e.
+    {"raw", "entries", "attempts" (calls made), "cache_hit", "content_sha256"}.
+    """
+    async for event in vision_events(image_bytes, client, get_client):
+        if event["event"] == "result":
+            return event["result"]
+
+class EntryStreamParser:
+    """Incremental parser for the model's answer ({"entries": [...]} or a bare array).
+    feed() takes text as it arrives and returns the entry objects that closed in it,
+    so they can be staged before generation ends. Braces inside strings are handled;
+    prose or code fences around the JSON are skipped. If the output is cut off
+    (max_tokens), the complete entries are kept and the unfinished one is dropped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.entries: List[Dict[str, Any]] = []
+        self.truncated = False
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._key = None
+        self._array_depth = None  # stack depth inside the entries array
+        self._entry_start = None
+        self._done = False
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        found = []
+        text, stack = self.text, self._stack
+        for i in range(self._pos, len(text)):
+            if self._done:
+                break
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start:i]
+            elif ch == '"':
+                if stack:  # quotes in prose before the JSON are not strings
+                    self._in_string = True
+                    self._string_start = i + 1
+            elif ch == ":":
+                if len(stack) == 1 and stack[0] == "{":
+                    self._key = self._last_string
+            elif ch == "," and len(stack) == 1:
+                self._key = None
+            elif ch in "{[":
+                if self._array_depth is None and ch == "[":
+                    if stack == ["{"] and self._key == "entries":
+                        self._array_depth = 2
+                    elif not stack:
+                        # a bare array must hold objects; "[2 trains]" in prose is not one
+                        nxt = text[i + 1:].lstrip()[:1]
+                        if not nxt:
+                            self._pos = i  # decide when the next character arrives
+                            return self._found(found)
+                        if nxt != "{":
+                            continue
+                        self._array_depth = 1
+                elif self._array_depth is not None and ch == "{" and len(stack) == self._array_depth:
+                    self._entry_start = i
+                stack.append(ch)
+            elif ch in "}]" and stack:
+                stack.pop()
+                if self._array_depth is None:
+                    continue
+                if ch == "}" and len(stack) == self._array_depth and self._entry_start is not None:
+                    try:
+                        entry = json.loads(text[self._entry_start:i + 1])
+                    except ValueError:
+                        entry = None
+                    if isinstance(entry, dict):
+                        found.append(entry)
+                    self._entry_start = None
+                elif ch == "]" and len(stack) == self._array_depth - 1:
+                    self._done = True
+        self._pos = len(text)
+        return self._found(found)
+
+    def _found(self, found: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        self.entries.extend(found)
+        return found
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """Entries not yet returned by feed(): when no entries were found, the
+        whole-text fallback of parsed_entries (e.g. an object without "entries")."""
+        self.truncated = bool(self._stack) and not self._done
+        if self._array_depth is not None and self.entries:
+            return []
+        rest = [e for e in parsed_entries(self.text) if isinstance(e, dict)]
+        self.entries.extend(rest)
+        return rest
 
 def extract_json_block(text: str) -> Dict[str, Any]:
     """Try to parse a JSON object from text; fallback to substring between first { and last }."""
@@ -203,172 +1412,153 @@ def extract_json_block(text: str) -> Dict[str, Any]:
             return {}
     return {}
 
-def apply_entries(entries: Any) -> Dict[str, Any]:
-    updates = []
-    for item in entries or []:
-        t = str(item.get("train_id", "")).strip()
-        if not t:
-            continue
-        t = t.upper()
-        status = str(item.get("status", "")).strip().lower()
-        slot = item.get("slot", None)
-        notes = item.get("notes", None)
-        logging.getLogger("ingest").info("Applying entry", extra={"train_id": t, "status": status, "slot": slot, "has_notes": bool(notes)})
-        ensure_train_exists(t)
-
-        # Map status to CSV updates used by the optimizer
-        if status == "maintenance":
-            append_or_update_csv(DATA_DIR / "jobcard.csv", "train_id", {"train_id": t, "open": 1})
-            updates.append({"train_id": t, "action": "jobcard_open=1"})
-        elif status == "cleaning":
-            # Mark as due: very large last_cleaned_days
-            append_or_update_csv(DATA_DIR / "cleaning.csv", "train_id", {"train_id": t, "last_cleaned_days": 999})
+def stage_entry(item: Dict[str, Any], staged: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Stage the table rows for one parsed entry; returns the updates it implies."""
+    updates: List[Dict[str, Any]] = []
+
+    def stage(name: str, row: Dict[str, Any]):
+        staged.setdefault(name, []).append(row)
+
+    t = str(item.get("train_id", "")).strip()
+    if not t:
+        return updates
+    t = t.upper()
+    status = str(item.get("status", "")).strip().lower()
+    slot = item.get("slot", None)
+    notes = item.get("notes", None)
+    logging.getLogger("ingest").info("Applying entry", extra={"train_id": t, "status": status, "slot": slot, "has_notes": bool(notes)})
+    if not STORAGE.has_key("trains.csv", "train_id", t) and not any(r["train_id"] == t for r in staged.get("trains.csv", [])):
+        # Append minimal train row
+        stage("trains.csv", {"train_id": t, "model": "Unknown", "capacity": None, "timestamp": now_iso()})
+
+    # Map status to CSV updates used by the optimizer
+    if status == "maintenance":
+        stage("jobcard.csv", {"train_id": t, "open": 1})
+        updates.append({"train_id": t, "action": "jobcard_open=1"})
+    elif status == "cleaning":
+        # Mark as due: very large last_cleaned_days
+        stage("cleaning.csv", {"train_id": t, "last_cleaned_days": 999})
+        updates.append({"train_id": t, "action": "cleaning_due"})
+    elif status == "run":
+        # Encourage run by marking fitness valid/high
+        stage("fitness.csv", {"train_id": t, "valid": 1, "score": 1.0})
+        updates.append({"train_id": t, "action": "fitness_valid=1,score=1.0"})
+    elif status == "standby":
+        # Ensure fitness valid, neutral score
+        stage("fitness.csv", {"train_id": t, "valid": 1, "score": 0.8})
+        updates.append({"train_id": t, "action": "fitness_valid=1,score=0.8"})
+
+    # Slot maps to stabling bay when provided
+    if slot is not None and slot != "":
+        stage("stabling.csv", {"train_id": t, "bay": slot})
+        updates.append({"train_id": t, "action": f"stabling.bay={slot}"})
+
+    # Derive and apply branding priority and other hints from structured fields or notes
+    branding_priority_value = None
+    # Explicit fields override inference
+    for k in ("priority", "branding_priority", "branding"):
+        if k in item and item.get(k) not in (None, ""):
+            try:
+                v = int(float(item.get(k)))
+                branding_priority_value = 1 if v > 0 else 0
+            except Exception:
+                pass
+    text = str(notes).lower() if notes else ""
+    if branding_priority_value is None and ("brand" in text or "branding priority" in text):
+        branding_priority_value = 1
+    # Apply branding update if we have either notes or a priority value
+    if notes is not None or branding_priority_value is not None:
+        row = {"train_id": t}
+        if branding_priority_value is not None:
+            row["priority"] = branding_priority_value
+            updates.append({"train_id": t, "action": f"branding.priority={branding_priority_value}"})
+        if notes is not None:
+            row["notes"] = str(notes)[:200]
+        stage("branding.csv", row)
+
+    # Heuristic mapping from notes
+    if text:
+        if ("cleaning due" in text) or ("due for cleaning" in text) or ("cleaning overdue" in text):
+            stage("cleaning.csv", {"train_id": t, "last_cleaned_days": 999})
             updates.append({"train_id": t, "action": "cleaning_due"})
-        elif status == "run":
-            # Encourage run by marking fitness valid/high
-            append_or_update_csv(DATA_DIR / "fitness.csv", "train_id", {"train_id": t, "valid": 1, "score": 1.0})
-            updates.append({"train_id": t, "action": "fitness_valid=1,score=1.0"})
-        elif status == "standby":
-            # Ensure fitness valid, neutral score
-            append_or_update_csv(DATA_DIR / "fitness.csv", "train_id", {"train_id": t, "valid": 1, "score": 0.8})
-            updates.append({"train_id": t, "action": "fitness_valid=1,score=0.8"})
-
-        # Slot maps to stabling bay when provided
-        if slot is not None and slot != "":
-            append_or_update_csv(DATA_DIR / "stabling.csv", "train_id", {"train_id": t, "bay": slot})
-            updates.append({"train_id": t, "action": f"stabling.bay={slot}"})
-
-        # Derive and apply branding priority and other hints from structured fields or notes
-        branding_priority_value = None
-        # Explicit fields override inference
-        for k in ("priority", "branding_priority", "branding"):
-            if k in item and item.get(k) not in (None, ""):
-                try:
-                    v = int(float(item.get(k)))
-                    branding_priority_value = 1 if v > 0 else 0
-                except Exception:
-                    pass
-        text = str(notes).lower() if notes else ""
-        if branding_priority_value is None and ("brand" in text or "branding priority" in text):
-            branding_priority_value = 1
-        # Apply branding update if we have either notes or a priority value
-        if notes is not None or branding_priority_value is not None:
-            row = {"train_id": t}
-            if branding_priority_value is not None:
-                row["priority"] = branding_priority_value
-                updates.append({"train_id": t, "action": f"branding.priority={branding_priority_value}"})
-            if notes is not None:
-                row["notes"] = str(notes)[:200]
-            append_or_update_csv(DATA_DIR / "branding.csv", "train_id", row)
-
-        # Heuristic mapping from notes
-        if text:
-            if ("cleaning due" in text) or ("due for cleaning" in text) or ("cleaning overdue" in text):
-                append_or_update_csv(DATA_DIR / "cleaning.csv", "train_id", {"train_id": t, "last_cleaned_days": 999})
-                updates.append({"train_id": t, "action": "cleaning_due"})
-            if ("fitness expired" in text) or ("fitness invalid" in text) or ("fitness not valid" in text):
-                append_or_update_csv(DATA_DIR / "fitness.csv", "train_id", {"train_id": t, "valid": 0, "score": 0.0})
-                updates.append({"train_id": t, "action": "fitness_valid=0,score=0.0"})
-            elif "fitness low" in text:
-                append_or_update_csv(DATA_DIR / "fitness.csv", "train_id", {"train_id": t, "valid": 1, "score": 0.3})
-                updates.append({"train_id": t, "action": "fitness_valid=1,score=0.3"})
-
-    return {"updates": updates}
+        if ("fitness expired" in text) or ("fitness invalid" in text) or ("fitness not valid" in text):
+            stage("fitness.csv", {"train_id": t, "valid": 0, "score": 0.0})
+            updates.append({"train_id": t, "action": "fitness_valid=0,score=0.0"})
+        elif "fitness low" in text:
+            stage("fitness.csv", {"train_id": t, "valid": 1, "score": 0.3})
+            updates.append({"train_id": t, "action": "fitness_valid=1,score=0.3"})
 
-@app.post("/api/ingest-image")
-async def ingest_image(file: UploadFile = File(...)):
-    try:
-        content = await file.read()
-    except Exception:
-        raise HTTPException(status_code=400, detail="Unable to read uploaded file")
-    logger = logging.getLogger("ingest")
-    if not logging.getLogger().handlers:
-        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
-    logger.info(
-        "Received upload",
-        extra={
-            "upload_filename": getattr(file, "filename", None),
-            "upload_bytes": len(content),
-            "upload_content_type": getattr(file, "content_type", None),
-        },
-    )
-    result = call_groq_vision(content)
-    parsed = extract_json_block(result.get("raw", ""))
+    return updates
+
+def apply_entry_groups(groups: List[Any]) -> List[List[Dict[str, Any]]]:
+    """Stage several entry lists (e.g. one per uploaded sheet) in order and commit
+    them as one batch; returns the updates of each group."""
+    staged: Dict[str, List[Dict[str, Any]]] = {}
+    results = []
+    for entries in groups:
+        updates = []
+        for item in entries or []:
+            updates.extend(stage_entry(item, staged))
+        results.append(updates)
+    commit_staged_rows(staged)
+    return results
+
+def parsed_entries(raw: Optional[str]) -> List[Dict[str, Any]]:
+    """The entries list of a model response ({"entries": [...]} or a bare array)."""
+    parsed = extract_json_block(raw or "")
     entries = parsed.get("entries") if isinstance(parsed, dict) else None
     if entries is None:
         # fallback: maybe raw is already an array
         if isinstance(parsed, list):
             entries = parsed
+        elif raw and not parsed:
+            # truncated output: keep the entries that did close
+            parser = EntryStreamParser()
+            parser.feed(raw)
+            entries = parser.entries
         else:
             entries = []
-    logger.info("Parsed entries", extra={"count": len(entries)})
-    applied = apply_entries(entries)
-    logger.info("Applied updates", extra={"count": len(applied.get("updates", []))})
-    try:
-        append_ingestion_audit(
-            filename=getattr(file, "filename", None) or "(upload)",
-            size_bytes=len(content),
-            model=os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct"),
-            entries=entries,
-            updates=applied.get("updates", []),
-            raw_text=result.get("raw") or "",
-        )
-        logger.info("Audit row appended", extra={"audit_file": str(DATA_DIR / "ingestion_log.csv")})
-    except Exception as e:
-        logger.warning(f"Failed to write ingestion audit: {e}")
-    # return what we got
-    return JSONResponse({
-        "parsed": entries,
-        "updates": applied.get("updates", []),
-        "raw": result.get("raw")
-    })
-
-@app.get("/", response_class=HTMLResponse)
-def root():
-    return FileResponse(str(BASE_DIR / "static" / "index.html"))
-
-@app.get("/api/data")
-def api_data():
-    # return all CSVs for frontend display
-    files = {}
-    for f in os.listdir(DATA_DIR):
-        if f.endswith(".csv"):
-            df = pd.read_csv(DATA_DIR / f)
-            files[f] = df_records_safe(df)
-    return JSONResponse(files)
+    return entries
 
-@app.post("/api/schedule")
-def api_schedule(params: Dict[Any, Any] = None):
-    """
-    Build and solve a PuLP scheduler using synthetic CSV data.
-    Accepts optional JSON params to modify capacities or simulate a train failure.
+def apply_entries(entries: Any) -> Dict[str, Any]:
+    """Map parsed entries to CSV updates and commit them as one batch.
+    Rows are staged per table in entry order and written with a single
+    upsert_csv_rows call per table, all under the upsert lock, so readers
+    never observe a partially applied sheet.
     """
-    # load data
-    def latest_by_train(path: Path):
-        df = pd.read_csv(path)
-        # Normalize train_id early and drop empty ids
-        if "train_id" in df.columns:
-            df["train_id"] = df["train_id"].astype(str).str.strip()
-            df = df[df["train_id"].notna() & (df["train_id"] != "")]
+    return {"updates": apply_entry_groups([entries])[0]}
 
-        if "timestamp" in df.columns:
-            # Parse mixed formats safely; invalids -> NaT, place NaT last in sort
-            df["timestamp"] = pd.to_datetime(df["timestamp"], format="mixed", errors="coerce")
-            df = df.sort_values(["train_id", "timestamp"], na_position="last").groupby("train_id", as_index=False).tail(1)
-        else:
-            # No timestamp column: keep the last occurrence per train_id
-            if "train_id" in df.columns:
-                df = df.drop_duplicates(subset=["train_id"], keep="last")
+def _latest_by_train_df(df: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
+    # Normalize train_id early and drop empty ids
+    if "train_id" in df.columns:
+        df["train_id"] = df["train_id"].astype(str).str.strip()
+        df = df[df["train_id"].notna() & (df["train_id"] != "")]
 
-        # Final safeguard: ensure uniqueness of index
+    if "timestamp" in df.columns:
+        # Parse mixed formats safely; invalids -> NaT. Untimestamped (seed) rows sort
+        # first so appended upserts win; ties keep file order (later rows win).
+        df["timestamp"] = pd.to_datetime(df["timestamp"], format="mixed", errors="coerce")
+        df = df.sort_values(["train_id", "timestamp"], na_position="first", kind="stable").groupby("train_id", as_index=False).tail(1)
+    else:
+        # No timestamp column: keep the last occurrence per train_id
         if "train_id" in df.columns:
             df = df.drop_duplicates(subset=["train_id"], keep="last")
-        return df.set_index("train_id").to_dict(orient="index")
 
-    trains_df = pd.read_csv(DATA_DIR / "trains.csv")
+    # Final safeguard: ensure uniqueness of index
+    if "train_id" in df.columns:
+        df = df.drop_duplicates(subset=["train_id"], keep="last")
+    return df.set_index("train_id").to_dict(orient="index")
+
+def latest_by_train(table: str) -> Dict[str, Dict[str, Any]]:
+    """Latest record per train_id of a table (e.g. "fitness.csv") as {train_id: row}, served from the fleet cache."""
+    return cached_table(table, "latest", STORAGE.latest_by_train)
+
+def _load_trains(table: str) -> Dict[str, Any]:
+    trains_df = STORAGE.read(table)
     if "train_id" in trains_df.columns:
         trains_df["train_id"] = trains_df["train_id"].astype(str).str.strip()
     trains_info = {}
+    train_ids = None
     if "train_id" in trains_df.columns:
         try:
             trains_info = trains_df.set_index("train_id").to_dict(orient="index")
@@ -376,168 +1566,1120 @@ def api_schedule(params: Dict[Any, Any] = None):
             # fallback if duplicate ids exist
             trains_df = trains_df.drop_duplicates(subset=["train_id"], keep="last")
             trains_info = trains_df.set_index("train_id").to_dict(orient="index")
-    fitness = latest_by_train(DATA_DIR / "fitness.csv")
-    jobcard = latest_by_train(DATA_DIR / "jobcard.csv")
-    branding = latest_by_train(DATA_DIR / "branding.csv")
-    mileage = latest_by_train(DATA_DIR / "mileage.csv")
-    cleaning = latest_by_train(DATA_DIR / "cleaning.csv")
-    stabling = latest_by_train(DATA_DIR / "stabling.csv")
-
-    # optionally accept overrides via params
-    overrides = params or {}
-    cleaning_capacity = int(overrides.get("cleaning_capacity", 3))
-    fail_train = overrides.get("fail_train", None)  # simulate sudden failure
-    # Advanced tuning parameters with safe defaults (non-binding unless specified)
-    fleet_n = max(1, len(trains_df))
-    default_min_run = int(overrides.get("min_run", math.ceil(0.4 * fleet_n)))
-    min_run = max(1, default_min_run)
-    max_run = int(overrides.get("max_run", len(trains_df)))
-    maintenance_capacity = int(overrides.get("maintenance_capacity", len(trains_df)))
-    min_standby = int(overrides.get("min_standby", 0))
-    default_max_standby = int(overrides.get("max_standby", math.ceil(0.6 * fleet_n)))
-    max_standby = max(0, min(default_max_standby, fleet_n))
-    min_branded_run = int(overrides.get("min_branded_run", 0))
-    run_min_fitness_score = float(overrides.get("run_min_fitness_score", 0.0))
-    min_clean_due = int(overrides.get("min_clean_due", 0))
-    cleaning_due_threshold = int(overrides.get("cleaning_due_threshold", 7))
-    # objective weights (configurable)
-    risk_w = float(overrides.get("risk_w", 50.0))
-    mileage_w = float(overrides.get("mileage_w", 1.0))
-    branding_w = float(overrides.get("branding_w", 20.0))
-    # discourage non-run states to avoid excessive standby
-    standby_w = float(overrides.get("standby_w", 6.0))
-    maintenance_w = float(overrides.get("maintenance_w", 2.0))
-    cleaning_w = float(overrides.get("cleaning_w", 0.5))
-
-    # Prefer train IDs from trains.csv if available; otherwise from fitness keys
-    if "train_id" in trains_df.columns:
         train_ids = list(trains_df["train_id"].astype(str).unique())
-    else:
-        train_ids = list(fitness.keys())
-    states = ["run", "standby", "maintenance", "cleaning"]
+    return {"rows": len(trains_df), "train_ids": train_ids, "info": trains_info}
 
-    def safe_float(v, default: float = 0.0) -> float:
-        try:
-            f = float(v)
-            if math.isnan(f) or math.isinf(f):
-                return default
-            return f
-        except Exception:
-            return default
+def load_trains() -> Dict[str, Any]:
+    """trains.csv summary: row count, unique train_ids (None without that column) and per-train info."""
+    return cached_table("trains.csv", "trains", _load_trains)
 
-    # create variables
-    x = pulp.LpVariable.dicts("assign", (train_ids, states), cat="Binary")
+# ---------------------------------------------------------------------------
+# Mileage rollup: mileage.csv is an odometer history with many readings per
+# train. Rather than re-parse and group the whole history after each change,
+# a per-train rollup is kept and fed only the rows appended since it last
+# looked (STORAGE.read_since); a rewritten table (compaction, an upsert on
+# SQLite, a migration, an edit of the CSV in place) rebuilds it once. Each train keeps the readings of the
+# longest window plus one older anchor, so memory and the feature pass behind
+# every solve are O(trains) whatever the history length. A reading is dated by
+# its timestamp; undated readings (the seed data) are taken as
+# MILEAGE_READING_DAYS apart, the last one that far before the first dated one.
+# ---------------------------------------------------------------------------
 
-    # model
-    model = pulp.LpProblem("KMRL_Scheduler", pulp.LpMinimize)
+MILEAGE_READING_DAYS = float(os.getenv("MILEAGE_READING_DAYS", "1"))
+MILEAGE_WINDOWS = (7, 30)  # days; km_7d, km_30d, and km_per_day over the longest
+_MILEAGE_LOCK = threading.Lock()
+_MILEAGE_ROLLUP: Optional["MileageRollup"] = None
 
-    # optionally compute sets used by constraints
-    branded_trains = [t for t in train_ids if safe_float(branding.get(t, {}).get("priority", 0.0), 0.0) > 0]
-    # cleaning due: based on last_cleaned_days if present; missing record => due
-    needs_cleaning = {}
-    for t in train_ids:
-        if not cleaning.get(t):
-            needs_cleaning[t] = 1
+class MileageRollup:
+    """Rollup state for one storage backend: per-train reading days and km (parallel
+    lists in day order), the read_since cursor, and the features handed out
+    (replaced, never mutated)."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.cursor: Any = None
+        self.signature: Any = None
+        self.days: Dict[str, List[float]] = {}
+        self.kms: Dict[str, List[float]] = {}
+        self.dated: set = set()
+        self.features: Dict[str, Dict[str, float]] = {}
+
+    def extend(self, train: str, days: np.ndarray, kms: List[float]):
+        """Add one train's new readings in arrival order (days NaN when undated)."""
+        undated = np.isnan(days)
+        have_days = self.days.setdefault(train, [])
+        have_kms = self.kms.setdefault(train, [])
+        if undated.all() and train not in self.dated:
+            # consecutive undated readings: only the tail can outlive the window
+            first = have_days[-1] + MILEAGE_READING_DAYS if have_days else 0.0
+            keep = len(kms) if MILEAGE_READING_DAYS <= 0 else min(len(kms), int(max(MILEAGE_WINDOWS) / MILEAGE_READING_DAYS) + 2)
+            have_days.extend((first + np.arange(len(kms) - keep, len(kms)) * MILEAGE_READING_DAYS).tolist())
+            have_kms.extend(kms[len(kms) - keep:])
+        elif not undated.any() and (train in self.dated or not have_days) and (np.diff(days) >= 0).all() \
+                and (not have_days or days[0] >= have_days[-1]):
+            self.dated.add(train)
+            have_days.extend(days.tolist())
+            have_kms.extend(kms)
         else:
-            days = safe_float(cleaning.get(t, {}).get("last_cleaned_days", None), None)
-            needs_cleaning[t] = 1 if (days is None or days >= cleaning_due_threshold) else 0
-   
-    # each train must be exactly one state
-    for t in train_ids:
-        model += pulp.lpSum([x[t][s] for s in states]) == 1, f"one_state_{t}"
+            for d, k in zip(days.tolist(), kms):
+                self.add(train, None if d != d else d, k)
+            return
+        self.trim(train)
 
-    # fitness constraint: if expired -> cannot run
-    for t in train_ids:
-        if fitness.get(t, {}).get("valid", 1) == 0:
-            model += x[t]["run"] == 0, f"fitness_block_{t}"
-    # additional: minimum fitness score required to run
-    for t in train_ids:
-        if safe_float(fitness.get(t, {}).get("score", 1.0), 1.0) < run_min_fitness_score:
-            model += x[t]["run"] == 0, f"min_fitness_to_run_{t}"
+    def add(self, train: str, day: Optional[float], km: float):
+        days, kms = self.days.setdefault(train, []), self.kms.setdefault(train, [])
+        if day is None:
+            day = days[-1] + MILEAGE_READING_DAYS if days else 0.0
+        elif train not in self.dated:
+            self.dated.add(train)
+            if days:
+                # line the undated history up to end one interval before this reading
+                shift = day - MILEAGE_READING_DAYS - days[-1]
+                days[:] = [d + shift for d in days]
+        i = bisect.bisect_right(days, day)  # a late reading goes in place; ties keep arrival order
+        days.insert(i, day)
+        kms.insert(i, km)
+        self.trim(train)
 
-    # job card: if open -> must be maintenance
-    for t in train_ids:
-        if jobcard.get(t, {}).get("open", 0) == 1:
-            model += x[t]["maintenance"] == 1, f"jobcard_requires_maint_{t}"
+    def trim(self, train: str):
+        # keep one reading at or before the start of the longest window
+        days = self.days[train]
+        drop = bisect.bisect_right(days, days[-1] - max(MILEAGE_WINDOWS)) - 1
+        if drop > 0:
+            del days[:drop]
+            del self.kms[train][:drop]
 
-    # branding: if branding_required -> prefer run by adding negative cost (we'll use objective)
-    branding_score = {t: safe_float(branding.get(t, {}).get("priority", 0.0), 0.0) for t in train_ids}
+    def train_features(self, train: str) -> Dict[str, float]:
+        days, kms = self.days[train], self.kms[train]
+        day, km = days[-1], kms[-1]
+        out = {"km": km}
+        for w in MILEAGE_WINDOWS:
+            out[f"km_{w}d"] = km - km_at(days, kms, day - w)
+        span = min(max(MILEAGE_WINDOWS), day - days[0])
+        out["km_per_day"] = out[f"km_{max(MILEAGE_WINDOWS)}d"] / span if span > 0 else 0.0
+        return out
 
-    # cleaning capacity
-    model += pulp.lpSum([x[t]["cleaning"] for t in train_ids]) <= cleaning_capacity, "clean_cap"
-    # ensure a minimum number of cleaning for due trains (subject to capacity)
-    due_list = [t for t in train_ids if needs_cleaning.get(t, 0) == 1]
-    if min_clean_due > 0 and len(due_list) > 0:
-        model += pulp.lpSum([x[t]["cleaning"] for t in due_list]) >= min(min_clean_due, len(due_list)), "clean_due_min"
+    def apply(self, df: pd.DataFrame) -> int:
+        """Fold rows of mileage.csv into the rollup; returns how many were usable."""
+        if "train_id" not in df.columns or "km" not in df.columns or df.empty:
+            return 0
+        # normalize the distinct ids only, then map rows onto them
+        raw, ids = pd.factorize(df["train_id"])
+        ids = pd.Index(ids.astype(str)).str.strip()
+        id_codes, names = pd.factorize(ids)
+        codes = np.where(raw >= 0, id_codes[raw], -1)
+        valid_id = (names != "") & (names != "nan")
+        km = pd.to_numeric(df["km"], errors="coerce")
+        keep = km.notna().to_numpy() & (codes >= 0) & np.append(valid_id, False)[codes]
+        if "timestamp" in df.columns:
+            ts = pd.to_datetime(df["timestamp"], format="mixed", errors="coerce", utc=True)
+            days = ((ts - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(days=1)).to_numpy(dtype=float)[keep]
+        else:
+            days = np.full(int(keep.sum()), np.nan)
+        # group rows by train, arrival order kept within each group
+        codes = codes[keep]
+        order = np.argsort(codes, kind="stable")
+        bounds = np.flatnonzero(np.diff(codes[order])) + 1
+        kms = km.to_numpy(dtype=float)[keep][order]
+        days = days[order]
+        names = names.tolist()
+        touched = []
+        for idx, lo, hi in zip(codes[order][np.r_[0, bounds]].tolist() if len(order) else [], np.r_[0, bounds].tolist(), np.r_[bounds, len(order)].tolist()):
+            touched.append(names[idx])
+            self.extend(names[idx], days[lo:hi], kms[lo:hi].tolist())
+        self.features = {**self.features, **{t: self.train_features(t) for t in touched}}
+        return len(order)
 
-    # mutual exclusivity run vs cleaning already enforced by one_state constraint
+def km_at(days: List[float], kms: List[float], day: float) -> float:
+    """Odometer at day, interpolated between readings; the first reading before the history starts."""
+    i = bisect.bisect_right(days, day)
+    if i == 0:
+        return kms[0]
+    if i == len(days):
+        return kms[-1]
+    return kms[i - 1] + (kms[i] - kms[i - 1]) * (day - days[i - 1]) / (days[i] - days[i - 1])
 
-    # simulate sudden failure: force failed train to not run
-    if fail_train and fail_train in train_ids:
-        model += x[fail_train]["run"] == 0, f"sim_fail_{fail_train}"
+def mileage_rollup() -> Dict[str, Dict[str, float]]:
+    """Per-train {"km", "km_7d", "km_30d", "km_per_day"} from mileage.csv, brought up to
+    date with the rows appended since the last call. Shared; treat as read-only."""
+    global _MILEAGE_ROLLUP
+    table = "mileage.csv"
+    with _MILEAGE_LOCK:
+        rollup = _MILEAGE_ROLLUP
+        sig = STORAGE.signature(table)
+        if rollup is not None and rollup.storage is STORAGE and rollup.signature == sig:
+            return rollup.features
+        got = None
+        if rollup is not None and rollup.storage is STORAGE:
+            got = STORAGE.read_since(table, rollup.cursor)
+        mode = "append"
+        if got is None:
+            rollup, mode = MileageRollup(STORAGE), "rebuild"
+            got = STORAGE.read_since(table, None)
+        df, rollup.cursor = got
+        count("kmrl_mileage_rollup_rows_total", rollup.apply(df), mode=mode)
+        rollup.signature = sig
+        _MILEAGE_ROLLUP = rollup
+        return rollup.features
 
-    # mileage: prefer assigning lower-mileage trains to run (normalized cost on run decision)
-    mile_km = {t: safe_float(mileage.get(t, {}).get("km", 0.0), 0.0) for t in train_ids}
-    max_mileage = max(1.0, max(mile_km.values()) if len(mile_km) > 0 else 1.0)
-    norm_mileage = {t: (mile_km[t] / max_mileage) for t in train_ids}
+FLEET_TABLES = ("fitness", "jobcard", "branding", "mileage", "cleaning", "stabling")
+
+def load_fleet() -> Dict[str, Any]:
+    """Consistent snapshot of trains.csv plus the latest-per-train tables.
+    Taken under the upsert lock so an in-flight apply_entries batch is never half visible.
+    """
+    with data_lock(exclusive=False):
+        sync_data_version()
+        with span("load_trains"):
+            fleet = {"trains": load_trains()}
+        with span("latest_by_train"):
+            for name in FLEET_TABLES:
+                if name != "mileage":
+                    fleet[name] = latest_by_train(f"{name}.csv")
+        with span("mileage_rollup"):
+            fleet["mileage"] = mileage_rollup()
+        fleet["yard"] = load_yard()
+        # storage signatures of the snapshot (and the depot layout); identifies the data a solved model came from
+        fleet["version"] = tuple(STORAGE.signature(t) for t in ("trains.csv", *(f"{name}.csv" for name in FLEET_TABLES))) + (
+            fleet["yard"]["signature"] if fleet["yard"] else None,)
+    return fleet
+
+DATA_ORIENTS = ("records", "columns")
+
+def data_payload(orient: str = "records") -> bytes:
+    """Serialized /api/data body; only files whose signature changed are re-parsed.
+    orient="columns" gives {file: {column: [values]}} instead of a list of row dicts.
+    """
+    with data_lock(exclusive=False):
+        sync_data_version()
+        return _data_payload(orient)
+
+def _data_payload(orient: str) -> bytes:
+    names = STORAGE.tables()
+    signature = tuple((f, STORAGE.signature(f)) for f in names)
+    with _FLEET_CACHE_LOCK:
+        hit = _DATA_PAYLOAD.get(orient)
+        if hit is not None and hit[0] == signature:
+            return hit[1]
+    convert = df_records_safe if orient == "records" else df_columns_safe
+    files = {}
+    for f in names:
+        files[f] = cached_table(f, orient, lambda t: convert(STORAGE.read(t)))
+    body = json_bytes(files)
+    with _FLEET_CACHE_LOCK:
+        _DATA_PAYLOAD[orient] = (signature, body)
+    return body
+
+async def ingest_events(content: bytes, filename: str):
+    """One sheet photo as a stream of progress events: each entry is staged as
+    soon as the model emits it ("entry" with the updates it implies), a "retry"
+    discards what was staged, and "done" follows once the whole sheet has been
+    committed as one batch and audited.
+    """
+    logger = logging.getLogger("ingest")
+    staged: Dict[str, List[Dict[str, Any]]] = {}
+    updates: List[Dict[str, Any]] = []
+    index = 0
+    started = time.perf_counter()
+    apply_s = 0.0
+    async for event in vision_events(content):
+        if event["event"] == "entry":
+            # has_key may touch storage; keep it off the event loop
+            staging = time.perf_counter()
+            item_updates = await run_in_threadpool(stage_entry, event["entry"], staged)
+            apply_s += time.perf_counter() - staging
+            updates.extend(item_updates)
+            yield {"event": "entry", "index": index, "entry": event["entry"], "updates": item_updates}
+            index += 1
+        elif event["event"] == "retry":
+            staged.clear()
+            updates.clear()
+            index = 0
+            yield event
+        else:
+            result = event["result"]
+    # time spent staging while the model streamed is apply time, not vision time
+    record_stage("vision_call", time.perf_counter() - started - apply_s)
+    entries = result["entries"]
+    logger.info("Parsed entries", extra={"count": len(entries)})
+    # storage writes are blocking; keep them off the event loop
+    staging = time.perf_counter()
+    await run_in_threadpool(commit_staged_rows, staged)
+    record_stage("apply", apply_s + time.perf_counter() - staging)
+    logger.info("Applied updates", extra={"count": len(updates)})
+    audit_started = time.perf_counter()
+    try:
+        await run_in_threadpool(
+            append_ingestion_audit,
+            filename=filename,
+            size_bytes=len(content),
+            model=os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct"),
+            entries=entries,
+            updates=updates,
+            raw_text=result.get("raw") or "",
+            cache_hit=result["cache_hit"],
+            content_sha256=result["content_sha256"],
+        )
+        logger.info("Audit row appended", extra={"audit_table": "ingestion_log.csv", "storage": STORAGE.kind})
+    except Exception as e:
+        logger.warning(f"Failed to write ingestion audit: {e}")
+    record_stage("audit", time.perf_counter() - audit_started)
+    yield {"event": "done", "parsed": entries, "updates": updates, "raw": result.get("raw"), "cache_hit": result["cache_hit"]}
+
+async def read_upload(file: UploadFile) -> Tuple[str, bytes]:
+    try:
+        with span("upload_read"):
+            content = await file.read()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Unable to read uploaded file")
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    logging.getLogger("ingest").info(
+        "Received upload",
+        extra={
+            "upload_filename": getattr(file, "filename", None),
+            "upload_bytes": len(content),
+            "upload_content_type": getattr(file, "content_type", None),
+        },
+    )
+    return getattr(file, "filename", None) or "(upload)", content
+
+def sse_event(event: str, data: Any) -> bytes:
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + json_bytes(data) + b"\n\n"
+
+@app.post("/api/ingest-image")
+async def ingest_image(file: UploadFile = File(...)):
+    filename, content = await read_upload(file)
+    async for event in ingest_events(content, filename):
+        if event["event"] == "done":
+            event.pop("event")
+            return FastJSONResponse(event)
+
+@app.post("/api/ingest-image/stream")
+async def ingest_image_stream(file: UploadFile = File(...)):
+    """
+    /api/ingest-image as Server-Sent Events: `entry` per extracted entry (index,
+    entry, updates) while the model is still generating, `retry` when the vision
+    call is retried (drop the entries shown so far), then `done` with the same
+    body /api/ingest-image returns, or `error` with status and detail.
+    """
+    filename, content = await read_upload(file)
+
+    async def events():
+        try:
+            async for event in ingest_events(content, filename):
+                yield sse_event(event.pop("event"), event)
+        except HTTPException as e:
+            yield sse_event("error", {"status": e.status_code, "detail": e.detail})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/ingest-images")
+async def ingest_images(files: List[UploadFile] = File(...)):
+    """
+    Ingest several sheet photos at once. Vision calls run concurrently (at most
+    GROQ_CONCURRENCY in flight, with retry/backoff); entries are merged in upload
+    order and applied as one batch. Files whose extraction fails are reported
+    per file and skipped; the request fails only if every file fails. Cached
+    photos are served without GROQ_API_KEY; the key is needed for the misses.
+    """
+    logger = logging.getLogger("ingest")
+    uploads = []
+    with span("upload_read"):
+        for f in files:
+            try:
+                uploads.append((getattr(f, "filename", None) or "(upload)", await f.read()))
+            except Exception:
+                raise HTTPException(status_code=400, detail=f"Unable to read uploaded file {getattr(f, 'filename', '')}")
+    logger.info("Received uploads", extra={"files": len(uploads), "upload_bytes": sum(len(c) for _, c in uploads)})
+
+    clients: List[Any] = []  # one client for all misses, made on the first one
+    gate = asyncio.Semaphore(GROQ_CONCURRENCY)
+
+    def get_client(api_key: str):
+        if not clients:
+            clients.append(groq_async_client_factory(api_key))
+        return clients[0]
+
+    async def extract(content: bytes):
+        async with gate:
+            return await call_groq_vision_async(content, get_client=get_client)
+
+    # identical photos in one request share a single extraction
+    digests = [hashlib.sha256(c).hexdigest() for _, c in uploads]
+    tasks: Dict[str, Any] = {}
+    for digest, (_, content) in zip(digests, uploads):
+        if digest not in tasks:
+            tasks[digest] = asyncio.ensure_future(extract(content))
+    with span("vision_call"):
+        results = await asyncio.gather(*(tasks[d] for d in digests), return_exceptions=True)
+    report = []
+    groups = []
+    seen = set()
+    for (name, content), digest, result in zip(uploads, digests, results):
+        if not isinstance(result, BaseException) and digest in seen:
+            result = {**result, "attempts": 0, "cache_hit": True}
+        seen.add(digest)
+        if isinstance(result, BaseException):
+            detail = result.detail if isinstance(result, HTTPException) else str(result)
+            report.append({"filename": name, "status": "error", "error": detail})
+            continue
+        entries = result["entries"]
+        report.append({"filename": name, "status": "ok", "attempts": result["attempts"], "cache_hit": result["cache_hit"],
+                       "parsed": entries, "raw": result.get("raw"), "_bytes": len(content), "_sha256": result["content_sha256"]})
+        groups.append(entries)
+    if not groups and not os.getenv("GROQ_API_KEY"):
+        # nothing was cached, so every file needed the key
+        raise HTTPException(status_code=400, detail="Missing GROQ_API_KEY environment variable")
+    if not groups:
+        raise HTTPException(status_code=502, detail={"message": "All extractions failed", "files": report})
+
+    # storage writes are blocking; keep them off the event loop
+    with span("apply"):
+        update_groups = iter(await run_in_threadpool(apply_entry_groups, groups))
+    model = os.getenv("GROQ_VISION_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+    for item in report:
+        if item["status"] != "ok":
+            continue
+        item["updates"] = next(update_groups)
+        try:
+            with span("audit"):
+                await run_in_threadpool(
+                    append_ingestion_audit,
+                    filename=item["filename"],
+                    size_bytes=item.pop("_bytes"),
+                    model=model,
+                    entries=item["parsed"],
+                    updates=item["updates"],
+                    raw_text=item["raw"] or "",
+                    cache_hit=item["cache_hit"],
+                    content_sha256=item.pop("_sha256"),
+                )
+        except Exception as e:
+            logger.warning(f"Failed to write ingestion audit: {e}")
+    logger.info("Applied uploads", extra={"files": len(groups), "failed": len(report) - len(groups)})
+    return FastJSONResponse({
+        "files": report,
+        "parsed": [e for item in report if item["status"] == "ok" for e in item["parsed"]],
+        "updates": [u for item in report if item["status"] == "ok" for u in item["updates"]],
+    })
+
+@app.get("/api/metrics")
+def api_metrics():
+    """Request and stage latency histograms, solver outcomes and model size (Prometheus text format)."""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/", response_class=HTMLResponse)
+def root():
+    return FileResponse(str(BASE_DIR / "static" / "index.html"))
+
+# /api/data selection: tables, latest row per train, train_id filter, cursor
+# pagination and NDJSON streaming. Rows are read in chunks, so a page or a
+# stream never holds a whole table in memory (latest_only reuses the fleet cache).
+DATA_CHUNK_ROWS = int(os.getenv("DATA_CHUNK_ROWS", "5000"))
+DATA_PAGE_MAX = int(os.getenv("DATA_PAGE_MAX", "10000"))
+
+def select_tables(tables: Optional[str]) -> List[str]:
+    """Comma-separated table names ("fitness" or "fitness.csv") -> stored table names."""
+    available = STORAGE.tables()
+    if not tables:
+        return available
+    selected = []
+    for name in tables.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        table = name if name.endswith(".csv") else f"{name}.csv"
+        if table not in available:
+            raise HTTPException(status_code=404, detail=f"Unknown table: {name}")
+        selected.append(table)
+    return selected
+
+def _json_cell(v):
+    if v is None or v is pd.NaT:
+        return None
+    if isinstance(v, float):
+        return v if math.isfinite(v) else None
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, np.generic):
+        return _json_cell(v.item())
+    return v
+
+def iter_table_rows(table: str, latest_only: bool = False, train_ids: Optional[set] = None, start: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """(position, row) pairs of a table from position start on.
+
+    Positions are data row numbers (or indexes into the latest-per-train list
+    when latest_only), so a cursor can resume exactly after the last row sent.
+    latest_only has no effect on tables without a train_id column.
+    """
+    if latest_only:
+        try:
+            latest = latest_by_train(table)
+        except KeyError:
+            latest = None
+        if latest is not None:
+            rows = [(t, r) for t, r in latest.items() if train_ids is None or t in train_ids]
+            for pos in range(start, len(rows)):
+                t, r = rows[pos]
+                yield pos, {"train_id": t, **{k: _json_cell(v) for k, v in r.items()}}
+            return
+    for first, chunk in STORAGE.iter_chunks(table, start, DATA_CHUNK_ROWS):
+        pos = first + np.arange(len(chunk))
+        if train_ids is not None:
+            if "train_id" not in chunk.columns:
+                return
+            mask = chunk["train_id"].astype(str).str.strip().isin(train_ids).to_numpy()
+            chunk, pos = chunk[mask], pos[mask]
+        yield from zip(pos.tolist(), df_records_safe(chunk))
+
+def encode_cursor(table: str, pos: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([table, pos]).encode("utf-8")).decode("ascii").rstrip("=")
 
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        table, pos = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(table), int(pos)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def rows_to_columns(rows: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    names = list(dict.fromkeys(k for r in rows for k in r))
+    return {k: [r.get(k) for r in rows] for k in names}
+
+def data_page(tables: List[str], latest_only: bool, train_ids: Optional[set], limit: int, cursor: Optional[str]) -> Dict[str, Any]:
+    """Up to limit rows across tables (in order) starting at cursor, plus the cursor for the next page."""
+    start_table, start = (tables[0] if tables else None, 0) if cursor is None else decode_cursor(cursor)
+    if tables and start_table not in tables:
+        raise HTTPException(status_code=400, detail="Cursor does not match the selected tables")
+    data: Dict[str, List[Dict[str, Any]]] = {}
+    next_cursor = None
+    remaining = limit
+    for table in tables[tables.index(start_table):] if tables else []:
+        rows = data.setdefault(table, [])
+        for pos, row in iter_table_rows(table, latest_only, train_ids, start if table == start_table else 0):
+            if remaining == 0:
+                next_cursor = encode_cursor(table, pos)
+                break
+            rows.append(row)
+            remaining -= 1
+        if next_cursor is not None:
+            break
+    return {"data": data, "next_cursor": next_cursor}
+
+def data_ndjson(tables: List[str], latest_only: bool, train_ids: Optional[set]) -> Iterator[bytes]:
+    """One {"table", "row"} object per line, written a chunk at a time."""
+    for table in tables:
+        batch = []
+        for _, row in iter_table_rows(table, latest_only, train_ids):
+            batch.append(json_bytes({"table": table, "row": row}))
+            if len(batch) >= DATA_CHUNK_ROWS:
+                yield b"\n".join(batch) + b"\n"
+                batch = []
+        if batch:
+            yield b"\n".join(batch) + b"\n"
+
+@app.get("/api/data")
+def api_data(
+    orient: str = "records",
+    tables: Optional[str] = None,
+    latest_only: bool = False,
+    train_id: Optional[List[str]] = Query(None),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fmt: str = Query("json", alias="format"),
+):
+    """
+    Fleet tables for display.
+    Without parameters: every table in full (cached until a table changes).
+    tables=a,b selects tables, latest_only=true keeps the latest row per train,
+    train_id (repeatable or comma-separated) filters rows. limit/cursor page
+    through the selection and answer {"data": {...}, "next_cursor": ...};
+    format=ndjson streams {"table", "row"} lines instead.
+    """
+    if orient not in DATA_ORIENTS:
+        raise HTTPException(status_code=400, detail=f"orient must be one of {', '.join(DATA_ORIENTS)}")
+    if fmt not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    if fmt == "json" and not (tables or latest_only or train_id) and limit is None and cursor is None:
+        # return all CSVs for frontend display (cached until a CSV changes)
+        with span("data_payload"):
+            return Response(content=data_payload(orient), media_type="application/json")
+
+    selected = select_tables(tables)
+    ids = {t.strip() for v in train_id for t in v.split(",") if t.strip()} if train_id else None
+    if fmt == "ndjson":
+        return StreamingResponse(data_ndjson(selected, latest_only, ids), media_type="application/x-ndjson")
+    if limit is not None or cursor is not None:
+        limit = DATA_PAGE_MAX if limit is None else limit
+        if not 1 <= limit <= DATA_PAGE_MAX:
+            raise HTTPException(status_code=400, detail=f"limit must be between 1 and {DATA_PAGE_MAX}")
+        with span("load"):
+            page = data_page(selected, latest_only, ids, limit, cursor)
+            if orient == "columns":
+                page["data"] = {t: rows_to_columns(rows) for t, rows in page["data"].items()}
+        with span("encode"):
+            return FastJSONResponse(page)
+    files = {}
+    with span("load"):
+        for table in selected:
+            rows = [row for _, row in iter_table_rows(table, latest_only, ids)]
+            files[table] = rows_to_columns(rows) if orient == "columns" else rows
+    with span("encode"):
+        return FastJSONResponse(files)
+
+STATES = ["run", "standby", "maintenance", "cleaning"]
+RUN, STANDBY, MAINTENANCE, CLEANING = range(len(STATES))
+
+def safe_float(v, default: float = 0.0) -> float:
+    try:
+        f = float(v)
+        if math.isnan(f) or math.isinf(f):
+            return default
+        return f
+    except Exception:
+        return default
+
+def schedule_parameters(overrides: Dict[Any, Any], fleet_rows: int) -> Dict[str, Any]:
+    """Normalize /api/schedule overrides into the full parameter set (defaults applied)."""
+    overrides = overrides or {}
+    # Advanced tuning parameters with safe defaults (non-binding unless specified)
+    fleet_n = max(1, fleet_rows)
+    default_min_run = int(overrides.get("min_run", math.ceil(0.4 * fleet_n)))
+    default_max_standby = int(overrides.get("max_standby", math.ceil(0.6 * fleet_n)))
+    return {
+        "cleaning_capacity": int(overrides.get("cleaning_capacity", 3)),
+        "cleaning_due_threshold": int(overrides.get("cleaning_due_threshold", 7)),
+        "min_clean_due": int(overrides.get("min_clean_due", 0)),
+        "min_run": max(1, default_min_run),
+        "max_run": int(overrides.get("max_run", fleet_rows)),
+        "maintenance_capacity": int(overrides.get("maintenance_capacity", fleet_rows)),
+        "min_standby": int(overrides.get("min_standby", 0)),
+        "max_standby": max(0, min(default_max_standby, fleet_n)),
+        "min_branded_run": int(overrides.get("min_branded_run", 0)),
+        "run_min_fitness_score": float(overrides.get("run_min_fitness_score", 0.0)),
+        # objective weights (configurable)
+        "risk_w": float(overrides.get("risk_w", 50.0)),
+        "mileage_w": float(overrides.get("mileage_w", 1.0)),
+        # wear balancing: cost of running a train in proportion to its recent km per day (0 = off)
+        "wear_w": float(overrides.get("wear_w", 0.0)),
+        "branding_w": float(overrides.get("branding_w", 20.0)),
+        # discourage non-run states to avoid excessive standby
+        "standby_w": float(overrides.get("standby_w", 6.0)),
+        "maintenance_w": float(overrides.get("maintenance_w", 2.0)),
+        "cleaning_w": float(overrides.get("cleaning_w", 0.5)),
+        "fail_train": overrides.get("fail_train", None),  # simulate sudden failure
+        # objective units one shunting move is worth; 0 (default) keeps the solver's
+        # run set and only orders departures, > 0 lets the stage swap states
+        "shunt_w": float(overrides.get("shunt_w", 0.0)),
+    }
+
+def schedule_limits(p: Dict[str, Any], n: int, n_due: int, n_branded: int) -> Dict[str, float]:
+    """Right-hand sides of the global cardinality rows; optional rows are omitted when inactive."""
+    rhs = {"clean_cap": p["cleaning_capacity"]}
+    if p["min_clean_due"] > 0 and n_due > 0:
+        rhs["clean_due_min"] = min(p["min_clean_due"], n_due)
+    rhs["min_run"] = min(p["min_run"], n)
+    rhs["max_run"] = max(0, min(p["max_run"], n))
+    rhs["maint_cap"] = max(0, p["maintenance_capacity"])
+    rhs["min_standby"] = max(0, p["min_standby"])
+    rhs["max_standby"] = max(0, p["max_standby"])
+    if p["min_branded_run"] > 0 and n_branded > 0:
+        rhs["min_branded_run"] = min(p["min_branded_run"], n_branded)
+    return rhs
+
+def build_schedule_model(fleet: Dict[str, Any], p: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the run/standby/maintenance/cleaning assignment MILP as NumPy arrays.
+
+    Variable j = i * 4 + s is "train i takes state s" (STATES order). Every
+    constraint coefficient is 1, so the matrix is held as COO row/column index
+    arrays; rows keep PuLP's names and order (one_state_*, fitness_block_*,
+    min_fitness_to_run_*, jobcard_requires_maint_*, clean_cap, clean_due_min,
+    sim_fail_*, min_run, max_run, maint_cap, min_standby, max_standby,
+    min_branded_run).
+    """
+    trains = fleet["trains"]
+    fitness, jobcard, branding = fleet["fitness"], fleet["jobcard"], fleet["branding"]
+    mileage, cleaning = fleet["mileage"], fleet["cleaning"]
+    # Prefer train IDs from trains.csv if available; otherwise from fitness keys
+    if trains["train_ids"] is not None:
+        train_ids = list(trains["train_ids"])
+    else:
+        train_ids = list(fitness.keys())
+    n = len(train_ids)
+
+    # per-train vectors pulled once from the latest-per-train tables
+    valid = np.array([fitness.get(t, {}).get("valid", 1) for t in train_ids], dtype=object)
+    score = np.fromiter((safe_float(fitness.get(t, {}).get("score", 1.0), 1.0) for t in train_ids), float, n)
+    job_open = np.array([jobcard.get(t, {}).get("open", 0) for t in train_ids], dtype=object)
+    branding_score = np.fromiter((safe_float(branding.get(t, {}).get("priority", 0.0), 0.0) for t in train_ids), float, n)
+    mile_km = np.fromiter((safe_float(mileage.get(t, {}).get("km", 0.0), 0.0) for t in train_ids), float, n)
+    run_rate = np.fromiter((safe_float(mileage.get(t, {}).get("km_per_day", 0.0), 0.0) for t in train_ids), float, n)
+    # cleaning due: based on last_cleaned_days if present; missing record => due
+    days = np.fromiter((safe_float(cleaning[t].get("last_cleaned_days", None), np.nan) if cleaning.get(t) else -np.inf for t in train_ids), float, n)
+    needs_cleaning = np.where(np.isneginf(days), 1, np.where(np.isnan(days) | (days >= p["cleaning_due_threshold"]), 1, 0))
+
+    fitness_block = valid == 0
+    low_fitness = score < p["run_min_fitness_score"]
+    jobcard_open = job_open == 1
+    branded = branding_score > 0
+
+    # mileage: prefer assigning lower-mileage trains to run (normalized cost on run decision)
+    max_mileage = max(1.0, float(mile_km.max()) if n > 0 else 1.0)
+    norm_mileage = mile_km / max_mileage
+    # wear: the recent utilisation rate, so trains worked hardest lately rest first
+    norm_rate = run_rate / max(1.0, float(run_rate.max()) if n > 0 else 1.0)
     # risk proxy: lower fitness score increases risk
-    risk_score = {t: 1 - safe_float(fitness.get(t, {}).get("score", 1.0), 1.0) for t in train_ids}
+    risk_score = 1 - score
 
-    model += (
-        risk_w * pulp.lpSum([risk_score[t] * x[t]["run"] for t in train_ids])
-        + mileage_w * pulp.lpSum([norm_mileage[t] * x[t]["run"] for t in train_ids])
-        + standby_w * pulp.lpSum([x[t]["standby"] for t in train_ids])
-        + maintenance_w * pulp.lpSum([x[t]["maintenance"] for t in train_ids])
-        + cleaning_w * pulp.lpSum([x[t]["cleaning"] for t in train_ids])
-        - branding_w * pulp.lpSum([branding_score[t] * x[t]["run"] for t in train_ids])
-    ), "main_objective"
+    # objective coefficients; "present" mirrors which terms PuLP keeps (zero products are dropped)
+    risk_term = p["risk_w"] * risk_score
+    mileage_term = p["mileage_w"] * norm_mileage
+    wear_term = p["wear_w"] * norm_rate
+    branding_term = p["branding_w"] * branding_score
+    cost = np.zeros((n, len(STATES)))
+    present = np.zeros((n, len(STATES)), dtype=bool)
+    cost[:, RUN] = risk_term + mileage_term + wear_term - branding_term
+    present[:, RUN] = (risk_term != 0) | (mileage_term != 0) | (wear_term != 0) | (branding_term != 0)
+    for s, w in ((STANDBY, p["standby_w"]), (MAINTENANCE, p["maintenance_w"]), (CLEANING, p["cleaning_w"])):
+        cost[:, s] = w
+        present[:, s] = w != 0
 
-    # Global resource and service level constraints
-    model += pulp.lpSum([x[t]["run"] for t in train_ids]) >= min(min_run, len(train_ids)), "min_run"
-    model += pulp.lpSum([x[t]["run"] for t in train_ids]) <= max(0, min(max_run, len(train_ids))), "max_run"
-    model += pulp.lpSum([x[t]["maintenance"] for t in train_ids]) <= max(0, maintenance_capacity), "maint_cap"
-    model += pulp.lpSum([x[t]["standby"] for t in train_ids]) >= max(0, min_standby), "min_standby"
-    model += pulp.lpSum([x[t]["standby"] for t in train_ids]) <= max(0, max_standby), "max_standby"
+    row_names: List[str] = []
+    row_sense: List[str] = []
+    row_rhs: List[float] = []
+    coo_rows: List[np.ndarray] = []
+    coo_cols: List[np.ndarray] = []
+    limits: Dict[str, float] = {}
+
+    def add_rows(names, sense, rhs, rows_rel, cols):
+        base = len(row_names)
+        row_names.extend(names)
+        row_sense.extend([sense] * len(names))
+        row_rhs.extend(rhs)
+        coo_rows.append(base + np.asarray(rows_rel, dtype=np.int64))
+        coo_cols.append(np.asarray(cols, dtype=np.int64))
 
+    def add_fix(mask, prefix, state, value):
+        idx = np.flatnonzero(mask)
+        add_rows([f"{prefix}{train_ids[i]}" for i in idx], "E", [value] * len(idx), np.arange(len(idx)), idx * len(STATES) + state)
+
+    def add_sum(name, sense, rhs, idx, state):
+        limits[name] = rhs
+        add_rows([name], sense, [rhs], np.zeros(len(idx)), np.asarray(idx) * len(STATES) + state)
+
+    trains_idx = np.arange(n)
+    # each train must be exactly one state
+    add_rows([f"one_state_{t}" for t in train_ids], "E", [1] * n, np.repeat(trains_idx, len(STATES)), np.arange(n * len(STATES)))
+    # fitness constraint: if expired -> cannot run
+    add_fix(fitness_block, "fitness_block_", RUN, 0)
+    # additional: minimum fitness score required to run
+    add_fix(low_fitness, "min_fitness_to_run_", RUN, 0)
+    # job card: if open -> must be maintenance
+    add_fix(jobcard_open, "jobcard_requires_maint_", MAINTENANCE, 1)
+    due_idx = np.flatnonzero(needs_cleaning == 1)
+    branded_idx = np.flatnonzero(branded)
+    rhs = schedule_limits(p, n, len(due_idx), len(branded_idx))
+    # cleaning capacity
+    add_sum("clean_cap", "L", rhs["clean_cap"], trains_idx, CLEANING)
+    # ensure a minimum number of cleaning for due trains (subject to capacity)
+    if "clean_due_min" in rhs:
+        add_sum("clean_due_min", "G", rhs["clean_due_min"], due_idx, CLEANING)
+    # simulate sudden failure: force failed train to not run
+    fail_train = p["fail_train"]
+    sim_fail = np.zeros(n, dtype=bool)
+    if fail_train and fail_train in train_ids:
+        sim_fail = np.array([t == fail_train for t in train_ids], dtype=bool)
+        add_fix(sim_fail, "sim_fail_", RUN, 0)
+    # Global resource and service level constraints
+    add_sum("min_run", "G", rhs["min_run"], trains_idx, RUN)
+    add_sum("max_run", "L", rhs["max_run"], trains_idx, RUN)
+    add_sum("maint_cap", "L", rhs["maint_cap"], trains_idx, MAINTENANCE)
+    add_sum("min_standby", "G", rhs["min_standby"], trains_idx, STANDBY)
+    add_sum("max_standby", "L", rhs["max_standby"], trains_idx, STANDBY)
     # Ensure minimum branded trains running if requested
-    if min_branded_run > 0 and len(branded_trains) > 0:
-        model += pulp.lpSum([x[t]["run"] for t in branded_trains]) >= min(min_branded_run, len(branded_trains)), "min_branded_run"
+    if "min_branded_run" in rhs:
+        add_sum("min_branded_run", "G", rhs["min_branded_run"], branded_idx, RUN)
+
+    return {
+        "train_ids": train_ids,
+        "cost": cost,
+        "cost_present": present,
+        "row_names": row_names,
+        "row_sense": row_sense,
+        "row_rhs": np.asarray(row_rhs, dtype=float),
+        "coo_rows": np.concatenate(coo_rows),
+        "coo_cols": np.concatenate(coo_cols),
+        # right-hand sides of the global (cardinality) rows by name
+        "limits": limits,
+        # per-train features reused for explanations and ranking
+        "fitness_block": fitness_block,
+        "low_fitness": low_fitness,
+        "jobcard_open": jobcard_open,
+        "sim_fail": sim_fail,
+        "branded": branded,
+        "needs_cleaning": needs_cleaning,
+        "branding_score": branding_score,
+        "risk_score": risk_score,
+        "norm_mileage": norm_mileage,
+        "mile_km": mile_km,
+        "norm_rate": norm_rate,
+        # days since last cleaning; inf when unknown (treated as due)
+        "clean_days": np.where(np.isneginf(days) | np.isnan(days), np.inf, days),
+    }
+
+_PULP_NAME_TRANS = str.maketrans("-+[] ->/", "________")
+
+def write_schedule_mps(model: Dict[str, Any], path: str):
+    """Write the model as fixed-format MPS in bulk.
+    Layout follows PuLP's writeMPS(rename=1) (columns sorted by PuLP variable
+    name, C/X normalized names), so CBC sees exactly the problem the former
+    LpProblem produced and returns the same assignment.
+    """
+    train_ids = model["train_ids"]
+    n_vars = len(train_ids) * len(STATES)
+    var_names = [f"assign_{t}_{s}".translate(_PULP_NAME_TRANS) for t in train_ids for s in STATES]
+    order = sorted(range(n_vars), key=var_names.__getitem__)
+    col_pos = np.empty(n_vars, dtype=np.int64)
+    col_pos[order] = np.arange(n_vars)
+
+    rows, cols = model["coo_rows"], model["coo_cols"]
+    by_col = np.lexsort((rows, col_pos[cols]))
+    rows_sorted = rows[by_col]
+    starts = np.searchsorted(col_pos[cols][by_col], np.arange(n_vars + 1))
+    cost = model["cost"].ravel().tolist()
+    present = model["cost_present"].ravel().tolist()
+    mps_sense = {"E": "E", "L": "L", "G": "G"}
+
+    row_tags = ["C%07d" % r for r in range(len(model["row_sense"]))]
+    unit = "% .12e" % 1
+    rows_sorted = rows_sorted.tolist()
+    starts = starts.tolist()
+    lines = ["*SENSE:Minimize\n", "NAME          MODEL\n", "ROWS\n", " N  OBJ\n"]
+    lines += [" %s  %s\n" % (mps_sense[s], row_tags[r]) for r, s in enumerate(model["row_sense"])]
+    lines.append("COLUMNS\n")
+    for k, j in enumerate(order):
+        name = "X%07d" % k
+        lines.append("    MARK      'MARKER'                 'INTORG'\n")
+        lines += ["    %-8s  %-8s  %s\n" % (name, row_tags[r], unit) for r in rows_sorted[starts[k]:starts[k + 1]]]
+        if present[j]:
+            lines.append("    %-8s  %-8s  % .12e\n" % (name, "OBJ", cost[j]))
+        lines.append("    MARK      'MARKER'                 'INTEND'\n")
+    lines.append("RHS\n")
+    lines += ["    RHS       %-8s  % .12e\n" % (row_tags[r], rhs) for r, rhs in enumerate(model["row_rhs"].tolist())]
+    lines.append("BOUNDS\n")
+    lines += [" BV BND       %-8s\n" % ("X%07d" % k) for k in range(n_vars)]
+    lines.append("ENDATA\n")
+    with open(path, "w") as f:
+        f.write("".join(lines))
+    return order
+
+_CBC_STATUS = {
+    "Optimal": pulp.LpStatusOptimal,
+    "Infeasible": pulp.LpStatusInfeasible,
+    "Integer": pulp.LpStatusInfeasible,
+    "Unbounded": pulp.LpStatusUnbounded,
+    "Stopped": pulp.LpStatusNotSolved,
+}
 
-    # solve with time limit
-    solver = pulp.PULP_CBC_CMD(msg=False, timeLimit=10)
-    model.solve(solver)
+def write_schedule_mst(model: Dict[str, Any], order: List[int], assigned: List[Optional[str]], path: str):
+    """Write an assignment as a CBC MIP start (-mips) for the columns of write_schedule_mps."""
+    x = np.zeros(len(order))
+    for i, s in enumerate(assigned):
+        if s is not None:
+            x[i * len(STATES) + STATES.index(s)] = 1
+    lines = ["Stopped on time - objective value 0\n"]
+    lines += ["{:>7} {} {:>15} {:>23}\n".format(k, "X%07d" % k, int(x[j]), 0) for k, j in enumerate(order)]
+    with open(path, "w") as f:
+        f.write("".join(lines))
 
-    # build result
+def run_cbc(write_mps: Callable[[str], Any], n_cols: int, time_limit: int = 10,
+            write_mst: Optional[Callable[[str], Any]] = None) -> Tuple[int, np.ndarray]:
+    """Run the CBC binary PuLP bundles on the MPS that write_mps(path) produces.
+    write_mst(path), when given, writes a MIP start (-mips). Returns the PuLP
+    status code and the values of columns X0000000.. in column order.
+    """
+    import subprocess
+    import tempfile
+    solver = pulp.PULP_CBC_CMD(msg=False, timeLimit=time_limit)
+    if not solver.available():
+        raise pulp.PulpSolverError("Pulp: cannot execute CBC solver " + str(solver.path))
+    fd, mps_path = tempfile.mkstemp(suffix="-pulp.mps")
+    os.close(fd)
+    sol_path = mps_path[:-4] + ".sol"
+    mst_path = mps_path[:-4] + ".mst"
+    try:
+        write_mps(mps_path)
+        args = [solver.path, mps_path]
+        if write_mst is not None:
+            write_mst(mst_path)
+            args += ["-mips", mst_path]
+        args += ["-sec", str(time_limit), "-timeMode", "elapsed",
+                 "-solve", "-printingOptions", "all", "-solution", sol_path]
+        with span("cbc_process"):
+            returncode = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        if returncode != 0:
+            raise pulp.PulpSolverError("Pulp: Error while trying to execute " + solver.path)
+        if not os.path.exists(sol_path):
+            raise pulp.PulpSolverError("Pulp: Error while executing " + solver.path)
+        values = np.zeros(n_cols)
+        with open(sol_path) as f:
+            status = _CBC_STATUS.get(f.readline().split()[0], pulp.LpStatusUndefined)
+            for line in f:
+                if len(line) <= 2:
+                    break
+                parts = line.split()
+                # incase the solution is infeasible
+                if parts[0] == "**":
+                    parts = parts[1:]
+                if parts[1].startswith("X"):
+                    values[int(parts[1][1:])] = float(parts[2])
+    finally:
+        for tmp in (mps_path, sol_path, mst_path):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return status, values
+
+def solve_schedule_model(model: Dict[str, Any], time_limit: int = 10, warm_start: Optional[List[Optional[str]]] = None) -> Tuple[str, List[Optional[str]]]:
+    """Solve with CBC (the binary PuLP bundles) and return (status, assigned state per train).
+    warm_start: optional per-train states handed to CBC as the initial incumbent.
+    """
+    train_ids = model["train_ids"]
+    if not train_ids:
+        return pulp.LpStatus[pulp.LpStatusNotSolved], []
+    order: List[int] = []
+    write_mst = None
+    if warm_start is not None:
+        write_mst = lambda path: write_schedule_mst(model, order, warm_start, path)
+    status, col_values = run_cbc(lambda path: order.extend(write_schedule_mps(model, path)),
+                                 len(train_ids) * len(STATES), time_limit, write_mst)
+    values = np.zeros(len(order))
+    values[order] = col_values
+    chosen = np.round(values.reshape(len(train_ids), len(STATES))) == 1
+    assigned = [STATES[int(np.argmax(row))] if row.any() else None for row in chosen]
+    return pulp.LpStatus[status], assigned
+
+# Row names the fast path understands; any other row sends the solve to CBC.
+_FAST_PATH_ROW_PREFIXES = ("one_state_", "fitness_block_", "min_fitness_to_run_", "jobcard_requires_maint_", "sim_fail_")
+_FAST_PATH_ROWS = {"clean_cap", "clean_due_min", "min_run", "max_run", "maint_cap", "min_standby", "max_standby", "min_branded_run"}
+
+def fast_path_applicable(model: Dict[str, Any]) -> bool:
+    """True when the model only has the per-train fixings and cardinality rows
+    build_schedule_model emits and the non-run states cost the same for every train."""
+    if not model["train_ids"]:
+        return False
+    for name in model["row_names"]:
+        if name not in _FAST_PATH_ROWS and not name.startswith(_FAST_PATH_ROW_PREFIXES):
+            return False
+    cost = model["cost"]
+    return bool(np.all(cost[:, [STANDBY, MAINTENANCE, CLEANING]] == cost[0, [STANDBY, MAINTENANCE, CLEANING]]))
+
+def _non_run_costs(model: Dict[str, Any], n_free: int, n_jobcard: int):
+    """Cheapest cost of placing m = 0..n_free free non-run trains into standby /
+    maintenance / cleaning under the cardinality rows (inf where infeasible),
+    plus the per-state lower bounds, upper bounds and unit costs used."""
+    lim = model["limits"]
+    unit = model["cost"][0]
+    lo = {STANDBY: lim["min_standby"], MAINTENANCE: 0, CLEANING: lim.get("clean_due_min", 0)}
+    hi = {STANDBY: lim["max_standby"], MAINTENANCE: lim["maint_cap"] - n_jobcard, CLEANING: lim["clean_cap"]}
+    m = np.arange(n_free + 1)
+    if any(lo[s] > hi[s] for s in lo):
+        return np.full(n_free + 1, np.inf), lo, hi, unit
+    g = np.full(n_free + 1, float(sum(lo[s] * unit[s] for s in lo)))
+    left = m - sum(lo.values())
+    feasible = left >= 0
+    for s in sorted(lo, key=lambda s: unit[s]):
+        take = np.clip(left, 0, hi[s] - lo[s])
+        g += take * unit[s]
+        left = left - take
+    return np.where(feasible & (left == 0), g, np.inf), lo, hi, unit
+
+def solve_schedule_fast(model: Dict[str, Any]) -> Optional[List[Optional[str]]]:
+    """Exact combinatorial solve of the assignment model (no CBC subprocess).
+
+    With uniform standby/maintenance/cleaning costs the objective only depends
+    on which trains run and how many trains take each other state. Job-card
+    trains are fixed to maintenance; among the remaining run-eligible trains
+    the run set is the cheapest selection per (branded, cleaning-due) group
+    that keeps >= min_branded_run branded runners and leaves enough due trains
+    off the run list for clean_due_min. Every run count is scored against the
+    cheapest feasible standby/maintenance/cleaning split of the rest.
+    Returns None when the model is infeasible or not of this form.
+    """
+    if not fast_path_applicable(model):
+        return None
+    lim = model["limits"]
+    n = len(model["train_ids"])
+    run_cost = model["cost"][:, RUN]
+    jobcard = model["jobcard_open"]
+    free = ~jobcard
+    eligible = free & ~(model["fitness_block"] | model["low_fitness"] | model["sim_fail"])
+    due = model["needs_cleaning"] == 1
+    n_free = int(free.sum())
+    n_jobcard = n - n_free
+    if n_jobcard > lim["maint_cap"]:
+        return None
+
+    kb = lim.get("min_branded_run", 0)
+    kd = lim.get("clean_due_min", 0)
+    # at most due_slack cleaning-due trains may run, or clean_due_min cannot be met
+    due_slack = int((due & free).sum()) - kd
+    if due_slack < 0:
+        return None
+    branded = model["branded"] if kb > 0 else np.zeros(n, dtype=bool)
+    if due_slack >= int((due & eligible).sum()):
+        due = np.zeros(n, dtype=bool)
+
+    def group(mask):
+        idx = np.flatnonzero(eligible & mask)
+        return idx[np.argsort(run_cost[idx], kind="stable")]
+
+    grp_a, grp_b = group(branded & due), group(branded & ~due)
+    grp_c, grp_d = group(~branded & due), group(~branded & ~due)
+    pre_a = np.concatenate([[0.0], np.cumsum(run_cost[grp_a])])
+    pre_b = np.concatenate([[0.0], np.cumsum(run_cost[grp_b])])
+    g, lo, hi, unit = _non_run_costs(model, n_free, n_jobcard)
+
+    best = None
+    for a in range(max(0, kb - len(grp_b)), min(len(grp_a), due_slack) + 1):
+        lb_b = max(0, kb - a)
+        pool = np.concatenate([grp_b[lb_b:], grp_c[:due_slack - a], grp_d])
+        pool = pool[np.argsort(run_cost[pool], kind="stable")]
+        cum = (pre_a[a] + pre_b[lb_b]) + np.concatenate([[0.0], np.cumsum(run_cost[pool])])
+        r = a + lb_b + np.arange(len(pool) + 1)
+        ok = (r >= lim["min_run"]) & (r <= lim["max_run"]) & (r <= n_free)
+        if not ok.any():
+            continue
+        total = np.where(ok, cum + g[np.clip(n_free - r, 0, n_free)], np.inf)
+        k = int(np.argmin(total))
+        if np.isfinite(total[k]) and (best is None or total[k] < best[0]):
+            best = (float(total[k]), a, lb_b, pool[:k])
+    if best is None:
+        return None
+
+    _, a, lb_b, extra = best
+    assigned: List[Optional[str]] = [None] * n
+    for i in np.concatenate([grp_a[:a], grp_b[:lb_b], extra]).astype(np.int64):
+        assigned[i] = "run"
+    for i in np.flatnonzero(jobcard):
+        assigned[i] = "maintenance"
+
+    # split the free non-run trains with the same greedy used for the costs
+    rest = [i for i in range(n) if assigned[i] is None]
+    counts = dict(lo)
+    left = len(rest) - sum(lo.values())
+    for s in sorted(lo, key=lambda s: unit[s]):
+        take = min(max(left, 0), hi[s] - lo[s])
+        counts[s] += take
+        left -= take
+    # cleaning goes to due trains first so clean_due_min holds, then the rest in fleet order
+    due_all = model["needs_cleaning"] == 1
+    rest.sort(key=lambda i: not due_all[i])
+    cursor = 0
+    for s in (CLEANING, MAINTENANCE, STANDBY):
+        for i in rest[cursor:cursor + counts[s]]:
+            assigned[i] = STATES[s]
+        cursor += counts[s]
+    return assigned
+
+def schedule_objective(model: Dict[str, Any], assigned: List[Optional[str]]) -> Optional[float]:
+    """Objective value of an assignment (None if any train is unassigned)."""
+    if any(s is None for s in assigned):
+        return None
+    cols = np.array([STATES.index(s) for s in assigned], dtype=np.int64)
+    return float(model["cost"][np.arange(len(assigned)), cols].sum())
+
+def solve_schedule(model: Dict[str, Any], method: str = "auto", verify: bool = False, time_limit: int = 10,
+                   warm_start: Optional[List[Optional[str]]] = None) -> Tuple[str, List[Optional[str]], Dict[str, Any]]:
+    """Solve with the fast path when possible, falling back to CBC.
+    method: "auto" (fast path, CBC fallback), "fast" (same, kept for clarity) or "cbc".
+    verify: also solve with CBC and compare objective values.
+    warm_start: initial incumbent for CBC (the fast path does not need one).
+    Returns (status, assigned, info) where info names the solver used.
+    """
+    assigned = None
+    if method != "cbc":
+        with span("solve_fast"):
+            assigned = solve_schedule_fast(model)
+    if assigned is not None:
+        status = pulp.LpStatus[pulp.LpStatusOptimal]
+        info: Dict[str, Any] = {"solver": "fast"}
+    else:
+        with span("solve_cbc"):
+            status, assigned = solve_schedule_model(model, time_limit=time_limit, warm_start=warm_start)
+        info = {"solver": "cbc"}
+    count("kmrl_schedule_solves_total", solver=info["solver"], status=status)
+    if verify:
+        cbc_status, cbc_assigned = solve_schedule_model(model, time_limit=time_limit) if info["solver"] == "fast" else (status, assigned)
+        objective = schedule_objective(model, assigned)
+        cbc_objective = schedule_objective(model, cbc_assigned)
+        match = cbc_status == status and (
+            objective == cbc_objective
+            or (objective is not None and cbc_objective is not None and abs(objective - cbc_objective) <= 1e-6 * max(1.0, abs(cbc_objective)))
+        )
+        info["verification"] = {
+            "objective": objective,
+            "cbc_objective": cbc_objective,
+            "cbc_status": cbc_status,
+            "match": bool(match),
+        }
+        if not match:
+            logging.getLogger("scheduler").warning("Fast path disagrees with CBC", extra=info["verification"])
+    return status, assigned, info
+
+def schedule_response(fleet: Dict[str, Any], p: Dict[str, Any], model: Dict[str, Any], status: str, assigned: List[Optional[str]]) -> Dict[str, Any]:
+    """Assemble the /api/schedule payload (per-train explanations, ranking, conflicts)."""
+    fitness, jobcard, cleaning, stabling = fleet["fitness"], fleet["jobcard"], fleet["cleaning"], fleet["stabling"]
+    mileage = fleet["mileage"]
+    trains_info = fleet["trains"]["info"]
+    run_min_fitness_score = p["run_min_fitness_score"]
+    fail_train = p["fail_train"]
+    risk_w, mileage_w, branding_w = p["risk_w"], p["mileage_w"], p["branding_w"]
+    standby_w, maintenance_w, cleaning_w = p["standby_w"], p["maintenance_w"], p["cleaning_w"]
     result = []
     conflicts = []
-    for t in train_ids:
-        assigned = None
-        for s in states:
-            val = pulp.value(x[t][s])
-            if val is not None and round(val) == 1:
-                assigned = s
-                break
+    # per-train score components (for explainability/ranking), vectorized; NaN/inf -> None
+    state_of = np.array([s or "" for s in assigned], dtype=object)
+    rank = (
+        risk_w * model["risk_score"] - branding_w * model["branding_score"]
+        + mileage_w * np.where(state_of == "run", model["norm_mileage"], 0.0)
+        + p["wear_w"] * np.where(state_of == "run", model["norm_rate"], 0.0)
+        + np.where(state_of == "standby", standby_w, 0.0)
+        + np.where(state_of == "maintenance", maintenance_w, 0.0)
+        + np.where(state_of == "cleaning", cleaning_w, 0.0)
+    )
+    rank_scores = _column_safe(rank)
+    mileage_kms = model["mile_km"].tolist()
+    plan = departure_plan(fleet, model, assigned, rank_scores)
+    departure = {i: k + 1 for k, i in enumerate(plan["order"])} if plan else {}
+    shunted = set(plan["shunted"]) if plan else set()
+    for i, t in enumerate(model["train_ids"]):
+        state = assigned[i]
         explanation = []
         blocking_reasons = []
-        if fitness.get(t, {}).get("valid", 1) == 0:
+        if model["fitness_block"][i]:
             explanation.append("fitness expired")
             blocking_reasons.append("fitness expired")
-        if jobcard.get(t, {}).get("open", 0) == 1:
+        if model["jobcard_open"][i]:
             explanation.append("open job card")
             blocking_reasons.append("open job card")
-        if safe_float(fitness.get(t, {}).get("score", 1.0), 1.0) < run_min_fitness_score:
+        if model["low_fitness"][i]:
             explanation.append(f"fitness below run threshold {run_min_fitness_score}")
             blocking_reasons.append("fitness below threshold")
-        if needs_cleaning.get(t, 0) and assigned == "cleaning":
+        if model["needs_cleaning"][i] and state == "cleaning":
             explanation.append("cleaning due")
-        if t == fail_train and assigned != "run":
+        if t == fail_train and state != "run":
             explanation.append("simulated failure")
             blocking_reasons.append("simulated failure")
-        if branding_score[t] > 0:
-            explanation.append(f"branding priority:{branding_score[t]}")
+        branding_score = float(model["branding_score"][i])
+        if branding_score > 0:
+            explanation.append(f"branding priority:{branding_score}")
         # stabling site best-effort across likely column names (include 'bay')
         stab = stabling.get(t, {})
+        wear = mileage.get(t, {})
         stabling_site = None
         for key in ("site", "depot", "yard", "location", "stabling", "bay"):
             if key in stab and stab.get(key) not in (None, ""):
@@ -545,68 +2687,1467 @@ def api_schedule(params: Dict[Any, Any] = None):
                 break
 
         # record conflicts if train is not assigned to run but had a blocking reason
-        if assigned != "run" and blocking_reasons:
+        if state != "run" and blocking_reasons:
             conflicts.append({
                 "train_id": t,
-                "assigned": assigned,
+                "assigned": state,
                 "reasons": blocking_reasons
             })
 
-        # per-train score components (for explainability/ranking)
-        run_cost_component = risk_w * risk_score[t] - branding_w * branding_score[t]
-        mileage_component = safe_float(norm_mileage.get(t, 0.0) if assigned == "run" else 0.0, 0.0)
-
         result.append(
             {
                 "train_id": t,
-                "assigned": assigned,
+                "assigned": state,
                 "explanation": explanation,
-                "mileage_km": safe_number(mile_km[t]),
+                "mileage_km": mileage_kms[i],
+                "km_7d": wear.get("km_7d"),
+                "km_30d": wear.get("km_30d"),
+                "km_per_day": wear.get("km_per_day"),
                 "fitness_score": safe_number(fitness.get(t, {}).get("score", 1.0)),
                 "fitness_valid": int(fitness.get(t, {}).get("valid", 1)),
                 "jobcard_open": int(jobcard.get(t, {}).get("open", 0)),
-                "branding_priority": safe_number(branding_score[t]),
+                "branding_priority": branding_score,
                 "model": (trains_info.get(t, {}) or {}).get("model"),
                 "stabling_site": stabling_site,
                 "has_cleaning_record": bool(cleaning.get(t)),
-                "cleaning_due": int(needs_cleaning.get(t, 0)),
-                "rank_score": safe_number(
-                    run_cost_component
-                    + mileage_w * mileage_component
-                    + (standby_w if assigned == "standby" else 0.0)
-                    + (maintenance_w if assigned == "maintenance" else 0.0)
-                    + (cleaning_w if assigned == "cleaning" else 0.0)
-                )
+                "cleaning_due": int(model["needs_cleaning"][i]),
+                "rank_score": rank_scores[i],
+                "bay_position": plan["position"].get(i) if plan else None,
+                "departure_order": departure.get(i),
+                "blocked_by": plan["blocked_by"].get(i, []) if plan else [],
+                "shunt": i in shunted,
             }
         )
 
-    # rank induction list (lower objective contribution is better); only for readability
+    # rank induction list (lower objective contribution is better); with a depot
+    # layout the running trains come first, in the order the yard lets them out
     ranked = sorted(result, key=lambda r: (r["rank_score"] if r["rank_score"] is not None else 0.0))
+    if plan:
+        ranked = [result[i] for i in plan["order"]] + [r for r in ranked if r["departure_order"] is None]
 
-    return JSONResponse({
+    return {
         "schedule": result,
         "ranked": ranked,
         "conflicts": conflicts,
-        "objective_status": pulp.LpStatus[model.status],
+        "objective_status": status,
+        "shunting": plan["summary"] if plan else None,
         "parameters": {
-            "cleaning_capacity": cleaning_capacity,
-            "cleaning_due_threshold": cleaning_due_threshold,
-            "min_clean_due": min_clean_due,
-            "min_run": min_run,
-            "max_run": max_run,
-            "maintenance_capacity": maintenance_capacity,
-            "min_standby": min_standby,
-            "max_standby": max_standby,
-            "min_branded_run": min_branded_run,
+            "cleaning_capacity": p["cleaning_capacity"],
+            "cleaning_due_threshold": p["cleaning_due_threshold"],
+            "min_clean_due": p["min_clean_due"],
+            "min_run": p["min_run"],
+            "max_run": p["max_run"],
+            "maintenance_capacity": p["maintenance_capacity"],
+            "min_standby": p["min_standby"],
+            "max_standby": p["max_standby"],
+            "min_branded_run": p["min_branded_run"],
             "run_min_fitness_score": run_min_fitness_score,
             "risk_w": risk_w,
             "mileage_w": mileage_w,
+            "wear_w": p["wear_w"],
             "branding_w": branding_w,
-            "fail_train": fail_train
+            "fail_train": fail_train,
+            "shunt_w": p["shunt_w"],
         }
+    }
+
+def schedule_feasible(model: Dict[str, Any], assigned: List[Optional[str]]) -> bool:
+    """True when the assignment satisfies every row of the model."""
+    if not assigned or any(s is None for s in assigned):
+        return False
+    x = np.zeros(len(assigned) * len(STATES))
+    x[np.arange(len(assigned)) * len(STATES) + np.array([STATES.index(s) for s in assigned])] = 1
+    lhs = np.bincount(model["coo_rows"], weights=x[model["coo_cols"]], minlength=len(model["row_names"]))
+    sense = np.array(model["row_sense"])
+    rhs = model["row_rhs"]
+    return bool(np.all(np.where(sense == "E", lhs == rhs, np.where(sense == "L", lhs <= rhs, lhs >= rhs))))
+
+# ---------------------------------------------------------------------------
+# Stabling yard: the depot layout file is turned into a blocking index once
+# (per file change). A bay is a stabling line holding trains one behind the
+# other; a train can only leave once everything between it and the exit has
+# left or been shunted aside. The departure order of the chosen run set follows
+# the yard instead of rank_score alone, and the shunting moves are counted.
+# With shunt_w > 0 a secondary stage also swaps run/non-run states between
+# trains when that saves more shunting moves (weighted by shunt_w) than it
+# costs in objective; the status then reads "Optimal+shunting".
+# ---------------------------------------------------------------------------
+
+DEPOT_LAYOUT = os.getenv("DEPOT_LAYOUT")  # default: data/depot_layout.json
+SHUNT_CANDIDATES = int(os.getenv("SHUNT_CANDIDATES", "6"))  # swap partners tried per blocked/blocking train
+_YARD_CACHE: Dict[str, Any] = {}
+
+def depot_layout_path() -> Path:
+    return Path(DEPOT_LAYOUT) if DEPOT_LAYOUT else DATA_DIR / "depot_layout.json"
+
+def build_yard(layout: Dict[str, Any]) -> Dict[str, Any]:
+    """Blocking index of a depot layout.
+
+    layout: {"depot": name, "move_minutes": m, "headway_minutes": h,
+             "tracks": [{"bay": "A1", "ends": 1, "via": "B1"}, ...]}
+    ends=1 is a dead-end siding (exit at position 1), ends=2 a through line
+    with an exit at both ends; via names the track a line's trains cross to
+    reach the exit ladder. Each bay maps to its ends, its full via chain and
+    the bays whose trains cross it ("behind").
+    """
+    tracks: Dict[str, Dict[str, Any]] = {}
+    for t in layout["tracks"]:
+        bay = str(t["bay"]).strip()
+        ends = int(t.get("ends", 1))
+        if ends not in (1, 2):
+            raise ValueError(f"track {bay}: ends must be 1 or 2")
+        tracks[bay] = {"ends": ends, "via": str(t["via"]).strip() if t.get("via") else None}
+    index = {bay: {"ends": t["ends"], "via": [], "behind": []} for bay, t in tracks.items()}
+    for bay, t in tracks.items():
+        seen, cur = {bay}, t["via"]
+        while cur:
+            if cur not in tracks:
+                raise ValueError(f"track {bay}: unknown via track {cur}")
+            if cur in seen:
+                raise ValueError(f"track {bay}: via loop at {cur}")
+            seen.add(cur)
+            index[bay]["via"].append(cur)
+            index[cur]["behind"].append(bay)
+            cur = tracks[cur]["via"]
+    return {
+        "depot": layout.get("depot"),
+        "move_minutes": float(layout.get("move_minutes", 10)),
+        "headway_minutes": float(layout.get("headway_minutes", 3)),
+        "tracks": index,
+    }
+
+def load_yard() -> Optional[Dict[str, Any]]:
+    """Blocking index of the depot layout file, rebuilt only when the file changes.
+    None without a layout file (or with an unusable one): the yard is then ignored.
+    """
+    path = depot_layout_path()
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    signature = (path.name, st.st_mtime_ns, st.st_size)
+    with _FLEET_CACHE_LOCK:
+        if _YARD_CACHE.get("signature") == signature:
+            return _YARD_CACHE["yard"]
+    try:
+        yard = build_yard(json.loads(path.read_text(encoding="utf-8")))
+        yard["signature"] = signature
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        logging.getLogger("scheduler").error("Depot layout unusable", extra={"path": str(path), "error": str(e)})
+        yard = None
+    with _FLEET_CACHE_LOCK:
+        _YARD_CACHE.update(signature=signature, yard=yard)
+    return yard
+
+def yard_occupancy(fleet: Dict[str, Any], train_ids: List[str]) -> Dict[str, List[int]]:
+    """Train indices per bay, ordered from the exit end (position 1 first).
+    A "position" column in stabling.csv wins; otherwise the latest arrival
+    (timestamp) stands nearest the exit, then fleet order.
+    """
+    stabling = fleet["stabling"]
+    bays: Dict[str, List[Tuple[float, str, int]]] = {}
+    for i, t in enumerate(train_ids):
+        row = stabling.get(t) or {}
+        bay = row.get("bay")
+        if bay is None or str(bay).strip() in ("", "nan"):
+            continue
+        bays.setdefault(str(bay).strip(), []).append((safe_float(row.get("position"), np.nan), str(row.get("timestamp") or ""), i))
+    occupancy = {}
+    for bay, items in bays.items():
+        items.sort(key=lambda x: x[1], reverse=True)  # stable: ties keep fleet order
+        items.sort(key=lambda x: (np.isnan(x[0]), 0.0 if np.isnan(x[0]) else x[0]))
+        occupancy[bay] = [i for _, _, i in items]
+    return occupancy
+
+def _track_plan(ends: int, trains: List[int], departs: np.ndarray, clear: bool) -> Tuple[List[int], List[Tuple[int, List[int]]]]:
+    """Fewest shunting moves on one track for a fixed set of departing trains.
+
+    The stayers left in place must form one unbroken block: at the far end of a
+    dead-end siding, anywhere on a through line (the longest block is kept).
+    clear=True (another line's trains cross this one) keeps none.
+    Returns (stayers to shunt, [(exit end, departing trains in exit order)]).
+    """
+    dep = [bool(departs[i]) for i in trains]
+    if not clear and not any(dep):
+        return [], []
+    n = len(trains)
+    keep = (n, n)  # kept block [lo, hi)
+    if not clear:
+        if ends == 1:
+            lo = n
+            while lo > 0 and not dep[lo - 1]:
+                lo -= 1
+            keep = (lo, n)
+        else:
+            lo = 0
+            for k in range(n + 1):
+                if k == n or dep[k]:
+                    if k - lo > keep[1] - keep[0]:
+                        keep = (lo, k)
+                    lo = k + 1
+    moved = [trains[k] for k in range(n) if not dep[k] and not keep[0] <= k < keep[1]]
+    chains = [(1, [trains[k] for k in range(keep[0]) if dep[k]])]
+    if ends == 2:
+        chains.append((2, [trains[k] for k in range(n - 1, keep[1] - 1, -1) if dep[k]]))
+    return moved, [c for c in chains if c[1]]
+
+class YardState:
+    """Per-track shunting plans for one assignment, updated a track at a time."""
+
+    def __init__(self, yard: Dict[str, Any], occupancy: Dict[str, List[int]], departs: np.ndarray):
+        self.tracks = yard["tracks"]
+        self.occupancy = {bay: trains for bay, trains in occupancy.items() if bay in self.tracks}
+        self.departs = departs
+        self.bay_of = {i: bay for bay, trains in self.occupancy.items() for i in trains}
+        self.plans = {bay: self._plan(bay) for bay in self.occupancy}
+        self.revision = dict.fromkeys(self.occupancy, 0)
+
+    def _plan(self, bay: str):
+        clear = any(self.departs[self.occupancy.get(b, [])].any() for b in self.tracks[bay]["behind"])
+        return _track_plan(self.tracks[bay]["ends"], self.occupancy[bay], self.departs, clear)
+
+    def affected(self, *trains: int) -> set:
+        """Bays whose plan can change when these trains change state."""
+        bays = set()
+        for i in trains:
+            bay = self.bay_of.get(i)
+            if bay is not None:
+                bays.add(bay)
+                bays.update(b for b in self.tracks[bay]["via"] if b in self.occupancy)
+        return bays
+
+    def moves(self, bays=None) -> int:
+        return sum(len(self.plans[b][0]) for b in (self.occupancy if bays is None else bays))
+
+    def trial_moves(self, bays: set) -> int:
+        return sum(len(self._plan(b)[0]) for b in bays)
+
+    def update(self, bays: set):
+        for b in bays:
+            self.plans[b] = self._plan(b)
+            self.revision[b] += 1
+
+    def local_moves(self, n: int) -> np.ndarray:
+        """Per train: the moves on its own track and the tracks it crosses."""
+        local = np.zeros(n)
+        for bay, trains in self.occupancy.items():
+            local[trains] = len(self.plans[bay][0]) + sum(len(self.plans[b][0]) for b in self.tracks[bay]["via"] if b in self.plans)
+        return local
+
+    def shunted(self) -> List[int]:
+        return [i for shunted, _ in self.plans.values() for i in shunted]
+
+    def blocked_by(self) -> Dict[int, List[int]]:
+        """Shunted stayers standing between each departing train and its exit."""
+        blocked: Dict[int, List[int]] = {}
+        for bay, (_, chains) in self.plans.items():
+            trains = self.occupancy[bay]
+            crossed = [j for b in self.tracks[bay]["via"] if b in self.plans for j in self.plans[b][0]]
+            shunted = set(self.plans[bay][0])
+            for end, chain in chains:
+                for i in chain:
+                    k = trains.index(i)
+                    ahead = trains[:k] if end == 1 else trains[:k:-1]
+                    blocked[i] = [j for j in ahead if j in shunted] + crossed
+        return blocked
+
+def shunting_stage(fleet: Dict[str, Any], model: Dict[str, Any], p: Dict[str, Any],
+                   assigned: List[Optional[str]]) -> Tuple[List[Optional[str]], Optional[Dict[str, Any]]]:
+    """Secondary stage after the state assignment: swap the states of a running
+    and a non-running train while the shunting moves saved (times shunt_w)
+    outweigh the objective given up. State counts never change; every swap is
+    checked against the model rows. Returns (assignment, stage summary or None).
+    """
+    yard = fleet.get("yard")
+    if yard is None or not p["shunt_w"] > 0 or not assigned or any(s is None for s in assigned):
+        return assigned, None
+    with span("shunting"):
+        cost = model["cost"]
+        state = np.array([STATES.index(s) for s in assigned], dtype=np.int64)
+        ys = YardState(yard, yard_occupancy(fleet, model["train_ids"]), state == RUN)
+        before = ys.moves()
+        can_run = ~(model["fitness_block"] | model["jobcard_open"] | model["low_fitness"] | model["sim_fail"])
+        objective_delta = 0.0
+        swaps = 0
+        trials: Dict[Tuple[int, int], Tuple[Tuple[int, ...], int]] = {}  # (r, s) -> (track revisions, moves saved)
+        for _ in range(len(state)):
+            moved = ys.shunted()
+            if not moved:
+                break
+            runners = np.flatnonzero(state == RUN)
+            stayers = np.flatnonzero((state != RUN) & can_run)
+            if not len(runners) or not len(stayers):
+                break
+            # a blocked runner stays instead of one of the cheapest stayers to run ...
+            stay_margin = cost[stayers, RUN] - cost[stayers, state[stayers]]
+            cheap_stayers = stayers[np.argsort(stay_margin, kind="stable")[:SHUNT_CANDIDATES]]
+            blocked = np.array([i for i, b in ys.blocked_by().items() if b], dtype=np.int64)
+            pairs = [np.stack(np.meshgrid(blocked, cheap_stayers, indexing="ij"), -1).reshape(-1, 2)]
+            # ... or a shunted stayer runs instead of a runner that is cheap to stand down
+            moved = np.array(moved, dtype=np.int64)
+            moved = moved[can_run[moved]]
+            for k in (STANDBY, MAINTENANCE, CLEANING):
+                cheap_runners = runners[np.argsort(cost[runners, k] - cost[runners, RUN], kind="stable")[:SHUNT_CANDIDATES]]
+                pairs.append(np.stack(np.meshgrid(cheap_runners, moved[state[moved] == k], indexing="ij"), -1).reshape(-1, 2))
+            pairs = np.unique(np.concatenate(pairs), axis=0)
+            r_, s_ = pairs[:, 0], pairs[:, 1]
+            d_obj = cost[r_, state[s_]] + cost[s_, RUN] - cost[r_, RUN] - cost[s_, state[s_]]
+            # a swap cannot pay off beyond the moves on the tracks it touches
+            local = ys.local_moves(len(state))
+            hopeful = p["shunt_w"] * (local[r_] + local[s_]) > d_obj + 1e-9
+            scored = []
+            for r, s, d in zip(r_[hopeful].tolist(), s_[hopeful].tolist(), d_obj[hopeful].tolist()):
+                bays = ys.affected(r, s)
+                revision = tuple(ys.revision[b] for b in bays)
+                hit = trials.get((r, s))
+                if hit is not None and hit[0] == revision:
+                    saved = hit[1]
+                else:
+                    now = ys.moves(bays)
+                    ys.departs[r], ys.departs[s] = False, True
+                    saved = now - ys.trial_moves(bays)
+                    ys.departs[r], ys.departs[s] = True, False
+                    trials[(r, s)] = (revision, saved)
+                gain = p["shunt_w"] * saved - d
+                if saved > 0 and gain > 1e-9:
+                    scored.append((-gain, r, s, d, bays))
+            scored.sort(key=lambda c: c[:3])
+            for _, r, s, d_obj, bays in scored:
+                trial = state.copy()
+                trial[r], trial[s] = state[s], RUN
+                if schedule_feasible(model, [STATES[k] for k in trial]):
+                    state = trial
+                    ys.departs[r], ys.departs[s] = False, True
+                    ys.update(bays)
+                    objective_delta += d_obj
+                    swaps += 1
+                    break
+            else:
+                break
+        if swaps:
+            assigned = [STATES[k] for k in state]
+        summary = {"moves_before": before, "moves": ys.moves(), "swaps": swaps,
+                   "objective_delta": round(float(objective_delta), 6)}
+    count("kmrl_shunting_swaps_total", swaps)
+    return assigned, summary
+
+def departure_plan(fleet: Dict[str, Any], model: Dict[str, Any], assigned: List[Optional[str]],
+                   rank: List[Optional[float]]) -> Optional[Dict[str, Any]]:
+    """Morning departure order for the running trains.
+
+    Shunted stayers are moved aside first; then the train with the lowest
+    rank_score among those free to leave (nothing left in front of it, no
+    departures left on the tracks it crosses) goes next. Running trains in
+    bays the layout does not know are never blocked. None without a layout.
+    """
+    yard = fleet.get("yard")
+    if yard is None:
+        return None
+    train_ids = model["train_ids"]
+    departs = np.array([s == "run" for s in assigned], dtype=bool)
+    occupancy = yard_occupancy(fleet, train_ids)
+    ys = YardState(yard, occupancy, departs)
+    key = [r if r is not None else 0.0 for r in rank]
+
+    position = {i: k + 1 for trains in occupancy.values() for k, i in enumerate(trains)}
+    chains: List[Tuple[Optional[str], List[int]]] = [(bay, chain) for bay, (_, cs) in ys.plans.items() for _, chain in cs]
+    placed = {i for _, c in chains for i in c}
+    chains.extend((None, [int(i)]) for i in np.flatnonzero(departs) if i not in placed)
+
+    remaining = {bay: sum(len(c) for b, c in chains if b == bay) for bay in ys.occupancy}
+    waiting: Dict[str, List[int]] = {}
+    pending = []
+    for c, (bay, _) in enumerate(chains):
+        via = [b for b in (yard["tracks"][bay]["via"] if bay else []) if remaining.get(b)]
+        pending.append(len(via))
+        for b in via:
+            waiting.setdefault(b, []).append(c)
+    heads = [(key[chain[0]], c) for c, (_, chain) in enumerate(chains) if not pending[c]]
+    heapq.heapify(heads)
+    cursor = [0] * len(chains)
+    order: List[int] = []
+    while heads:
+        _, c = heapq.heappop(heads)
+        bay, chain = chains[c]
+        i = chain[cursor[c]]
+        order.append(i)
+        cursor[c] += 1
+        if cursor[c] < len(chain):
+            heapq.heappush(heads, (key[chain[cursor[c]]], c))
+        if bay is not None:
+            remaining[bay] -= 1
+            if not remaining[bay]:
+                for w in waiting.pop(bay, []):
+                    pending[w] -= 1
+                    if not pending[w]:
+                        heapq.heappush(heads, (key[chains[w][1][0]], w))
+    shunted = ys.shunted()
+    return {
+        "order": order,
+        "position": position,
+        "blocked_by": {i: [train_ids[j] for j in b] for i, b in ys.blocked_by().items()},
+        "shunted": shunted,
+        "summary": {
+            "depot": yard["depot"],
+            "moves": len(shunted),
+            "shunted": [train_ids[i] for i in shunted],
+            "estimated_minutes": round(len(shunted) * yard["move_minutes"] + len(order) * yard["headway_minutes"], 1),
+            "unknown_bays": sorted(b for b in occupancy if b not in yard["tracks"]),
+        },
+    }
+
+# ---------------------------------------------------------------------------
+# What-if scenarios: solved baselines are kept (keyed by data version, parameters
+# and solver) so a scenario that only moves a capacity or the simulated failure is
+# applied to the baseline model as a delta instead of rebuilding it.
+# ---------------------------------------------------------------------------
+
+SCENARIO_CACHE_SIZE = int(os.getenv("SCENARIO_CACHE_SIZE", "8"))
+_SCENARIO_LOCK = threading.Lock()
+_SCENARIO_BASELINES: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+# parameters a scenario may change and still be applied as a delta
+_DELTA_PARAMS = {"fail_train", "cleaning_capacity", "min_clean_due", "min_run", "max_run",
+                 "maintenance_capacity", "min_standby", "max_standby", "min_branded_run"}
+
+def scenario_key(version: Any, p: Dict[str, Any], method: str) -> str:
+    blob = json.dumps({"version": version, "params": p, "solver": method}, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+def remember_schedule(key: str, entry: Dict[str, Any]):
+    with _SCENARIO_LOCK:
+        _SCENARIO_BASELINES[key] = entry
+        _SCENARIO_BASELINES.move_to_end(key)
+        while len(_SCENARIO_BASELINES) > SCENARIO_CACHE_SIZE:
+            _SCENARIO_BASELINES.popitem(last=False)
+
+def lookup_schedule(key: str) -> Optional[Dict[str, Any]]:
+    with _SCENARIO_LOCK:
+        entry = _SCENARIO_BASELINES.get(key)
+        if entry is not None:
+            _SCENARIO_BASELINES.move_to_end(key)
+        return entry
+
+# Serialized /api/schedule responses, same key as the baselines above; bounded
+# by entry count and total bytes.
+SCHEDULE_CACHE_SIZE = int(os.getenv("SCHEDULE_CACHE_SIZE", "64"))
+SCHEDULE_CACHE_MAX_BYTES = int(os.getenv("SCHEDULE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+_SCHEDULE_RESULTS: "OrderedDict[str, bytes]" = OrderedDict()
+_SCHEDULE_RESULTS_BYTES = 0
+
+def store_schedule_result(key: str, body: bytes):
+    global _SCHEDULE_RESULTS_BYTES
+    if len(body) > SCHEDULE_CACHE_MAX_BYTES:
+        return
+    with _SCENARIO_LOCK:
+        old = _SCHEDULE_RESULTS.pop(key, None)
+        if old is not None:
+            _SCHEDULE_RESULTS_BYTES -= len(old)
+        _SCHEDULE_RESULTS[key] = body
+        _SCHEDULE_RESULTS_BYTES += len(body)
+        while len(_SCHEDULE_RESULTS) > SCHEDULE_CACHE_SIZE or _SCHEDULE_RESULTS_BYTES > SCHEDULE_CACHE_MAX_BYTES:
+            _, evicted = _SCHEDULE_RESULTS.popitem(last=False)
+            _SCHEDULE_RESULTS_BYTES -= len(evicted)
+
+def lookup_schedule_result(key: str) -> Optional[bytes]:
+    with _SCENARIO_LOCK:
+        body = _SCHEDULE_RESULTS.get(key)
+        if body is not None:
+            _SCHEDULE_RESULTS.move_to_end(key)
+        return body
+
+def invalidate_schedule_cache():
+    """Drop solved baselines and cached responses (keys embed the data version, so this only frees memory early)."""
+    global _SCHEDULE_RESULTS_BYTES
+    with _SCENARIO_LOCK:
+        _SCENARIO_BASELINES.clear()
+        _SCHEDULE_RESULTS.clear()
+        _SCHEDULE_RESULTS_BYTES = 0
+
+def apply_schedule_delta(model: Dict[str, Any], p_base: Dict[str, Any], p_new: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], bool]]:
+    """Derive the scenario model from a baseline model without rebuilding it.
+
+    Handles changed right-hand sides of the global rows and a moved/added/cleared
+    fail_train. Returns (model, tightened) where tightened means the scenario's
+    feasible set is contained in the baseline's, or None when the change needs a
+    full rebuild (weights, thresholds, or an optional row switching on or off).
+    """
+    changed = {k for k in p_new if p_new.get(k) != p_base.get(k)}
+    if not changed <= _DELTA_PARAMS:
+        return None
+    train_ids = model["train_ids"]
+    n = len(train_ids)
+    limits = schedule_limits(p_new, n, int((model["needs_cleaning"] == 1).sum()), int(model["branded"].sum()))
+    if limits.keys() != model["limits"].keys():
+        return None
+
+    row_names = list(model["row_names"])
+    row_sense = list(model["row_sense"])
+    row_rhs = model["row_rhs"].copy()
+    coo_rows, coo_cols = model["coo_rows"], model["coo_cols"]
+    tightened = True
+    for name, rhs in limits.items():
+        old = model["limits"][name]
+        if rhs != old:
+            r = row_names.index(name)
+            row_rhs[r] = rhs
+            tightened &= (rhs < old) if row_sense[r] == "L" else (rhs > old)
+
+    sim_fail = model["sim_fail"]
+    new_fail = np.array([t == p_new.get("fail_train") for t in train_ids], dtype=bool)
+    if not np.array_equal(new_fail, sim_fail):
+        # drop the old sim_fail_* row (a relaxation) ...
+        drop = [r for r, name in enumerate(row_names) if name.startswith("sim_fail_")]
+        if drop:
+            tightened = False
+            keep = np.ones(len(row_names), dtype=bool)
+            keep[drop] = False
+            remap = np.cumsum(keep) - 1
+            entries = keep[coo_rows]
+            coo_rows, coo_cols = remap[coo_rows[entries]], coo_cols[entries]
+            row_names = [x for r, x in enumerate(row_names) if keep[r]]
+            row_sense = [x for r, x in enumerate(row_sense) if keep[r]]
+            row_rhs = row_rhs[keep]
+        # ... and insert the new one where build_schedule_model puts it (before min_run)
+        if new_fail.any():
+            i = int(np.flatnonzero(new_fail)[0])
+            pos = row_names.index("min_run")
+            row_names.insert(pos, f"sim_fail_{train_ids[i]}")
+            row_sense.insert(pos, "E")
+            row_rhs = np.insert(row_rhs, pos, 0.0)
+            coo_rows = np.append(np.where(coo_rows >= pos, coo_rows + 1, coo_rows), pos)
+            coo_cols = np.append(coo_cols, i * len(STATES) + RUN)
+        sim_fail = new_fail
+
+    scenario = dict(model)
+    scenario.update({
+        "row_names": row_names,
+        "row_sense": row_sense,
+        "row_rhs": row_rhs,
+        "coo_rows": coo_rows,
+        "coo_cols": coo_cols,
+        "limits": limits,
+        "sim_fail": sim_fail,
+    })
+    return scenario, tightened
+
+def solved_schedule(fleet: Dict[str, Any], p: Dict[str, Any], method: str = "auto") -> Dict[str, Any]:
+    """Solved model for (fleet, p), from the baseline cache when already solved."""
+    key = scenario_key(fleet["version"], p, method)
+    entry = lookup_schedule(key)
+    if entry is None:
+        model = build_schedule_model(fleet, p)
+        status, assigned, info = solve_schedule(model, method=method)
+        entry = schedule_entry(key, fleet, p, model, status, assigned, info)
+        remember_schedule(key, entry)
+    return entry
+
+def schedule_entry(key: str, fleet: Dict[str, Any], p: Dict[str, Any], model: Dict[str, Any], status: str,
+                   primary: List[Optional[str]], info: Dict[str, Any]) -> Dict[str, Any]:
+    """Solved-schedule entry; the shunting stage runs on the solver's assignment,
+    which is kept as "primary" for optimality-based reuse and warm starts."""
+    assigned, info["shunting_stage"] = shunting_stage(fleet, model, p, primary)
+    return {"key": key, "p": p, "model": model, "status": status, "assigned": assigned, "primary": primary, "info": info}
+
+def reported_status(entry: Dict[str, Any]) -> str:
+    """objective_status of an entry: the solver status, marked when the shunting
+    stage swapped states so the assignment is no longer the MILP optimum."""
+    stage = entry["info"].get("shunting_stage")
+    return entry["status"] + "+shunting" if stage and stage["swaps"] else entry["status"]
+
+def solve_scenario(fleet: Dict[str, Any], base: Dict[str, Any], p: Dict[str, Any], method: str = "auto",
+                   remember: bool = True) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Solve a what-if scenario incrementally from a solved baseline entry.
+
+    The baseline assignment is reused outright when the delta only tightens the
+    model and the assignment is still feasible (it stays optimal); otherwise
+    the scenario is solved with the baseline assignment as CBC's warm start.
+    remember=False keeps one-off solves (batch sweeps) out of the baseline cache.
+    Returns (scenario entry, incremental info).
+    """
+    key = scenario_key(fleet["version"], p, method)
+    cached = lookup_schedule(key)
+    if cached is not None:
+        return cached, {"mode": "cached", "reused_baseline": False}
+    delta = apply_schedule_delta(base["model"], base["p"], p)
+    if delta is None:
+        model, tightened, mode = build_schedule_model(fleet, p), False, "rebuilt"
+    else:
+        (model, tightened), mode = delta, "delta"
+    base_optimal = base["status"] == pulp.LpStatus[pulp.LpStatusOptimal]
+    if tightened and base_optimal and schedule_feasible(model, base["primary"]):
+        status, assigned, info = base["status"], list(base["primary"]), dict(base["info"])
+        reused = True
+    else:
+        warm = base["primary"] if base_optimal else None
+        status, assigned, info = solve_schedule(model, method=method, warm_start=warm)
+        reused = False
+    entry = schedule_entry(key, fleet, p, model, status, assigned, info)
+    if remember:
+        remember_schedule(key, entry)
+    return entry, {"mode": mode, "reused_baseline": reused}
+
+def schedule_diff(base: Dict[str, Any], scenario: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-train state changes and objective movement from baseline to scenario."""
+    changed = [
+        {"train_id": t, "baseline": a, "scenario": b}
+        for t, a, b in zip(base["model"]["train_ids"], base["assigned"], scenario["assigned"])
+        if a != b
+    ]
+    base_obj = schedule_objective(base["model"], base["assigned"])
+    scen_obj = schedule_objective(scenario["model"], scenario["assigned"])
+    return {
+        "changed": changed,
+        "changed_count": len(changed),
+        "objective_baseline": safe_number(base_obj),
+        "objective_scenario": safe_number(scen_obj),
+        "objective_delta": safe_number(scen_obj - base_obj) if base_obj is not None and scen_obj is not None else None,
+    }
+
+# ---------------------------------------------------------------------------
+# Solve pool: schedule requests run on a bounded executor so a slow CBC solve
+# neither blocks the event loop nor takes over the server's shared threadpool.
+# Requests beyond the concurrency limit wait in the executor queue; past
+# SOLVE_QUEUE_MAX waiting requests the API answers 503 with Retry-After.
+# ---------------------------------------------------------------------------
+
+SOLVE_CONCURRENCY = max(1, int(os.getenv("SOLVE_CONCURRENCY", str(os.cpu_count() or 1))))
+SOLVE_QUEUE_MAX = int(os.getenv("SOLVE_QUEUE_MAX", "32"))
+_SOLVE_EXECUTOR = ThreadPoolExecutor(max_workers=SOLVE_CONCURRENCY, thread_name_prefix="solve")
+_SOLVE_PENDING = 0
+_SOLVE_PENDING_LOCK = threading.Lock()
+
+async def run_solve(fn: Callable[..., Any], *args) -> Any:
+    """Await fn(*args) on the solve pool; 503 when the queue is full."""
+    global _SOLVE_PENDING
+    with _SOLVE_PENDING_LOCK:
+        if _SOLVE_PENDING >= SOLVE_CONCURRENCY + SOLVE_QUEUE_MAX:
+            raise HTTPException(status_code=503, detail="Scheduler busy, retry shortly", headers={"Retry-After": "1"})
+        _SOLVE_PENDING += 1
+    try:
+        # copy the context so spans inside fn reach this request's timings
+        return await asyncio.get_running_loop().run_in_executor(_SOLVE_EXECUTOR, contextvars.copy_context().run, fn, *args)
+    finally:
+        with _SOLVE_PENDING_LOCK:
+            _SOLVE_PENDING -= 1
+
+# ---------------------------------------------------------------------------
+# Batch sweeps: many parameter sets against one fleet snapshot. Each scenario is
+# derived from the shared baseline model (apply_schedule_delta) and solved on a
+# thread pool; CBC runs as a child process, so CBC solves use separate cores.
+# ---------------------------------------------------------------------------
+
+SCHEDULE_BATCH_WORKERS = int(os.getenv("SCHEDULE_BATCH_WORKERS", str(os.cpu_count() or 1)))
+SCHEDULE_BATCH_MAX = int(os.getenv("SCHEDULE_BATCH_MAX", "500"))
+_BATCH_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_BATCH_EXECUTOR_LOCK = threading.Lock()
+
+def batch_executor() -> ThreadPoolExecutor:
+    global _BATCH_EXECUTOR
+    with _BATCH_EXECUTOR_LOCK:
+        if _BATCH_EXECUTOR is None:
+            _BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, SCHEDULE_BATCH_WORKERS), thread_name_prefix="schedule-batch")
+        return _BATCH_EXECUTOR
+
+def expand_batch_spec(spec: Dict[str, Any], train_ids: List[str]) -> List[Dict[str, Any]]:
+    """Turn a batch request into a list of /api/schedule override dicts.
+
+    Accepted forms (combinable, each layered over "base"):
+      {"scenarios": [{...}, ...]}                      explicit parameter sets
+      {"grid": {"cleaning_capacity": [1, 2, 3], ...}}  cartesian product
+      {"n_minus_1": true | ["T1", "T2"]}               fail each (listed) train in turn
+    """
+    base = spec.get("base") or {}
+    scenarios = [{**base, **(s or {})} for s in spec.get("scenarios") or []]
+    grid = spec.get("grid") or {}
+    if grid:
+        keys = list(grid)
+        values = [v if isinstance(v, list) else [v] for v in grid.values()]
+        scenarios += [{**base, **dict(zip(keys, combo))} for combo in itertools.product(*values)]
+    n_minus_1 = spec.get("n_minus_1")
+    if n_minus_1:
+        failing = train_ids if n_minus_1 is True else [t for t in n_minus_1 if t in train_ids]
+        scenarios += [{**base, "fail_train": t} for t in failing]
+    return scenarios
+
+def _batch_item(fleet: Dict[str, Any], base: Dict[str, Any], index: int, overrides: Dict[str, Any], method: str, detail: bool) -> Dict[str, Any]:
+    p = schedule_parameters(overrides, fleet["trains"]["rows"])
+    entry, incremental = solve_scenario(fleet, base, p, method, remember=False)
+    payload = schedule_response(fleet, p, entry["model"], reported_status(entry), entry["assigned"])
+    item = {
+        "index": index,
+        "params": overrides,
+        "objective_status": payload["objective_status"],
+        "objective": safe_number(schedule_objective(entry["model"], entry["assigned"])),
+        "run_count": sum(1 for s in entry["assigned"] if s == "run"),
+        "conflicts": len(payload["conflicts"]),
+        "solver": entry["info"]["solver"],
+        "incremental": incremental["mode"],
+    }
+    if detail:
+        item["result"] = {**payload, **entry["info"]}
+    return item
+
+@app.post("/api/schedule/batch")
+def api_schedule_batch(spec: Dict[Any, Any] = None):
+    """
+    Solve many scenarios against one fleet snapshot.
+    Body: see expand_batch_spec, plus optional "solver", "detail" (include full
+    per-scenario payloads) and "stream" (NDJSON: one line per finished scenario,
+    then a summary line). Without streaming the response is
+    {"results": [...], "summary": [...]} in scenario order.
+    """
+    spec = spec or {}
+    method = str(spec.get("solver", "auto"))
+    detail = bool(spec.get("detail", False))
+    fleet = load_fleet()
+    base = solved_schedule(fleet, schedule_parameters(spec.get("base") or {}, fleet["trains"]["rows"]), method)
+    scenarios = expand_batch_spec(spec, base["model"]["train_ids"])
+    if not scenarios:
+        raise HTTPException(status_code=400, detail="No scenarios: pass scenarios, grid or n_minus_1")
+    if len(scenarios) > SCHEDULE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Too many scenarios ({len(scenarios)} > {SCHEDULE_BATCH_MAX})")
+
+    started = time.perf_counter()
+    pool = batch_executor()
+    futures = [pool.submit(_batch_item, fleet, base, i, o, method, detail) for i, o in enumerate(scenarios)]
+    summary_keys = ("index", "params", "objective_status", "objective", "run_count", "conflicts", "solver")
+
+    def summary(items):
+        return [{k: item[k] for k in summary_keys} for item in sorted(items, key=lambda r: r["index"])]
+
+    if spec.get("stream"):
+        def lines():
+            done = []
+            for fut in as_completed(futures):
+                item = fut.result()
+                done.append(item)
+                yield json_bytes({"type": "result", **item}) + b"\n"
+            yield json_bytes({"type": "summary", "count": len(done), "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                              "summary": summary(done)}) + b"\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    items = [f.result() for f in futures]
+    return FastJSONResponse({
+        "count": len(items),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "results": items,
+        "summary": summary(items),
     })
 
+def schedule_request(params: Optional[Dict[Any, Any]]) -> Dict[str, Any]:
+    """Resolve /api/schedule params against the current fleet snapshot.
+    key identifies the result (data version + normalized params + solver); None for verify runs.
+    """
+    # load data (parsed tables are cached until the underlying CSV changes)
+    fleet = load_fleet()
+    overrides = params or {}
+    p = schedule_parameters(params, fleet["trains"]["rows"])
+    method = str(overrides.get("solver", "auto"))
+    verify = bool(overrides.get("verify_solver", False)) or os.getenv("SCHEDULER_VERIFY", "") == "1"
+    orient = str(overrides.get("orient", "records"))
+    if orient not in DATA_ORIENTS:
+        raise HTTPException(status_code=400, detail=f"orient must be one of {', '.join(DATA_ORIENTS)}")
+    key = None if verify else scenario_key(fleet["version"], p, method) + ("" if orient == "records" else "-" + orient)
+    return {"fleet": fleet, "p": p, "method": method, "verify": verify, "orient": orient, "key": key}
+
+def schedule_payload(req: Dict[str, Any]) -> Dict[str, Any]:
+    """/api/schedule body for a resolved request: build and solve (blocking)."""
+    fleet, p, method = req["fleet"], req["p"], req["method"]
+    with span("model_build"):
+        model = build_schedule_model(fleet, p)
+    set_gauge("kmrl_schedule_model_variables", len(model["train_ids"]) * len(STATES))
+    set_gauge("kmrl_schedule_model_constraints", len(model["row_names"]))
+    # exact fast path when the model allows it, CBC (with time limit) otherwise
+    status, assigned, info = solve_schedule(model, method=method, verify=req["verify"], time_limit=10)
+    # keep the solved model around as a what-if baseline
+    key = scenario_key(fleet["version"], p, method)
+    entry = schedule_entry(key, fleet, p, model, status, assigned, info)
+    assigned = entry["assigned"]
+    remember_schedule(key, entry)
+    with span("result_build"):
+        payload = schedule_response(fleet, p, model, reported_status(entry), assigned)
+    payload.update(info)
+    return payload
+
+def schedule_columns(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Column-oriented /api/schedule payload: schedule as {field: [values]} and
+    ranked as the train_id order (the rows are the same as in schedule)."""
+    rows = payload["schedule"]
+    columns = {k: [r[k] for r in rows] for k in rows[0]} if rows else {}
+    return {**payload, "schedule": columns, "ranked": [r["train_id"] for r in payload["ranked"]]}
+
+def schedule_body(req: Dict[str, Any]) -> bytes:
+    payload = schedule_payload(req)
+    with span("encode"):
+        if req["orient"] == "columns":
+            payload = schedule_columns(payload)
+        body = json_bytes(payload)
+    if req["key"] is not None:
+        store_schedule_result(req["key"], body)
+    return body
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+@app.post("/api/schedule")
+async def api_schedule(request: Request, params: Dict[Any, Any] = None):
+    """
+    Build and solve the scheduler MILP over the latest fleet tables.
+    Accepts optional JSON params to modify capacities or simulate a train failure.
+    The solve runs on the bounded solve pool, never on the event loop.
+    Results are cached per data version and parameters; the ETag names that
+    pair, so If-None-Match gets a 304 while nothing changed.
+    """
+    req = await run_in_threadpool(schedule_request, params)
+    headers = {}
+    body = None
+    if req["key"] is not None:
+        etag = f'"{req["key"]}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request, etag):
+            count("kmrl_schedule_result_cache_total", result="not_modified")
+            return Response(status_code=304, headers=headers)
+        body = lookup_schedule_result(req["key"])
+    count("kmrl_schedule_result_cache_total", result="miss" if body is None else "hit")
+    if body is None:
+        body = await run_solve(schedule_body, req)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def whatif_payload(body: Optional[Dict[Any, Any]]) -> Dict[str, Any]:
+    """/api/schedule/whatif body: baseline, incremental scenario and their diff (blocking)."""
+    body = body or {}
+    base_overrides = body.get("baseline") or {}
+    scenario_overrides = {**base_overrides, **(body.get("scenario") or {})}
+    method = str(body.get("solver", "auto"))
+    fleet = load_fleet()
+    rows = fleet["trains"]["rows"]
+    base = solved_schedule(fleet, schedule_parameters(base_overrides, rows), method)
+    scenario, incremental = solve_scenario(fleet, base, schedule_parameters(scenario_overrides, rows), method)
+    payloads = {}
+    for name, entry in (("baseline", base), ("scenario", scenario)):
+        payloads[name] = schedule_response(fleet, entry["p"], entry["model"], reported_status(entry), entry["assigned"])
+        payloads[name].update(entry["info"])
+    payloads["diff"] = schedule_diff(base, scenario)
+    payloads["incremental"] = incremental
+    return payloads
+
+@app.post("/api/schedule/whatif")
+async def api_schedule_whatif(body: Dict[Any, Any] = None):
+    """
+    Baseline vs. scenario in one call.
+    Body: {"baseline": {...}, "scenario": {...}, "solver": "auto"} where both take
+    /api/schedule params and scenario values override the baseline's. The
+    scenario is solved incrementally from the (cached) baseline model.
+    """
+    return FastJSONResponse(await run_solve(whatif_payload, body))
+
+# ---------------------------------------------------------------------------
+# Schedule change-feed: dashboards subscribe with GET /api/schedule/feed (SSE)
+# and their parameters. A committed ingestion marks the schedule stale, and so
+# does a data version moved by another worker (polled while anyone listens).
+# Once no commit has arrived for SCHEDULE_FEED_DEBOUNCE seconds (or
+# SCHEDULE_FEED_MAX_DELAY after the first), each distinct parameter set among
+# the subscribers is solved once and pushed with the per-train changes of
+# "assigned" since its previous push.
+# ---------------------------------------------------------------------------
+
+SCHEDULE_FEED_DEBOUNCE = float(os.getenv("SCHEDULE_FEED_DEBOUNCE", "0.5"))
+SCHEDULE_FEED_MAX_DELAY = float(os.getenv("SCHEDULE_FEED_MAX_DELAY", "3"))
+SCHEDULE_FEED_POLL = float(os.getenv("SCHEDULE_FEED_POLL", "2"))
+SCHEDULE_FEED_KEEPALIVE = float(os.getenv("SCHEDULE_FEED_KEEPALIVE", "15"))
+
+def assignment_diff(previous: Optional[Dict[str, Any]], current: Dict[str, Any]) -> Dict[str, Any]:
+    """Per-train changes of "assigned" between two {train_id: assigned} maps."""
+    previous = previous or {}
+    changed = [{"train_id": t, "previous": previous.get(t), "current": a} for t, a in current.items() if previous.get(t) != a]
+    changed += [{"train_id": t, "previous": a, "current": None} for t, a in previous.items() if t not in current]
+    return {"changed": changed, "changed_count": len(changed)}
+
+def params_key(params: Dict[str, Any]) -> str:
+    return json.dumps(params, sort_keys=True, default=str)
+
+class ScheduleFeed:
+    """Subscribers, the debounce state and the last pushed assignment per parameter set.
+    Lives on the event loop; notify() may be called from any thread."""
+
+    def __init__(self):
+        self.subscribers: Dict[int, Dict[str, Any]] = {}
+        self.last: Dict[str, Dict[str, Any]] = {}  # params key -> {"etag", "assigned"}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wake: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.first_change: Optional[float] = None
+        self.last_change: Optional[float] = None
+        self.version: Any = None
+        self._ids = itertools.count()
+
+    def subscribe(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop, self.wake, self.task = loop, asyncio.Event(), None
+        sub = {"id": next(self._ids), "params": params, "key": params_key(params), "queue": asyncio.Queue(maxsize=4)}
+        self.subscribers[sub["id"]] = sub
+        set_gauge("kmrl_schedule_feed_subscribers", len(self.subscribers))
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        return sub
+
+    def unsubscribe(self, sub: Dict[str, Any]):
+        self.subscribers.pop(sub["id"], None)
+        set_gauge("kmrl_schedule_feed_subscribers", len(self.subscribers))
+        if not any(s["key"] == sub["key"] for s in self.subscribers.values()):
+            self.last.pop(sub["key"], None)
+        if not self.subscribers and self.wake is not None:
+            self.wake.set()  # let run() notice and exit
+
+    def notify(self):
+        """Data changed (thread-safe): schedule a debounced recompute."""
+        loop = self.loop
+        if loop is None or not self.subscribers or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._mark)
+
+    def _mark(self):
+        now = time.monotonic()
+        self.first_change = self.first_change or now
+        self.last_change = now
+        self.wake.set()
+
+    async def run(self):
+        while self.subscribers:
+            if self.first_change is None:
+                timeout = SCHEDULE_FEED_POLL
+            else:
+                due = min(self.last_change + SCHEDULE_FEED_DEBOUNCE, self.first_change + SCHEDULE_FEED_MAX_DELAY)
+                timeout = max(0.0, due - time.monotonic())
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            if not self.subscribers:
+                break
+            if self.first_change is None:
+                # writes by other workers only show up in the shared version
+                version = await run_in_threadpool(STORAGE.data_version)
+                if self.version is not None and version != self.version:
+                    self._mark()
+                self.version = version
+                continue
+            due = min(self.last_change + SCHEDULE_FEED_DEBOUNCE, self.first_change + SCHEDULE_FEED_MAX_DELAY)
+            if time.monotonic() < due:
+                continue
+            self.first_change = self.last_change = None
+            try:
+                await self.push_all()
+            except Exception as e:
+                logging.getLogger("scheduler").error("Schedule feed recompute failed", extra={"error": str(e)})
+
+    async def push_all(self):
+        """Recompute once per distinct parameter set and push to its subscribers."""
+        groups: Dict[str, Dict[str, Any]] = {}
+        for sub in list(self.subscribers.values()):
+            groups.setdefault(sub["key"], sub["params"])
+        for key, params in groups.items():
+            event = await self.event(key, params, "data")
+            if event is None:
+                continue
+            for sub in list(self.subscribers.values()):
+                if sub["key"] == key:
+                    self.put(sub, event)
+
+    async def event(self, key: str, params: Dict[str, Any], reason: str) -> Optional[bytes]:
+        """SSE "schedule" event for params; None for a data event whose result was already pushed."""
+        version = await run_in_threadpool(STORAGE.data_version)
+        req = await run_in_threadpool(schedule_request, params)
+        last = self.last.get(key)
+        if reason == "data" and last is not None and last["etag"] == req["key"]:
+            return None
+        body = lookup_schedule_result(req["key"])
+        count("kmrl_schedule_result_cache_total", result="miss" if body is None else "hit")
+        if body is None:
+            body = await run_solve(schedule_body, req)
+        self.version = version
+        diff = None
+        if reason == "data" or last is None:
+            # a late subscriber must not move the baseline the others are diffed against
+            assigned = {r["train_id"]: r["assigned"] for r in json.loads(body)["schedule"]}
+            if reason == "data":
+                diff = assignment_diff(last["assigned"] if last else None, assigned)
+            self.last[key] = {"etag": req["key"], "assigned": assigned}
+        count("kmrl_schedule_feed_pushes_total", reason=reason)
+        head = json_bytes({"reason": reason, "etag": req["key"], "data_version": version, "diff": diff})
+        return b"event: schedule\ndata: " + head[:-1] + b',"result":' + body + b"}\n\n"
+
+    @staticmethod
+    def put(sub: Dict[str, Any], event: bytes):
+        queue = sub["queue"]
+        if queue.full():
+            queue.get_nowait()  # a slow client only needs the newest schedule
+        queue.put_nowait(event)
+
+SCHEDULE_FEED = ScheduleFeed()
+
+@app.get("/api/schedule/feed")
+async def api_schedule_feed(params: Optional[str] = Query(None, description="JSON object of /api/schedule params")):
+    """
+    Server-Sent Events stream of the schedule for the given params.
+    The first "schedule" event carries the current schedule. Later ones follow
+    committed data changes (debounced), each with "diff": the trains whose
+    assigned state changed since the previous event. Every event has "etag"
+    (usable as If-None-Match on /api/schedule), "data_version" and "result"
+    (the /api/schedule body).
+    """
+    try:
+        overrides = json.loads(params) if params else {}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+    if not isinstance(overrides, dict):
+        raise HTTPException(status_code=400, detail="params must be a JSON object")
+    # one records-oriented, unverified result per parameter set
+    overrides = {k: v for k, v in overrides.items() if k not in ("orient", "verify_solver")}
+    sub = SCHEDULE_FEED.subscribe(overrides)
+    try:
+        first = await SCHEDULE_FEED.event(sub["key"], overrides, "initial")
+    except BaseException:
+        SCHEDULE_FEED.unsubscribe(sub)
+        raise
+
+    async def stream():
+        try:
+            yield first
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub["queue"].get(), SCHEDULE_FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                yield event
+        finally:
+            SCHEDULE_FEED.unsubscribe(sub)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ---------------------------------------------------------------------------
+# Multi-night horizon: plan `days` nights with state carried between them (km
+# accrue on run nights, the cleaning counter resets on cleaning nights, an open
+# job card closes after its maintenance night). Solved by rolling horizon: a
+# `window`-night MILP is solved, its first night is committed, the state moves
+# forward and the next window is re-planned, warm-started from the previous one.
+# ---------------------------------------------------------------------------
+
+HORIZON_MAX_DAYS = int(os.getenv("HORIZON_MAX_DAYS", "31"))
+_HORIZON_PLANS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # params -> last plan, reused as warm start
+
+def horizon_parameters(overrides: Optional[Dict[Any, Any]]) -> Dict[str, Any]:
+    """Horizon settings from /api/schedule/horizon params (defaults applied)."""
+    overrides = overrides or {}
+    days = max(1, min(int(overrides.get("days", 7)), HORIZON_MAX_DAYS))
+    return {
+        "days": days,
+        "window": max(1, min(int(overrides.get("window", 3)), days)),
+        # km a train covers on a run night
+        "daily_km": float(overrides.get("daily_km", 300.0)),
+        # cost per train-night spent overdue for cleaning (counter >= cleaning_due_threshold)
+        "overdue_w": float(overrides.get("overdue_w", 10.0)),
+        # seconds of CBC time for the whole horizon, shared between the windows
+        "time_budget": float(overrides.get("time_budget", 30.0)),
+    }
+
+def horizon_state(model: Dict[str, Any]) -> Dict[str, Any]:
+    """Carried per-train state at the start of the horizon, from a single-night model."""
+    return {
+        "km": model["mile_km"].astype(float).copy(),
+        "clean_days": model["clean_days"].astype(float).copy(),
+        "jobcard_open": model["jobcard_open"].astype(bool).copy(),
+    }
+
+def build_horizon_model(base: Dict[str, Any], state: Dict[str, Any], p: Dict[str, Any], hp: Dict[str, Any],
+                        window: int, first_night: bool) -> Dict[str, Any]:
+    """MILP for `window` nights from `state`. Columns: x[(i*W + d)*4 + s] (binary,
+    train i takes state s on night d), then z[i*W + k] (continuous, train i's
+    (k+1)-th run night in the window), then one overdue slack per train-night
+    that can be overdue. Run nights cost risk + wear - branding as in the
+    single-night model; the mileage term moves to z, where the k-th run of a
+    train is charged at its projected km, so each extra run of a high-mileage
+    train costs more (with one night this is exactly the single-night objective).
+    first_night: the window starts tonight, so sim_fail and min_clean_due apply.
+    """
+    n, W, S = len(base["train_ids"]), window, len(STATES)
+    n_x, n_z = n * W * S, n * W
+    T = p["cleaning_due_threshold"]
+    km, clean_days = state["km"], state["clean_days"]
+
+    cost_x = np.zeros((n, W, S))
+    cost_x[:, :, RUN] = (p["risk_w"] * base["risk_score"] + p["wear_w"] * base["norm_rate"] - p["branding_w"] * base["branding_score"])[:, None]
+    cost_x[:, :, STANDBY] = p["standby_w"]
+    cost_x[:, :, MAINTENANCE] = p["maintenance_w"]
+    cost_x[:, :, CLEANING] = p["cleaning_w"]
+    ref_km = base["mile_km"].max() if n else 1.0
+    ref_km = max(1.0, float(ref_km))
+    cost_z = p["mileage_w"] * (km[:, None] + hp["daily_km"] * np.arange(W)[None, :]) / ref_km
+
+    # train-nights that are overdue unless cleaned within the last T nights
+    d_idx = np.arange(W)
+    can_be_overdue = (clean_days[:, None] + d_idx[None, :] >= T) | (d_idx[None, :] >= T - 1)
+    over_i, over_d = np.nonzero(can_be_overdue)
+    n_o = len(over_i)
+    n_cols = n_x + n_z + n_o
+
+    lower = np.zeros(n_cols)
+    upper = np.ones(n_cols)
+    upper[n_x + n_z:] = np.inf
+    x_at = lambda i, d, s: (np.asarray(i) * W + np.asarray(d)) * S + s
+    blocked = np.flatnonzero(base["fitness_block"] | base["low_fitness"])
+    for d in range(W):
+        upper[x_at(blocked, d, RUN)] = 0
+    lower[x_at(np.flatnonzero(state["jobcard_open"]), 0, MAINTENANCE)] = 1
+    if first_night:
+        upper[x_at(np.flatnonzero(base["sim_fail"]), 0, RUN)] = 0
+
+    rows: List[np.ndarray] = []
+    cols: List[np.ndarray] = []
+    vals: List[np.ndarray] = []
+    sense: List[str] = []
+    rhs: List[float] = []
+
+    def add(row_ids, col_ids, coef, senses, rights):
+        rows.append(len(sense) + np.asarray(row_ids, dtype=np.int64))
+        cols.append(np.asarray(col_ids, dtype=np.int64))
+        vals.append(np.broadcast_to(np.asarray(coef, dtype=float), len(cols[-1])))
+        sense.extend(senses)
+        rhs.extend(rights)
+
+    # one state per train and night
+    add(np.repeat(np.arange(n * W), S), np.arange(n_x), 1.0, ["E"] * (n * W), [1.0] * (n * W))
+    # run nights of train i == its z columns in use
+    run_cols = x_at(np.repeat(np.arange(n), W), np.tile(d_idx, n), RUN)
+    add(np.concatenate([np.repeat(np.arange(n), W), np.repeat(np.arange(n), W)]),
+        np.concatenate([run_cols, n_x + np.arange(n_z)]),
+        np.concatenate([np.ones(n_z), -np.ones(n_z)]), ["E"] * n, [0.0] * n)
+    # overdue slack + cleanings in the last T nights >= 1
+    if n_o:
+        lo = np.maximum(0, over_d - T + 1)
+        width = over_d - lo + 1
+        row_ids = np.repeat(np.arange(n_o), width)
+        offs = np.arange(width.sum()) - np.repeat(np.cumsum(width) - width, width)
+        clean_cols = x_at(np.repeat(over_i, width), np.repeat(lo, width) + offs, CLEANING)
+        add(np.concatenate([row_ids, np.arange(n_o)]), np.concatenate([clean_cols, n_x + n_z + np.arange(n_o)]),
+            1.0, ["G"] * n_o, [1.0] * n_o)
+    # nightly capacity and service rows, as in the single-night model
+    due_idx = np.flatnonzero(clean_days >= T)
+    branded_idx = np.flatnonzero(base["branded"])
+    limits = schedule_limits(p, n, len(due_idx), len(branded_idx))
+    all_idx = np.arange(n)
+    for d in range(W):
+        nightly = [("clean_cap", "L", all_idx, CLEANING), ("min_run", "G", all_idx, RUN), ("max_run", "L", all_idx, RUN),
+                   ("maint_cap", "L", all_idx, MAINTENANCE), ("min_standby", "G", all_idx, STANDBY),
+                   ("max_standby", "L", all_idx, STANDBY), ("min_branded_run", "G", branded_idx, RUN)]
+        if first_night and d == 0:
+            nightly.append(("clean_due_min", "G", due_idx, CLEANING))
+        for name, row_sense, idx, s in nightly:
+            if name in limits:
+                add(np.zeros(len(idx)), x_at(idx, d, s), 1.0, [row_sense], [limits[name]])
+
+    return {
+        "n": n, "window": W, "n_x": n_x, "n_z": n_z, "overdue": (over_i, over_d),
+        "cost": np.concatenate([cost_x.ravel(), cost_z.ravel(), np.full(n_o, hp["overdue_w"])]),
+        "lower": lower, "upper": upper, "n_int": n_x,
+        "coo_rows": np.concatenate(rows), "coo_cols": np.concatenate(cols), "coo_vals": np.concatenate(vals),
+        "row_sense": sense, "row_rhs": np.asarray(rhs, dtype=float),
+    }
+
+def write_milp_mps(model: Dict[str, Any], path: str):
+    """Fixed-format MPS for a generic model: columns X0000000.. (the first n_int
+    integer), rows C0000000.., coefficients from COO arrays, lower/upper bounds."""
+    n_cols = len(model["cost"])
+    rows, cols, vals = model["coo_rows"], model["coo_cols"], model["coo_vals"]
+    by_col = np.lexsort((rows, cols))
+    rows_sorted, vals_sorted = rows[by_col].tolist(), vals[by_col].tolist()
+    starts = np.searchsorted(cols[by_col], np.arange(n_cols + 1)).tolist()
+    cost = model["cost"].tolist()
+    lines = ["*SENSE:Minimize\n", "NAME          MODEL\n", "ROWS\n", " N  OBJ\n"]
+    lines += [" %s  C%07d\n" % (s, r) for r, s in enumerate(model["row_sense"])]
+    lines.append("COLUMNS\n")
+    n_int = model["n_int"]
+    for k in range(n_cols):
+        name = "X%07d" % k
+        if k == 0 and n_int:
+            lines.append("    MARK      'MARKER'                 'INTORG'\n")
+        lines += ["    %-8s  C%07d  % .12e\n" % (name, r, v) for r, v in zip(rows_sorted[starts[k]:starts[k + 1]], vals_sorted[starts[k]:starts[k + 1]])]
+        if cost[k] != 0:
+            lines.append("    %-8s  %-8s  % .12e\n" % (name, "OBJ", cost[k]))
+        if k == n_int - 1:
+            lines.append("    MARK      'MARKER'                 'INTEND'\n")
+    lines.append("RHS\n")
+    lines += ["    RHS       C%07d  % .12e\n" % (r, v) for r, v in enumerate(model["row_rhs"].tolist()) if v != 0]
+    lines.append("BOUNDS\n")
+    for k, (lo, up) in enumerate(zip(model["lower"].tolist(), model["upper"].tolist())):
+        name = "X%07d" % k
+        if lo == up:
+            lines.append(" FX BND       %-8s  % .12e\n" % (name, lo))
+            continue
+        if k < n_int and lo == 0 and up == 1:
+            lines.append(" BV BND       %-8s\n" % name)
+            continue
+        if lo != 0:
+            lines.append(" LO BND       %-8s  % .12e\n" % (name, lo))
+        if up != np.inf:
+            lines.append(" UP BND       %-8s  % .12e\n" % (name, up))
+    lines.append("ENDATA\n")
+    with open(path, "w") as f:
+        f.write("".join(lines))
+
+def horizon_start_values(hm: Dict[str, Any], plan: np.ndarray, T: int, clean_days: np.ndarray) -> np.ndarray:
+    """Column values for a window plan (n x W state indices), z and slacks included."""
+    n, W, S = hm["n"], hm["window"], len(STATES)
+    x = np.zeros((n, W, S))
+    x[np.arange(n)[:, None], np.arange(W)[None, :], plan] = 1
+    runs = (plan == RUN).sum(axis=1)
+    z = (np.arange(W)[None, :] < runs[:, None]).astype(float)
+    over_i, over_d = hm["overdue"]
+    cleaned = plan == CLEANING
+    o = np.zeros(len(over_i))
+    for m, (i, d) in enumerate(zip(over_i.tolist(), over_d.tolist())):
+        o[m] = 0.0 if cleaned[i, max(0, d - T + 1):d + 1].any() else 1.0
+    return np.concatenate([x.ravel(), z.ravel(), o])
+
+def write_milp_mst(values: np.ndarray, path: str):
+    lines = ["Stopped on time - objective value 0\n"]
+    lines += ["{:>7} {} {:>15} {:>23}\n".format(k, "X%07d" % k, v, 0) for k, v in enumerate(values.tolist())]
+    with open(path, "w") as f:
+        f.write("".join(lines))
+
+def solve_horizon_window(hm: Dict[str, Any], time_limit: int, start: Optional[np.ndarray]) -> Tuple[str, Optional[np.ndarray]]:
+    """CBC on one window; returns (status, n x W state indices) or (status, None) without a solution."""
+    n, W, S = hm["n"], hm["window"], len(STATES)
+    write_mst = (lambda path: write_milp_mst(start, path)) if start is not None else None
+    status, values = run_cbc(lambda path: write_milp_mps(hm, path), len(hm["cost"]), time_limit, write_mst)
+    x = np.round(values[:hm["n_x"]].reshape(n, W, S)) == 1
+    if status in (pulp.LpStatusInfeasible, pulp.LpStatusUnbounded) or not (x.sum(axis=2) == 1).all():
+        return pulp.LpStatus[status], None
+    return pulp.LpStatus[status], x.argmax(axis=2)
+
+def solve_horizon(fleet: Dict[str, Any], p: Dict[str, Any], hp: Dict[str, Any],
+                  previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Rolling-horizon plan: for each night, solve the next `window` nights, commit the
+    first and carry the state forward. previous: an earlier plan for the same
+    parameters (e.g. before the last data change), used as warm start.
+    """
+    base = build_schedule_model(fleet, p)
+    train_ids = base["train_ids"]
+    n, D, T = len(train_ids), hp["days"], p["cleaning_due_threshold"]
+    state = horizon_state(base)
+    start_state = {k: v.copy() for k, v in state.items()}
+    plan = np.full((n, D), -1, dtype=np.int64)
+    overdue = np.zeros((n, D), dtype=bool)
+    prior = None
+    if previous is not None:
+        # align the earlier plan with the current trains; unknown trains start on standby
+        pos = {t: i for i, t in enumerate(previous["train_ids"])}
+        prior = np.full((n, D), STANDBY, dtype=np.int64)
+        for i, t in enumerate(train_ids):
+            j = pos.get(t)
+            if j is not None:
+                prior[i, :min(D, previous["plan"].shape[1])] = previous["plan"][j, :D]
+    windows = []
+    deadline = time.perf_counter() + hp["time_budget"]
+    last: Optional[np.ndarray] = None
+    for t in range(D):
+        W = min(hp["window"], D - t)
+        started = time.perf_counter()
+        remaining = deadline - started
+        if windows and windows[-1]["seconds"] * (D - t) > remaining:
+            # the budget cannot cover full windows any more: plan the rest night by night
+            W = 1
+        limit = max(1, int(remaining / (D - t)))
+        hm = build_horizon_model(base, state, p, hp, W, first_night=(t == 0))
+        start = None
+        if last is not None and last.shape[1] > 1:
+            # previous window shifted by one night; its last night repeated to fill the window
+            guess = last[:, 1:]
+            start = np.concatenate([guess] + [guess[:, -1:]] * (W - guess.shape[1]), axis=1)[:, :W]
+        elif prior is not None:
+            start = prior[:, t:t + W]
+        with span("horizon_window"):
+            status, sol = solve_horizon_window(hm, limit, None if start is None else horizon_start_values(hm, start, T, state["clean_days"]))
+            if sol is None and W > 1:
+                # no solution in time: fall back to planning this night alone
+                hm = build_horizon_model(base, state, p, hp, 1, first_night=(t == 0))
+                status, sol = solve_horizon_window(hm, max(1, limit), None)
+        windows.append({"night": t + 1, "window": hm["window"], "status": status,
+                        "seconds": round(time.perf_counter() - started, 3)})
+        if sol is None:
+            break
+        last = sol
+        tonight = sol[:, 0]
+        plan[:, t] = tonight
+        overdue[:, t] = (state["clean_days"] >= T) & (tonight != CLEANING)
+        # carry the state into the next night
+        state["km"] = state["km"] + hp["daily_km"] * (tonight == RUN)
+        state["clean_days"] = np.where(tonight == CLEANING, 1.0, state["clean_days"] + 1)
+        state["jobcard_open"] = state["jobcard_open"] & (tonight != MAINTENANCE)
+    return {"train_ids": train_ids, "plan": plan, "overdue": overdue, "windows": windows,
+            "km_start": start_state["km"], "km_end": state["km"], "warm_start": prior is not None}
+
+def horizon_payload(result: Dict[str, Any], hp: Dict[str, Any]) -> Dict[str, Any]:
+    plan, overdue = result["plan"], result["overdue"]
+    planned = int((plan[0] >= 0).sum()) if len(plan) else 0
+    state_of = lambda s: STATES[s] if s >= 0 else None
+    nights = []
+    for t in range(hp["days"]):
+        column = plan[:, t]
+        nights.append({
+            "night": t + 1,
+            "committed": t == 0,
+            "planned": bool((column >= 0).all()) and len(column) > 0,
+            "counts": {s: int((column == k).sum()) for k, s in enumerate(STATES)},
+            "overdue_cleaning": int(overdue[:, t].sum()),
+        })
+    trains = []
+    for i, t in enumerate(result["train_ids"]):
+        trains.append({
+            "train_id": t,
+            "plan": [state_of(s) for s in plan[i].tolist()],
+            "km_start": float(result["km_start"][i]),
+            "km_end": float(result["km_end"][i]),
+            "runs": int((plan[i] == RUN).sum()),
+            "cleanings": int((plan[i] == CLEANING).sum()),
+            "overdue_nights": int(overdue[i].sum()),
+        })
+    spread = lambda km: float(km.max() - km.min()) if len(km) else 0.0
+    return {
+        "days": hp["days"],
+        "window": hp["window"],
+        "committed": [{"train_id": t, "assigned": state_of(plan[i, 0]) if plan.shape[1] else None}
+                      for i, t in enumerate(result["train_ids"])] if planned else [],
+        "nights": nights,
+        "trains": trains,
+        "mileage_spread": {"start": spread(result["km_start"]), "end": spread(result["km_end"])},
+        "overdue_train_nights": int(overdue.sum()),
+        "windows": result["windows"],
+        "warm_start": result["warm_start"],
+    }
+
+def horizon_body(params: Optional[Dict[Any, Any]]) -> bytes:
+    """/api/schedule/horizon body (blocking); cached like /api/schedule per data version and params."""
+    params = params or {}
+    fleet = load_fleet()
+    p = schedule_parameters(params, fleet["trains"]["rows"])
+    hp = horizon_parameters(params)
+    plan_key = scenario_key(None, {**p, **hp}, "horizon")
+    key = "horizon-" + scenario_key(fleet["version"], {**p, **hp}, "horizon")
+    body = lookup_schedule_result(key)
+    if body is not None:
+        return body
+    with _SCENARIO_LOCK:
+        previous = _HORIZON_PLANS.get(plan_key)
+    result = solve_horizon(fleet, p, hp, previous)
+    with _SCENARIO_LOCK:
+        _HORIZON_PLANS[plan_key] = {"train_ids": result["train_ids"], "plan": result["plan"]}
+        _HORIZON_PLANS.move_to_end(plan_key)
+        while len(_HORIZON_PLANS) > SCENARIO_CACHE_SIZE:
+            _HORIZON_PLANS.popitem(last=False)
+    with span("encode"):
+        body = json_bytes(horizon_payload(result, hp))
+    store_schedule_result(key, body)
+    return body
+
+@app.post("/api/schedule/horizon")
+async def api_schedule_horizon(params: Dict[Any, Any] = None):
+    """
+    Multi-night plan. Takes /api/schedule params plus days (default 7), window
+    (nights per MILP, default 3), daily_km, overdue_w and time_budget (CBC
+    seconds for the whole plan). Night 1 is the committed schedule; later
+    nights are the current plan and are re-planned on every call, warm-started
+    from the last plan for the same parameters.
+    """
+    return Response(content=await run_solve(horizon_body, params), media_type="application/json")
+
+# ---------------------------------------------------------------------------
+# Startup warm-up: the lifespan hook loads the fleet tables, runs CBC on a
+# two-train model (the first run of the binary is the slow one) and solves the
+# default schedule into the result cache. It runs in the background so the
+# server accepts connections at once; GET /api/ready answers 503 until it is
+# done, for readiness probes. WARMUP=0 skips it (ready at once).
+# ---------------------------------------------------------------------------
+
+WARMUP = os.getenv("WARMUP", "1") != "0"
+_WARMUP_STATE: Dict[str, Any] = {"ready": not WARMUP, "started": False, "stages_ms": {}, "total_ms": None, "error": None}
+
+def warmup_fleet() -> Dict[str, Any]:
+    """Two trains and no records: the smallest model that still runs every solver step."""
+    ids = ["WARMUP1", "WARMUP2"]
+    fleet = {name: {} for name in FLEET_TABLES}
+    fleet.update({"trains": {"rows": len(ids), "train_ids": ids, "info": {}}, "yard": None, "version": None})
+    return fleet
+
+def warm_up():
+    """The blocking warm-up steps, each timed into _WARMUP_STATE["stages_ms"]."""
+    stages = _WARMUP_STATE["stages_ms"]
+
+    def step(name: str, fn: Callable[[], Any]):
+        started = time.perf_counter()
+        fn()
+        stages[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    step("load_fleet", load_fleet)
+    tiny = warmup_fleet()
+    step("cbc", lambda: solve_schedule_model(build_schedule_model(tiny, schedule_parameters({}, 2))))
+    step("schedule", lambda: schedule_body(schedule_request({})))
+
+async def run_warmup():
+    logger = logging.getLogger("startup")
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(warm_up)
+    except Exception as e:
+        # still ready: the endpoints report their own errors
+        _WARMUP_STATE["error"] = str(e)
+        logger.warning("Warm-up failed", extra={"error": str(e)})
+    _WARMUP_STATE["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    _WARMUP_STATE["ready"] = True
+    logger.info("Warm-up done", extra={"total_ms": _WARMUP_STATE["total_ms"], **_WARMUP_STATE["stages_ms"]})
+
+def start_warmup():
+    """Start run_warmup once per process (a no-op with WARMUP=0)."""
+    if _WARMUP_STATE["ready"] or _WARMUP_STATE["started"]:
+        return
+    _WARMUP_STATE["started"] = True
+    asyncio.get_running_loop().create_task(run_warmup())
+
+@app.get("/api/ready")
+async def api_ready():
+    """Readiness: 200 once the startup warm-up has finished, 503 before; the body has its step timings."""
+    state = _WARMUP_STATE
+    body = {"ready": state["ready"], "warmup": {k: state[k] for k in ("stages_ms", "total_ms", "error")}}
+    return FastJSONResponse(body, status_code=200 if state["ready"] else 503)
+
 if __name__ == '__main__':
+    import sys
+    import argparse
+    if len(sys.argv) > 1 and sys.argv[1] in ("migrate", "export"):
+        # Storage maintenance: `migrate` imports data/*.csv into SQLite,
+        # `export` writes every SQLite table back out as CSV.
+        parser = argparse.ArgumentParser(prog="backend.main")
+        parser.add_argument("command", choices=["migrate", "export"])
+        parser.add_argument("--db", type=Path, default=Path(os.getenv("FLEET_DB", str(DATA_DIR / "fleet.db"))))
+        parser.add_argument("--data-dir", type=Path, default=DATA_DIR, help="CSV source (migrate) or destination (export)")
+        args = parser.parse_args()
+        if args.command == "migrate":
+            counts = migrate_csv_to_sqlite(args.data_dir, args.db)
+        else:
+            counts = export_sqlite_to_csv(args.db, args.data_dir)
+        for table, n in counts.items():
+            print(f"{args.command}: {table} ({n} rows)")
+        sys.exit(0)
+
     import uvicorn
     import importlib
     # Choose an import string that works whether executed from project root or backend folder
@@ -617,5 +4158,10 @@ if __name__ == '__main__':
         # When running `python main.py` from inside the backend folder
         app_path = "main:app"
 
-    uvicorn.run(app_path, host="0.0.0.0", port=8000, reload=True)
+    # several workers share the data directory through data_lock; reload only works with one
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        uvicorn.run(app_path, host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app_path, host="0.0.0.0", port=8000, reload=True)
     print("Server started at http://localhost:8000")
\ No newline at end of file
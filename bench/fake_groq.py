@@ -0,0 +1,96 @@
+"""Offline stand-in for the Groq SDK's async client.
+
+Plug it into the backend with
+    backend.main.groq_async_client_factory = lambda api_key: FakeAsyncGroq(latency=0.5)
+Each call sleeps for `latency` seconds and answers with entries derived from
+the image bytes (same image -> same entries). A `fail_rate` share of calls
+raise the SDK's own 429 / 503 errors so the retry path is exercised too.
+With `upload_bps` set, each call also waits len(data URL) / upload_bps
+seconds to model the upload of the image payload. With stream=True the
+answer arrives in small chunks: `first_token_share` of the latency passes
+before the first one, and the rest is spread over the chunks.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+from types import SimpleNamespace
+
+import groq
+import httpx
+
+STATES = ["run", "standby", "maintenance", "cleaning"]
+
+
+def fake_entries(image_url: str, n: int, fleet_size: int = 40):
+    digest = hashlib.sha256(image_url.encode("utf-8")).digest()
+    rng = random.Random(digest)
+    return [
+        {"train_id": f"T{rng.randint(1, fleet_size)}", "status": rng.choice(STATES), "slot": f"B{rng.randint(1, 20)}"}
+        for _ in range(n)
+    ]
+
+
+class _Completions:
+    def __init__(self, owner: "FakeAsyncGroq"):
+        self.owner = owner
+
+    async def create(self, **request):
+        owner = self.owner
+        with owner._lock:
+            owner.calls += 1
+            owner.in_flight += 1
+            owner.max_in_flight = max(owner.max_in_flight, owner.in_flight)
+            fail = owner._rng.random() < owner.fail_rate
+        image_url = request["messages"][0]["content"][1]["image_url"]["url"]
+        content = json.dumps({"entries": fake_entries(image_url, owner.entries_per_image, owner.fleet_size)})
+        # optional upload cost so payload size shows up in latency
+        upload = len(image_url) / owner.upload_bps if owner.upload_bps else 0.0
+        try:
+            # time to first token; with stream=True the rest of `latency` is spread over the chunks
+            await asyncio.sleep(upload + (owner.latency * owner.first_token_share if request.get("stream") else owner.latency))
+            if fail:
+                status = owner._rng.choice([429, 503])
+                response = httpx.Response(status, headers={"retry-after": "0"}, request=httpx.Request("POST", "https://fake.groq/chat"))
+                cls = groq.RateLimitError if status == 429 else groq.InternalServerError
+                raise cls(f"fake {status}", response=response, body=None)
+        except BaseException:
+            with owner._lock:
+                owner.in_flight -= 1
+            raise
+        if request.get("stream"):
+            return self._stream(content)
+        with owner._lock:
+            owner.in_flight -= 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    async def _stream(self, content: str, size: int = 16):
+        owner = self.owner
+        pieces = [content[i:i + size] for i in range(0, len(content), size)]
+        step = owner.latency * (1 - owner.first_token_share) / max(1, len(pieces))
+        try:
+            for piece in pieces:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+                await asyncio.sleep(step)
+        finally:
+            with owner._lock:
+                owner.in_flight -= 1
+
+
+class FakeAsyncGroq:
+    def __init__(self, api_key: str = "fake", latency: float = 0.5, fail_rate: float = 0.0,
+                 entries_per_image: int = 5, fleet_size: int = 40, seed: int = 0,
+                 upload_bps: float = 0.0, first_token_share: float = 0.2):
+        self.latency = latency
+        self.first_token_share = first_token_share
+        self.upload_bps = upload_bps
+        self.fail_rate = fail_rate
+        self.entries_per_image = entries_per_image
+        self.fleet_size = fleet_size
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=_Completions(self))
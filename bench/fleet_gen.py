@@ -0,0 +1,97 @@
+"""Synthetic fleet data in the same CSV schemas as data/.
+
+    python bench/fleet_gen.py --trains 1000 --history 25 --updates 2 --out /tmp/fleet1000
+
+Writes trains, fitness, jobcard, branding, cleaning, mileage and stabling CSVs
+(plus an empty ingestion_log.csv and a depot_layout.json with about four
+trains per bay) for `trains` trains. Each train gets
+`history` mileage and stabling rows. `updates` adds that many timestamped
+upsert rows per train to fitness, jobcard, cleaning and branding, the way
+photo ingestion leaves superseded rows behind until compaction. Value
+distributions follow the bundled 40-train sample; the same seed gives the
+same files.
+"""
+import argparse
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+MODELS = {"3-car": 900, "4-car": 1200, "6-car": 1800}
+AUDIT_COLUMNS = ["timestamp", "filename", "size_bytes", "model", "entries_json", "updates_json", "raw_excerpt",
+                 "cache_hit", "content_sha256"]
+
+
+def depot_layout(trains: int):
+    """Three rows of bays, A and B dead-end sidings, C through lines (A1-C4 for the sample fleet)."""
+    per_row = max(4, math.ceil(trains / 12))
+    return {"depot": "synthetic", "move_minutes": 12, "headway_minutes": 4,
+            "tracks": [{"bay": f"{row}{n}", "ends": 2 if row == "C" else 1} for row in "ABC" for n in range(1, per_row + 1)]}
+
+
+def generate_fleet(out_dir: Path, trains: int, history: int = 25, updates: int = 0, seed: int = 0):
+    """Write the fleet tables for `trains` trains to out_dir; returns {file name: rows written}."""
+    rng = np.random.default_rng(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    ids = np.array([f"T{i}" for i in range(1, trains + 1)])
+    layout = depot_layout(trains)
+    bays = [t["bay"] for t in layout["tracks"]]
+    models = rng.choice(list(MODELS), size=trains, p=[0.25, 0.55, 0.2])
+    tables = {
+        "trains.csv": pd.DataFrame({"train_id": ids, "model": models, "capacity": [MODELS[m] for m in models]}),
+        "fitness.csv": pd.DataFrame({"train_id": ids, "valid": (rng.random(trains) < 0.78).astype(int),
+                                     "score": rng.uniform(0.5, 1.0, trains).round(2), "timestamp": ""}),
+        "jobcard.csv": pd.DataFrame({"train_id": ids, "open": (rng.random(trains) < 0.27).astype(int), "timestamp": ""}),
+        "branding.csv": pd.DataFrame({"train_id": ids, "priority": (rng.random(trains) < 0.15).astype(int),
+                                      "notes": "", "timestamp": ""}),
+        "cleaning.csv": pd.DataFrame({"train_id": ids, "last_cleaned_days": rng.integers(0, 15, trains), "timestamp": ""}),
+    }
+    # history: mileage grows per train, stabling bays drift
+    rep = np.repeat(ids, history)
+    start = rng.integers(40000, 60000, trains)
+    km = (np.repeat(start, history) + rng.integers(0, 600, trains * history).reshape(trains, history).cumsum(axis=1).ravel())
+    tables["mileage.csv"] = pd.DataFrame({"train_id": rep, "km": km})
+    tables["stabling.csv"] = pd.DataFrame({"train_id": rep, "bay": rng.choice(bays, trains * history)})
+
+    if updates:
+        # ingestion-style upserts: later timestamps supersede the seed rows
+        stamps = pd.Timestamp("2025-09-01T00:00:00Z") + pd.to_timedelta(rng.integers(0, 30 * 86400, trains * updates), unit="s")
+        stamps = stamps.strftime("%Y-%m-%dT%H:%M:%SZ")
+        upd_ids = np.tile(ids, updates)
+        n = len(upd_ids)
+        extra = {
+            "fitness.csv": {"valid": (rng.random(n) < 0.8).astype(int), "score": rng.choice([0.3, 0.8, 1.0], n)},
+            "jobcard.csv": {"open": (rng.random(n) < 0.3).astype(int)},
+            "cleaning.csv": {"last_cleaned_days": rng.choice([0, 999], n, p=[0.7, 0.3])},
+            "branding.csv": {"priority": (rng.random(n) < 0.2).astype(int), "notes": ""},
+        }
+        for name, cols in extra.items():
+            rows = pd.DataFrame({"train_id": upd_ids, **cols, "timestamp": stamps})
+            tables[name] = pd.concat([tables[name], rows], ignore_index=True)
+
+    written = {}
+    for name, df in tables.items():
+        df.to_csv(out_dir / name, index=False)
+        written[name] = len(df)
+    pd.DataFrame(columns=AUDIT_COLUMNS).to_csv(out_dir / "ingestion_log.csv", index=False)
+    (out_dir / "depot_layout.json").write_text(json.dumps(layout, indent=1))
+    return written
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--trains", type=int, default=1000)
+    ap.add_argument("--history", type=int, default=25, help="mileage/stabling rows per train")
+    ap.add_argument("--updates", type=int, default=0, help="ingested update rows per train and table")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", type=Path, required=True)
+    args = ap.parse_args()
+    for name, rows in generate_fleet(args.out, args.trains, args.history, args.updates, args.seed).items():
+        print(f"{name:<14} {rows:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Upload preprocessing: payload size, ingest latency and extraction accuracy.
+
+    python bench/image_bench.py                      # offline, fake client
+    python bench/image_bench.py --upscale 4          # also a simulated phone photo
+    GROQ_API_KEY=... python bench/image_bench.py --live
+
+Runs each image in static/demo through the vision call twice: once as
+uploaded and once after preprocess_image(). The vision cache is off. Offline,
+the fake client charges `--latency` plus upload time at `--upload-kbps`.
+With --live, the real Groq API is called, and the extracted train IDs are
+scored against bench/demo_expected.json.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import backend.main as m  # noqa: E402
+from fake_groq import FakeAsyncGroq  # noqa: E402
+
+EXPECTED = json.loads((Path(__file__).resolve().parent / "demo_expected.json").read_text())
+
+
+def load_images(upscale):
+    images = []
+    for path in sorted((ROOT / "static" / "demo").iterdir()):
+        if path.suffix.lower() not in (".jpg", ".jpeg", ".png", ".webp"):
+            continue
+        data = path.read_bytes()
+        images.append((path.name, path.name, data))
+        if upscale > 1 and m.Image is not None:
+            # a camera photo of the same sheet: larger and barely compressed
+            img = m.Image.open(io.BytesIO(data)).convert("RGB")
+            img = img.resize((img.width * upscale, img.height * upscale), m.Image.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=95)
+            images.append((f"{path.stem}@x{upscale}", path.name, buf.getvalue()))
+    return images
+
+
+def score(entries, expected):
+    got = {str(e.get("train_id", "")).strip().upper() for e in entries}
+    want = set(expected)
+    hit = len(got & want)
+    return hit / len(want) if want else 1.0, hit / len(got) if got else 1.0
+
+
+async def run_one(data, preprocess, client):
+    m.IMAGE_PREPROCESS = preprocess
+    start = time.perf_counter()
+    result = await m.call_groq_vision_async(data, client=client)
+    return time.perf_counter() - start, result
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--live", action="store_true", help="call the real Groq API (needs GROQ_API_KEY)")
+    ap.add_argument("--upscale", type=int, default=3, help="also bench an upscaled copy (1 to skip)")
+    ap.add_argument("--latency", type=float, default=0.8, help="fake model time in seconds")
+    ap.add_argument("--upload-kbps", type=float, default=2000.0, help="fake uplink in KB/s")
+    args = ap.parse_args()
+
+    if m.Image is None:
+        sys.exit("Pillow is not installed; preprocessing is a pass-through")
+    if args.live and not os.getenv("GROQ_API_KEY"):
+        sys.exit("--live needs GROQ_API_KEY")
+    os.environ.setdefault("GROQ_API_KEY", "fake")
+    m.LLM_CACHE_ENABLED = False
+    client = None if args.live else FakeAsyncGroq(latency=args.latency, upload_bps=args.upload_kbps * 1024)
+
+    print(f"{'image':<34} {'mode':<5} {'bytes':>9} {'size':>10} {'prep_ms':>8} {'call_s':>7} {'recall':>7} {'prec':>6}")
+    for label, source, data in load_images(args.upscale):
+        sent, info = m.preprocess_image(data)
+        for mode, on in (("raw", False), ("prep", True)):
+            elapsed, result = asyncio.run(run_one(data, on, client))
+            payload, dims = (sent, info.get("size_out")) if on else (data, info.get("size_in"))
+            if args.live and source in EXPECTED:
+                recall, precision = score(result["entries"], EXPECTED[source])
+                acc = f"{recall:>7.2f} {precision:>6.2f}"
+            else:
+                acc = f"{'-':>7} {'-':>6}"
+            size = "x".join(str(v) for v in dims) if dims else "-"
+            prep_ms = info.get("ms", 0.0) if on else 0.0
+            print(f"{label:<34} {mode:<5} {len(payload):>9} {size:>10} {prep_ms:>8.1f} {elapsed:>7.2f} {acc}")
+
+
+if __name__ == "__main__":
+    main()
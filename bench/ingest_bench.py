@@ -0,0 +1,67 @@
+"""Multi-image ingestion throughput against the fake Groq client (no network).
+
+    python bench/ingest_bench.py --images 12 --latency 0.5 --concurrency 1 4 8
+
+Runs /api/ingest-images in-process on a scratch copy of data/, once per
+concurrency level, and prints wall time, images/s and retry counts.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("GROQ_API_KEY", "fake")
+
+import httpx  # noqa: E402
+
+import backend.main as m  # noqa: E402
+from fake_groq import FakeAsyncGroq  # noqa: E402
+
+
+async def run_once(images, latency, fail_rate, concurrency):
+    fake = FakeAsyncGroq(latency=latency, fail_rate=fail_rate)
+    m.groq_async_client_factory = lambda api_key: fake
+    m.GROQ_CONCURRENCY = concurrency
+    files = [("files", (f"sheet{i}.jpg", os.urandom(2048), "image/jpeg")) for i in range(images)]
+    transport = httpx.ASGITransport(app=m.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        r = await client.post("/api/ingest-images", files=files)
+        elapsed = time.perf_counter() - start
+    r.raise_for_status()
+    report = r.json()["files"]
+    ok = sum(1 for f in report if f["status"] == "ok")
+    return elapsed, ok, fake.calls, fake.max_in_flight
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--images", type=int, default=12)
+    ap.add_argument("--latency", type=float, default=0.5, help="fake LLM round-trip in seconds")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="share of calls answered with 429/503")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    args = ap.parse_args()
+
+    m.GROQ_RETRY_BASE_DELAY = 0.01
+    m.LLM_CACHE_ENABLED = False  # every run is a real (fake) call; keeps data/llm_cache untouched
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'concurrency':>11} {'wall_s':>8} {'images/s':>9} {'ok':>4} {'calls':>6} {'peak':>5}")
+        for c in args.concurrency:
+            # fresh scratch copy per run so every run applies to the same data
+            data = Path(tmp) / f"data{c}"
+            shutil.copytree(ROOT / "data", data)
+            m.STORAGE = m.CsvStorage(data)
+            m.invalidate_fleet_cache()
+            elapsed, ok, calls, peak = asyncio.run(run_once(args.images, args.latency, args.fail_rate, c))
+            print(f"{c:>11} {elapsed:>8.2f} {args.images / elapsed:>9.2f} {ok:>4} {calls:>6} {peak:>5}")
+
+
+if __name__ == "__main__":
+    main()
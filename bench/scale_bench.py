@@ -0,0 +1,239 @@
+"""Scaling benchmark for the hot paths on synthetic fleets (no network).
+
+    python bench/scale_bench.py --trains 25 100 1000 10000 --out bench-results.jsonl
+    python bench/scale_bench.py --trains 25 1000 --baseline bench-results.jsonl
+
+For each fleet size a fresh data set is generated (fleet_gen.py) and served
+in-process. Each case is timed end to end, with the per-stage breakdown from
+the Server-Timing header. The cases are:
+- schedule_cold: /api/schedule with empty table caches
+- schedule_warm: /api/schedule with tables cached and the result cache cleared
+- schedule_cbc: schedule_warm forced through CBC
+- data_full: full /api/data, uncached
+- data_page: one 500-row page of mileage.csv
+- upsert: single-row append_or_update_csv
+- mileage_append: one appended mileage.csv reading, then /api/schedule
+- mileage_rewrite: mileage.csv rewritten in place (same inode, as an edit of
+  the mounted data/ would), then /api/schedule; fails if the edit is missed (CSV only)
+- ingest: /api/ingest-images through the fake vision client
+
+One JSON object per case and size is written to --out (or stdout), with the
+median wall time, the stages, the tracemalloc peak and the process max RSS.
+--baseline compares against an earlier file and exits 1 when a case got
+slower by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.environ.setdefault("GROQ_API_KEY", "fake")
+
+import httpx  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import backend.main as m  # noqa: E402
+from fake_groq import FakeAsyncGroq  # noqa: E402
+from fleet_gen import generate_fleet  # noqa: E402
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, dur = part.strip().partition(";dur=")
+        if name and dur:
+            stages[name] = float(dur)
+    return stages
+
+
+def cold():
+    m.invalidate_fleet_cache()
+
+
+def warm():
+    m.invalidate_schedule_cache()
+
+
+async def schedule_km(client, train_id):
+    r = await client.post("/api/schedule", json={})
+    r.raise_for_status()
+    return next(row["mileage_km"] for row in r.json()["schedule"] if row["train_id"] == train_id)
+
+
+async def request(client, method, url, **kw):
+    r = await client.request(method, url, **kw)
+    r.raise_for_status()
+    return parse_server_timing(r.headers.get("server-timing"))
+
+
+def cases(args):
+    """(name, setup, action) triples; actions are coroutines taking the HTTP client."""
+    fake = FakeAsyncGroq(latency=args.vision_latency, entries_per_image=args.entries_per_image, fleet_size=args.current_trains)
+    m.groq_async_client_factory = lambda api_key: fake
+    images = [("files", (f"sheet{i}.jpg", os.urandom(2048), "image/jpeg")) for i in range(args.ingest_images)]
+    counter = iter(range(10 ** 9))
+
+    async def upsert(client):
+        # the first call of a process builds the key index; later calls append
+        row = {"train_id": f"T{next(counter) % args.current_trains + 1}", "valid": 1, "score": 0.9}
+        started = time.perf_counter()
+        await asyncio.to_thread(m.append_or_update_csv, m.DATA_DIR / "fitness.csv", "train_id", row)
+        return {"upsert": (time.perf_counter() - started) * 1000}
+
+    async def mileage_append(client):
+        # the mileage rollup takes in the new row instead of re-reading the history
+        t = f"T{next(counter) % args.current_trains + 1}"
+        await asyncio.to_thread(m.STORAGE.append, "mileage.csv", {"train_id": t, "km": 10 ** 6 + next(counter)})
+        return await request(client, "POST", "/api/schedule", json={})
+
+    async def mileage_rewrite(client):
+        # raise one train's readings and append another train's; the rollup must rebuild
+        t = f"T{next(counter) % args.current_trains + 1}"
+        before = await schedule_km(client, t)
+        path = m.DATA_DIR / "mileage.csv"
+        df = pd.read_csv(path)
+        df.loc[df["train_id"] == t, "km"] += 1000
+        df = pd.concat([df, pd.DataFrame([{"train_id": "T1" if t != "T1" else "T2", "km": 10 ** 6 + next(counter)}])])
+        df.to_csv(path, index=False)  # truncates and rewrites the same file
+        started = time.perf_counter()
+        stages = await request(client, "POST", "/api/schedule", json={})
+        stages["rewrite_schedule"] = (time.perf_counter() - started) * 1000
+        after = await schedule_km(client, t)
+        if after != before + 1000:
+            raise SystemExit(f"mileage_rewrite: {t} mileage_km {before} -> {after}, expected {before + 1000}")
+        return stages
+
+    return [
+        ("schedule_cold", cold, lambda c: request(c, "POST", "/api/schedule", json={})),
+        ("schedule_warm", warm, lambda c: request(c, "POST", "/api/schedule", json={})),
+        ("schedule_cbc", warm, lambda c: request(c, "POST", "/api/schedule", json={"solver": "cbc"})),
+        ("data_full", cold, lambda c: request(c, "GET", "/api/data")),
+        ("data_page", None, lambda c: request(c, "GET", "/api/data", params={"tables": "mileage.csv", "limit": 500})),
+        ("upsert", None, upsert),
+        ("mileage_append", None, mileage_append),
+        *([("mileage_rewrite", None, mileage_rewrite)] if args.storage == "csv" else []),
+        ("ingest", None, lambda c: request(c, "POST", "/api/ingest-images", files=images)),
+    ]
+
+
+async def run_case(client, setup, action, repeat, memory):
+    walls, stages = [], []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        stages.append(await action(client))
+        walls.append((time.perf_counter() - started) * 1000)
+    peak = None
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        await action(client)
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    # stages of the median run
+    median = statistics.median(walls)
+    mid = min(range(len(walls)), key=lambda i: abs(walls[i] - median))
+    return median, stages[mid], peak
+
+
+async def run_size(args, trains, data_dir):
+    m.DATA_DIR = data_dir
+    if args.storage == "sqlite":
+        db = data_dir / "fleet.db"
+        m.migrate_csv_to_sqlite(data_dir, db)
+        m.STORAGE = m.SqliteStorage(db)
+    else:
+        m.STORAGE = m.CsvStorage(data_dir)
+    m.invalidate_fleet_cache()
+    args.current_trains = trains
+    transport = httpx.ASGITransport(app=m.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, setup, action in cases(args):
+            if args.only and name not in args.only:
+                continue
+            wall, stages, peak = await run_case(client, setup, action, args.repeat, args.memory)
+            results.append({"case": name, "trains": trains, "history": args.history, "updates": args.updates,
+                            "storage": args.storage, "wall_ms": round(wall, 2),
+                            "stages_ms": {k: round(v, 2) for k, v in stages.items()},
+                            "peak_alloc_mb": None if peak is None else round(peak, 2),
+                            "maxrss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)})
+            print(f"{name:<14} {trains:>6} {wall:>10.1f} {'' if peak is None else f'{peak:.1f}':>9}", file=sys.stderr)
+    return results
+
+
+def compare(results, baseline_path, tolerance):
+    baseline = {}
+    for line in Path(baseline_path).read_text().splitlines():
+        if line.strip():
+            r = json.loads(line)
+            baseline[(r["case"], r["trains"], r.get("storage", "csv"))] = r["wall_ms"]
+    regressions = []
+    for r in results:
+        old = baseline.get((r["case"], r["trains"], r["storage"]))
+        if old and r["wall_ms"] > old * (1 + tolerance):
+            regressions.append(f"{r['case']} @ {r['trains']} trains: {old:.1f} -> {r['wall_ms']:.1f} ms")
+    for line in regressions:
+        print("REGRESSION", line, file=sys.stderr)
+    return not regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--trains", type=int, nargs="+", default=[25, 100, 1000, 10000])
+    ap.add_argument("--history", type=int, default=25, help="mileage/stabling rows per train")
+    ap.add_argument("--updates", type=int, default=2, help="ingested update rows per train and table")
+    ap.add_argument("--storage", choices=["csv", "sqlite"], default="csv")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc run")
+    ap.add_argument("--ingest-images", type=int, default=8)
+    ap.add_argument("--entries-per-image", type=int, default=10)
+    ap.add_argument("--vision-latency", type=float, default=0.05, help="fake LLM round-trip in seconds")
+    ap.add_argument("--only", nargs="+", help="run only these cases")
+    ap.add_argument("--out", type=Path, help="JSON lines output (default stdout)")
+    ap.add_argument("--baseline", type=Path, help="earlier --out file to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    m.SERVER_TIMING = True
+    m.LLM_CACHE_ENABLED = False
+    m.IMAGE_PREPROCESS = False  # the fake images are random bytes
+    m.GROQ_RETRY_BASE_DELAY = 0.01
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    print(f"{'case':<14} {'trains':>6} {'wall_ms':>10} {'peak_mb':>9}", file=sys.stderr)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for trains in args.trains:
+            data_dir = Path(tmp) / f"fleet{trains}"
+            generate_fleet(data_dir, trains, args.history, args.updates)
+            results.extend(asyncio.run(run_size(args, trains, data_dir)))
+    lines = "".join(json.dumps({**r, "commit": commit}) + "\n" for r in results)
+    if args.out:
+        args.out.write_text(lines)
+    else:
+        sys.stdout.write(lines)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
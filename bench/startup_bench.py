@@ -0,0 +1,124 @@
+"""Cold-start benchmark: import time, warm-up and the first /api/schedule.
+
+    python bench/startup_bench.py --trains 25 1000 10000 --out startup-results.jsonl
+    python bench/startup_bench.py --trains 25 1000 --baseline startup-results.jsonl
+
+Every sample is a fresh interpreter on a generated fleet (fleet_gen.py), so
+nothing is cached between samples. The cases are:
+- import: `import backend.main`
+- first_schedule: the first /api/schedule of a process without warm-up
+- warmup: lifespan start until /api/ready answers 200
+- first_schedule_warmed: the first /api/schedule after the warm-up
+
+One JSON object per case and size is written to --out (or stdout) with the
+median wall time and the stages of the median sample (Server-Timing for
+requests, the warm-up steps for warmup). --baseline compares against an
+earlier file and exits 1 when a case got slower by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+# fleet_gen and scale_bench import pandas and the app; they are imported where
+# needed so a child process measures the app import from scratch
+
+
+def child(data_dir: Path, warm: bool):
+    """One cold process: print the timings of this sample as JSON."""
+    import asyncio
+    import httpx  # the app does not import it; keep it out of the import time
+    sys.path.insert(0, str(ROOT))
+    os.environ["SERVER_TIMING"] = "1"
+    os.environ["DEPOT_LAYOUT"] = str(data_dir / "depot_layout.json")
+    started = time.perf_counter()
+    import backend.main as m
+    out = {"import": {"wall_ms": (time.perf_counter() - started) * 1000, "stages_ms": {}}}
+    from scale_bench import parse_server_timing
+    m.DATA_DIR = data_dir
+    m.STORAGE = m.CsvStorage(data_dir)
+    m.invalidate_fleet_cache()
+
+    async def run():
+        transport = httpx.ASGITransport(app=m.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            if warm:
+                started = time.perf_counter()
+                async with m.app.router.lifespan_context(m.app):
+                    while (r := await client.get("/api/ready")).status_code != 200:
+                        await asyncio.sleep(0.005)
+                    out["warmup"] = {"wall_ms": (time.perf_counter() - started) * 1000, "stages_ms": r.json()["warmup"]["stages_ms"]}
+                    await first("first_schedule_warmed", client)
+            else:
+                await first("first_schedule", client)
+
+    async def first(name, client):
+        started = time.perf_counter()
+        r = await client.post("/api/schedule", json={})
+        r.raise_for_status()
+        out[name] = {"wall_ms": (time.perf_counter() - started) * 1000, "stages_ms": parse_server_timing(r.headers.get("server-timing"))}
+
+    asyncio.run(run())
+    print(json.dumps(out))
+
+
+def sample(data_dir: Path, warm: bool):
+    cmd = [sys.executable, __file__, "--child", str(data_dir)] + (["--warm"] if warm else [])
+    done = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return json.loads(done.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--trains", type=int, nargs="+", default=[25, 1000, 10000])
+    ap.add_argument("--history", type=int, default=25, help="mileage/stabling rows per train")
+    ap.add_argument("--updates", type=int, default=2, help="ingested update rows per train and table")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", type=Path, help="JSON lines output (default stdout)")
+    ap.add_argument("--baseline", type=Path, help="earlier --out file to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    ap.add_argument("--child", type=Path, help=argparse.SUPPRESS)
+    ap.add_argument("--warm", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        return child(args.child, args.warm)
+    from fleet_gen import generate_fleet
+    from scale_bench import compare
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    print(f"{'case':<22} {'trains':>6} {'wall_ms':>10}", file=sys.stderr)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for trains in args.trains:
+            data_dir = Path(tmp) / f"fleet{trains}"
+            generate_fleet(data_dir, trains, args.history, args.updates)
+            samples = [sample(data_dir, warm) for _ in range(args.repeat) for warm in (False, True)]
+            for name in ("import", "first_schedule", "warmup", "first_schedule_warmed"):
+                runs = [s[name] for s in samples if name in s]
+                median = statistics.median(r["wall_ms"] for r in runs)
+                mid = min(runs, key=lambda r: abs(r["wall_ms"] - median))
+                results.append({"case": name, "trains": trains, "history": args.history, "updates": args.updates,
+                                "storage": "csv", "wall_ms": round(median, 2),
+                                "stages_ms": {k: round(v, 2) for k, v in mid["stages_ms"].items()}})
+                print(f"{name:<22} {trains:>6} {median:>10.1f}", file=sys.stderr)
+    lines = "".join(json.dumps({**r, "commit": commit}) + "\n" for r in results)
+    if args.out:
+        args.out.write_text(lines)
+    else:
+        sys.stdout.write(lines)
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()